@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# agreement.py
+# Inter-rater agreement statistics for forum data annotator application.
+#
+# Author: Alex Kindel
+# Date: 19 July 2016
+
+from collections import defaultdict
+
+import numpy as np
+from dbutils import query
+
+
+MISSING = -1    # Label matrix entry for an item a coder has not coded
+CHUNK = 4096    # Items compared per block when counting pairwise agreement
+
+
+# Label encoding
+
+def code_label(code_value, targets):
+    '''Label compared across coders. Two "commenters" codes only agree if their targets agree.'''
+    if code_value == "commenters":
+        return (code_value, targets)
+    return (code_value, None)
+
+def label_matrices(records):
+    '''Encode (thread_id, user_id, item, code_value, targets) records as label matrices.
+
+    Returns the sorted coder ids, the number of distinct labels, and for each thread
+    a (items, matrix) pair where matrix[i, n] is coder i's label for items[n].'''
+    labels = dict()
+    coded = defaultdict(dict)  # thread_id -> {(user_id, item): label index}
+    coders = set()
+    for thread_id, user_id, item, code_value, targets in records:
+        label = labels.setdefault(code_label(code_value, targets), len(labels))
+        coded[thread_id][(user_id, item)] = label
+        coders.add(user_id)
+
+    coders = sorted(coders)
+    row = dict((user_id, i) for i, user_id in enumerate(coders))
+    matrices = dict()
+    for thread_id, cells in coded.items():
+        items = sorted(set(item for _, item in cells))
+        col = dict((item, n) for n, item in enumerate(items))
+        matrix = np.full((len(coders), len(items)), MISSING, dtype=np.int64)
+        for (user_id, item), label in cells.items():
+            matrix[row[user_id], col[item]] = label
+        matrices[thread_id] = (items, matrix)
+    return coders, len(labels), matrices
+
+
+# Statistics
+
+def pair_counts(matrix, n_labels):
+    '''Count, for every ordered coder pair, items both coded, items agreed on, and label margins.
+
+    margins[i, j, k] is the number of items coder i labelled k among those coder j also coded.'''
+    c = matrix.shape[0]
+    overlap = np.zeros((c, c))
+    agree = np.zeros((c, c))
+    margins = np.zeros(c * c * n_labels)
+    pair = np.arange(c * c).reshape(c, c, 1) * n_labels
+    for start in range(0, matrix.shape[1], CHUNK):
+        block = matrix[:, start:start + CHUNK]
+        coded = block != MISSING
+        both = coded[:, None, :] & coded[None, :, :]
+        overlap += both.sum(-1)
+        agree += ((block[:, None, :] == block[None, :, :]) & both).sum(-1)
+        margins += np.bincount((pair + block[:, None, :])[both], minlength=c * c * n_labels)
+    return overlap, agree, margins.reshape(c, c, n_labels)
+
+def item_counts(matrix, n_labels):
+    '''Per-item rating counts for items coded at least twice.
+
+    Returns ratings per item, sum over labels of n_ik * (n_ik - 1) per item, and label totals.'''
+    coder, item = np.nonzero(matrix != MISSING)
+    label = matrix[coder, item]
+    ratings = np.bincount(item, minlength=matrix.shape[1])
+    pairable = ratings[item] >= 2
+    item, label = item[pairable], label[pairable]
+
+    # Distinct (item, label) cells and how many coders chose each
+    cells, n_ik = np.unique(item * n_labels + label, return_counts=True)
+    same = np.bincount(cells // n_labels, weights=n_ik * (n_ik - 1.), minlength=matrix.shape[1])
+    totals = np.bincount(label, minlength=n_labels).astype(np.float64)
+    keep = ratings >= 2
+    return ratings[keep].astype(np.float64), same[keep], totals
+
+def fleiss_kappa(ratings, same, totals):
+    '''Fleiss' kappa, generalized to a varying number of ratings per item.'''
+    if not len(ratings):
+        return np.nan
+    observed = np.mean(same / (ratings * (ratings - 1)))
+    expected = np.sum((totals / totals.sum()) ** 2)
+    return (observed - expected) / (1 - expected)
+
+def krippendorff_alpha(ratings, same, totals):
+    '''Krippendorff's alpha for nominal labels.'''
+    n = ratings.sum()
+    if n < 2:
+        return np.nan
+    observed = np.sum(same / (ratings - 1)) / n
+    expected = np.sum(totals * (totals - 1)) / (n * (n - 1))
+    return (observed - expected) / (1 - expected)
+
+class Agreement(object):
+    '''Agreement statistics for a coder x item label matrix.
+
+    percent and kappa are coder x coder arrays (Cohen's kappa for kappa), NaN where a
+    pair has no items in common; fleiss and alpha summarize all coders at once.'''
+
+    def __init__(self, coders, matrix, n_labels):
+        self.coders = coders
+        self.items = matrix.shape[1]
+        overlap, agree, margins = pair_counts(matrix, n_labels)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.overlap = overlap
+            self.percent = agree / overlap
+            chance = (margins * margins.transpose(1, 0, 2)).sum(-1) / overlap ** 2
+            self.kappa = (self.percent - chance) / (1 - chance)
+            ratings, same, totals = item_counts(matrix, n_labels)
+            self.fleiss = fleiss_kappa(ratings, same, totals)
+            self.alpha = krippendorff_alpha(ratings, same, totals)
+
+    def pairs(self):
+        '''Yield (user_id, user_id, percent agreement, Cohen's kappa) for each ordered coder pair.'''
+        for i, ui in enumerate(self.coders):
+            for j, uj in enumerate(self.coders):
+                yield ui, uj, value(self.percent[i, j]), value(self.kappa[i, j])
+
+def value(x, digits=4):
+    '''Rounded float, or None where a statistic is undefined.'''
+    if np.isnan(x):
+        return None
+    return round(float(x), digits)
+
+def task_agreement(records):
+    '''Agreement per thread and pooled across threads for a task's code records.'''
+    coders, n_labels, matrices = label_matrices(records)
+    threads = dict()
+    for thread_id, (items, matrix) in matrices.items():
+        threads[thread_id] = Agreement(coders, matrix, n_labels)
+    if matrices:
+        pooled = np.hstack([matrices[t][1] for t in sorted(matrices)])
+    else:
+        pooled = np.empty((0, 0), dtype=np.int64)
+    return threads, Agreement(coders, pooled, max(n_labels, 1))
+
+
+# Persistent cache
+
+# SQL version of code_label equality between codes c1 and c2
+AGREE = ("(BINARY c1.code_value <=> BINARY c2.code_value AND "
+         "(BINARY COALESCE(c1.code_value, '') <> 'commenters' OR BINARY c1.targets <=> BINARY c2.targets))")
+
+# Pairs of codes by different coders on the same post in the same task
+CODE_PAIRS = """FROM codes c1
+                JOIN assignments a1 ON c1.assn_id = a1.assn_id
+                JOIN codes c2 ON c2.post_id = c1.post_id AND c2.user_id <> c1.user_id
+                JOIN assignments a2 ON c2.assn_id = a2.assn_id AND a2.task_id = a1.task_id"""
+
+def refresh_pairs(db, where):
+    '''Recount agreement for the coder pairs selected by a condition on c1/a1.'''
+    query(db, """REPLACE INTO pair_agreement (task_id, thread_id, user1_id, user2_id, overlap, agree)
+                 SELECT a1.task_id, a1.thread_id, LEAST(c1.user_id, c2.user_id), GREATEST(c1.user_id, c2.user_id), count(*), SUM(%s)
+                 %s
+                 WHERE %s
+                 GROUP BY a1.task_id, a1.thread_id, c1.user_id, c2.user_id""" % (AGREE, CODE_PAIRS, where))
+
+def refresh_disagreements(db, where):
+    '''Record unresolved disagreements for the code pairs selected by a condition on c1/a1.'''
+    query(db, """INSERT IGNORE INTO disagreements (task_id, thread_id, post_id, user1_id, user2_id)
+                 SELECT a1.task_id, a1.thread_id, c1.post_id, c1.user_id, c2.user_id
+                 %s
+                 WHERE %s AND c1.user_id < c2.user_id AND NOT %s
+                 AND NOT EXISTS (SELECT 1 FROM tiebreakers tb WHERE tb.post_id = c1.post_id AND tb.user_id IN (c1.user_id, c2.user_id))""" % (CODE_PAIRS, where, AGREE))
+
+def refresh_post(db, task_id, post_id):
+    '''Update cached disagreements on a post, e.g. after a tie is broken.'''
+    query(db, "DELETE FROM disagreements WHERE task_id = %d AND post_id = %d" % (int(task_id), int(post_id)))
+    refresh_disagreements(db, "a1.task_id = %d AND c1.post_id = %d" % (int(task_id), int(post_id)))
+
+def refresh_codes(db, task_id, assn_id, post_ids):
+    '''Update the cache after codes on an assignment's posts are inserted or replaced.'''
+    posts = ','.join(str(int(p)) for p in post_ids)
+    refresh_pairs(db, "c1.assn_id = %d" % int(assn_id))
+    query(db, "DELETE FROM disagreements WHERE task_id = %d AND post_id IN (%s)" % (int(task_id), posts))
+    refresh_disagreements(db, "a1.task_id = %d AND c1.post_id IN (%s)" % (int(task_id), posts))
+
+def rebuild(db, task_id):
+    '''Recompute a task's cached agreement and disagreements from codes.'''
+    query(db, "DELETE FROM pair_agreement WHERE task_id = %d" % int(task_id))
+    query(db, "DELETE FROM disagreements WHERE task_id = %d" % int(task_id))
+    refresh_pairs(db, "a1.task_id = %d AND c1.user_id < c2.user_id" % int(task_id))
+    refresh_disagreements(db, "a1.task_id = %d" % int(task_id))
+
+def cached_agreement(db, task_id):
+    '''Percent agreement keyed by (user_id, user_id, thread_id), in both pair orders.'''
+    pairwise = dict()
+    for row in query(db, "SELECT thread_id, user1_id, user2_id, overlap, agree FROM pair_agreement WHERE task_id = %d" % int(task_id)):
+        prop = round(float(row['agree']) / row['overlap'], 4)
+        pairwise[(row['user1_id'], row['user2_id'], row['thread_id'])] = prop
+        pairwise[(row['user2_id'], row['user1_id'], row['thread_id'])] = prop
+    return pairwise
+
+def disagreement_key(row):
+    '''Queue position of a disagreement, as a string usable in URLs and forms.'''
+    return "%d-%d-%d-%d" % (row['thread_id'], row['post_id'], row['u1_id'], row['u2_id'])
+
+def parse_disagreement_key(key):
+    '''(thread_id, post_id, user1_id, user2_id) from disagreement_key, or None if malformed.'''
+    try:
+        key = tuple(int(part) for part in key.split('-'))
+    except (AttributeError, ValueError):
+        return None
+    return key if len(key) == 4 else None
+
+def cached_disagreements(db, task_id, after=None, thread_id=None, pair=None, limit=None):
+    '''Unresolved disagreements for a task, in thread and post order.
+
+    Pages are keyed on the last disagreement seen (a parsed disagreement_key), so each
+    page is an index range scan on disagreements_thread however deep the queue is.'''
+    conditions = ["task_id = %d" % int(task_id)]
+    if thread_id is not None:
+        conditions.append("thread_id = %d" % int(thread_id))
+    if pair is not None:
+        conditions.append("user1_id = %d AND user2_id = %d" % tuple(sorted(int(u) for u in pair)))
+    if after is not None:
+        conditions.append("(thread_id > {0} OR (thread_id = {0} AND (post_id > {1} OR (post_id = {1} AND "
+                          "(user1_id > {2} OR (user1_id = {2} AND user2_id > {3}))))))".format(*[int(k) for k in after]))
+    q = """SELECT thread_id, post_id, user1_id AS u1_id, user2_id AS u2_id
+           FROM disagreements
+           WHERE %s
+           ORDER BY thread_id, post_id, user1_id, user2_id""" % ' AND '.join(conditions)
+    if limit is not None:
+        q += " LIMIT %d" % int(limit)
+    return query(db, q, fetchall=True)
+
+def disagreement_counts(db, task_id):
+    '''Unresolved disagreement counts for a task by thread and by coder pair.'''
+    threads = query(db, """SELECT d.thread_id, t.title, count(*) AS n
+                           FROM disagreements d JOIN threads t ON d.thread_id = t.thread_id
+                           WHERE d.task_id = %d
+                           GROUP BY d.thread_id, t.title
+                           ORDER BY d.thread_id""" % int(task_id), fetchall=True)
+    pairs = query(db, """SELECT d.user1_id AS u1_id, d.user2_id AS u2_id, u1.username AS u1_name, u2.username AS u2_name, count(*) AS n
+                         FROM disagreements d
+                           JOIN users u1 ON d.user1_id = u1.id
+                           JOIN users u2 ON d.user2_id = u2.id
+                         WHERE d.task_id = %d
+                         GROUP BY d.user1_id, d.user2_id, u1.username, u2.username
+                         ORDER BY d.user1_id, d.user2_id""" % int(task_id), fetchall=True)
+    return threads, pairs
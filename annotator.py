@@ -8,14 +8,27 @@
 from csv import DictReader
 from functools import wraps
 from collections import defaultdict
-from itertools import combinations, product
+from itertools import chain, product
+from multiprocessing import cpu_count
 import subprocess
-import time
 import os
+import time
 
-from flask import Flask, g, render_template, request, url_for, redirect, session, flash
+import click
+from flask import Flask, g, render_template, request, url_for, redirect, session, flash, jsonify, abort, get_template_attribute, Response, stream_with_context
 from werkzeug import generate_password_hash, check_password_hash
-from dbutils import with_db, query, dev_only
+from dbutils import with_db, query, stream, transaction, retry_on_lock, dev_only, init_app
+from cache import LRUCache
+from context import ThreadContext
+from dataset import COMPILED_SUFFIX, compile_rows, compiled_path, read_rows, source_stamp
+from assign import assign_balanced, codable_threads, write_assignments
+from export import EXPORT_TABLES, EXPORT_FORMATS, export_rows, export_lines
+from loader import BatchWriter, load_rows, load_threads, reposition
+from reddit_parser import page_paths, parse_pages
+from migrate import apply_migrations, explain_core_queries, pending
+import sqlite_backend
+import agreement
+import metrics
 
 
 # Application container
@@ -26,12 +39,33 @@ application = Flask(__name__)
 DEV_INSTANCE = True
 THREADS = 'data/discourse.csv'
 SECRET_KEY = os.environ['SECRET_KEY']
-dbms = {'username': os.environ['DB_USER'],
-        'password': os.environ['DB_PASS'],
-        'db': os.environ['DB_NAME'],
-        'host': os.environ['DB_HOST'],
-        'port': int(os.environ['DB_PORT'])}
+DB_BACKEND = os.environ.get('DB_BACKEND', 'mysql')
+if DB_BACKEND == 'sqlite':
+    dbms = {'backend': 'sqlite',
+            'path': os.environ.get('DB_PATH', 'data/annotator.db')}
+else:
+    dbms = {'username': os.environ['DB_USER'],
+            'password': os.environ['DB_PASS'],
+            'db': os.environ['DB_NAME'],
+            'host': os.environ['DB_HOST'],
+            'port': int(os.environ['DB_PORT'])}
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 10))
+TIES_PER_PAGE = 50
+THREAD_CACHE_BYTES = int(os.environ.get('THREAD_CACHE_BYTES', 64 * 1024 * 1024))
+USER_CACHE_TTL = 60  # Seconds a logged-in user's profile is trusted before it is re-read
+USER_CACHE_BYTES = 1024 * 1024
+FRAGMENT_CACHE_BYTES = int(os.environ.get('FRAGMENT_CACHE_BYTES', 32 * 1024 * 1024))
+LOAD_WRITERS = 2  # Connections writing loaded threads in parallel; 0 writes on the command's own connection
+PREFETCH_POSTS = 20  # Posts per annotation API request, and the most a client may ask for
+SUBMIT_QUERIES = 8  # Statements submit_codes runs (5 in its transaction, 3 refreshing agreement after it); a coding page POST runs 2 more (X-Query-Count), tracked by the submit_code benchmark
+SLOW_QUERY_MS = int(os.environ.get('SLOW_QUERY_MS', 250))  # Statements taking longer are logged
+SLOW_QUERY_LOG = os.environ.get('SLOW_QUERY_LOG')  # File for slow-query and N+1 warnings; stderr if unset
+N_PLUS_ONE_THRESHOLD = int(os.environ.get('N_PLUS_ONE_THRESHOLD', 20))  # Runs of one statement per request before warning
 application.config.from_object(__name__)
+init_app(application)  # Share one pooled connection per request, and profile its statements
+thread_cache = LRUCache(THREAD_CACHE_BYTES)  # Thread context trees by thread_id
+user_cache = LRUCache(USER_CACHE_BYTES, ttl=USER_CACHE_TTL)  # Session user profiles by user_id
+fragment_cache = LRUCache(FRAGMENT_CACHE_BYTES)  # Rendered post HTML by post_id, thread load stamp and variant
 
 
 # User session management
@@ -56,17 +90,29 @@ def superuser_required(f):
         return f(*args, **kwargs)
     return su_req_fn
 
-@application.before_request
 @with_db(dbms)
-def set_user(db):
+def fetch_user(db, user_id):
+    try:
+        return query(db, "SELECT id, username, first_name, last_name, superuser FROM users WHERE id = %d" % int(user_id)).next()
+    except StopIteration:
+        return None
+
+@application.before_request
+def set_user():
     '''Attach user information to HTTP requests.'''
     g.user = None
-    if 'user_id' in session:
-        try:
-            g.user = query(db, "SELECT id, username, first_name, last_name, superuser FROM users WHERE id = %s" % session['user_id']).next()
-        except StopIteration:
-            session.clear()
-            g.user = query(db, "SELECT id, username, first_name, last_name, superuser FROM users WHERE id = %s" % session['user_id']).next()
+    if request.endpoint == 'static' or 'user_id' not in session:
+        return  # Nothing to look up, so no connection either
+
+    # Profiles are cached briefly so most requests skip the users table
+    user_id = session['user_id']
+    g.user = user_cache.get(user_id)
+    if g.user is None:
+        g.user = fetch_user(user_id)
+        if g.user is None:
+            session.clear()  # User no longer exists
+        else:
+            user_cache.put(user_id, g.user)
 
 @application.route('/login', methods=['GET', 'POST'])
 @with_db(dbms)
@@ -77,7 +123,7 @@ def login(db):
     if request.method == 'POST':
         user = None
         try:
-            user = query(db, "SELECT id, pass_hash FROM users WHERE username = '%s'" % request.form['username']).next()
+            user = query(db, "SELECT id, pass_hash FROM users WHERE username = %s", args=[request.form['username']]).next()
         except StopIteration:
             pass
         if not user:
@@ -102,6 +148,7 @@ def userpage(db, username):
     '''Show assignment information for this user.'''
     user_id = g.user['id']
     assignments = query(db, "SELECT a.user_id, a.task_id, a.thread_id, t.label FROM assignments a JOIN tasks t ON a.task_id = t.task_id WHERE user_id = %d" % user_id, fetchall=True)
+    preload_progress(user_id=user_id)
     return render_template('user.html', username=username, assignments=assignments)
 
 @application.route('/admin', methods=['GET', 'POST'])
@@ -111,138 +158,120 @@ def admin(db):
     '''Logic for user admin page'''
     if request.method == 'POST':
         su = int(request.form.get('superuser') == 'on')
-        query(db, "INSERT INTO users(username, first_name, last_name, email, pass_hash, superuser) VALUES ('%s','%s','%s','%s','%s','%s')" %
-                  (request.form['username'], request.form['first_name'], request.form['last_name'], request.form['email'], generate_password_hash(request.form['password']), su))
+        query(db, "INSERT INTO users(username, first_name, last_name, email, pass_hash, superuser) VALUES (%s, %s, %s, %s, %s, %s)",
+              args=[request.form['username'], request.form['first_name'], request.form['last_name'], request.form['email'], generate_password_hash(request.form['password']), su])
+        user_cache.clear()  # Other processes pick up user changes after USER_CACHE_TTL
         return redirect(url_for('admin'))
     users = query(db, 'select id, username, first_name, last_name, superuser from users', fetchall=True)
     return render_template('admin.html', users=users)
 
+@application.route('/admin/metrics', methods=['GET', 'POST'])
+@superuser_required
+def query_metrics():
+    '''Request latency by route and the costliest statements, since this app process started or was reset.'''
+    if request.method == 'POST':
+        metrics.registry.reset()
+        return redirect(url_for('query_metrics'))
+    return render_template('metrics.html', routes=metrics.registry.route_summary(),
+                           statements=metrics.registry.statement_summary(),
+                           buckets=metrics.bucket_labels(), since=time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(metrics.registry.started_at)),
+                           slow_query_ms=metrics.SLOW_QUERY_MS, n_plus_one_threshold=metrics.N_PLUS_ONE_THRESHOLD)
+
 
 # Database funcs/procs interface
 
 @with_db(dbms)
 def total_posts(db, thread_id):
-    return query(db, "SELECT total_posts('%s')" % thread_id).next().values()[0]
+    return query(db, "SELECT total_posts(%s)", args=[thread_id]).next().values()[0]
 
 @with_db(dbms)
 def done_posts(db, assignmentid):
-    return query(db, "SELECT done_posts('%s')" % assignmentid).next().values()[0]
+    return query(db, "SELECT done_posts(%s)", args=[assignmentid]).next().values()[0]
 
 @with_db(dbms)
 def set_finished(db, assignmentid):
-    query(db, "CALL set_finished('%s')" % assignmentid)
+    query(db, "CALL set_finished(%s)", args=[assignmentid])
 
 @with_db(dbms)
 def title_of_thread(db, thread_id):
-    return query(db, "SELECT thread_title('%s')" % thread_id).next().values()[0]
+    return query(db, "SELECT thread_title(%s)", args=[thread_id]).next().values()[0]
 
 
 # Database management
 
 @application.cli.command('build')
-def build_db():
-    '''Rebuild MySQL tables for development.'''
-    subprocess.call("mysql -h %s -P %d -D %s -u %s -p%s < ./sql/schema.sql" % (dbms['host'], dbms['port'], dbms['db'], dbms['username'], dbms['password']), shell=True)
-    subprocess.call("mysql -h %s -P %d -D %s -u %s -p%s < ./sql/procs_funcs.sql" % (dbms['host'], dbms['port'], dbms['db'], dbms['username'], dbms['password']), shell=True)
-
-@application.cli.command('load')
 @with_db(dbms)
-def load_db(db):
+def build_db(db):
+    '''Rebuild database tables for development.'''
+    if DB_BACKEND == 'sqlite':
+        sqlite_backend.create_schema(db.connection)  # Already at the latest migration; procs_funcs.sql is emulated
+    else:
+        subprocess.call("mysql -h %s -P %d -D %s -u %s -p%s < ./sql/schema.sql" % (dbms['host'], dbms['port'], dbms['db'], dbms['username'], dbms['password']), shell=True)
+        subprocess.call("mysql -h %s -P %d -D %s -u %s -p%s < ./sql/procs_funcs.sql" % (dbms['host'], dbms['port'], dbms['db'], dbms['username'], dbms['password']), shell=True)
+    apply_migrations(db)
 
-    # Static methods for loading
-    def assign(target, source, key):
-        target[key] = source[key]
+@application.cli.command('migrate')
+@click.option('--explain/--no-explain', default=True, help='Show core query plans and timings before and after.')
+@with_db(dbms)
+def migrate_db(db, explain):
+    '''Apply pending schema migrations in place.'''
+    if not pending(db):
+        print "Schema is up to date."
+        return
+    if explain:
+        print "Core queries before migrating:"
+        explain_core_queries(db)
+    apply_migrations(db)
+    if explain:
+        print "Core queries after migrating:"
+        explain_core_queries(db)
 
-    def to_epoch(timestamp):
-        '''Convert post timestamp string to epoch time.'''
-        if not timestamp:
-            return "0"
-        else:
-            try:
-                return str(int(time.mktime(time.strptime(timestamp, '%Y-%m-%d %H:%M:%S.%f %Z'))))
-            except ValueError:
-                try:
-                    return str(int(time.mktime(time.strptime(timestamp, '%Y-%m-%d %H:%M:%S %Z'))))
-                except ValueError:
-                    return str(int(time.mktime(time.strptime(timestamp, '%Y-%m-%d %H:%M:%S'))))
-
-    with open(application.config['THREADS']) as t:
-        rows = list(DictReader(t))
-
-        # Load threads first
-        threadct = query(db, "SELECT count(*) FROM threads").next().values()[0]
-        thread_ids = dict()
-        for row in rows:
-            if row['X_type'] != "CommentThread":
-                continue
+@application.cli.command('load')
+@click.argument('paths', nargs=-1)
+@click.option('--processes', '-p', type=int, default=cpu_count(), help='Processes ordering threads (default: one per CPU).')
+@click.option('--writers', '-w', type=int, default=LOAD_WRITERS, help='Database connections writing batches.')
+@with_db(dbms)
+def load_db(db, paths, processes, writers):
+    '''Load new forum threads and posts from one or more CSV exports (or their compiled copies).'''
+    rows = chain.from_iterable(read_rows(path) for path in paths or [THREADS])
+    load_rows(db, rows, processes=processes, writer=BatchWriter(dbms, writers) if writers else None)
+
+@application.cli.command('compile-data')
+@click.argument('path', default=THREADS)
+@click.option('--output', '-o', help='Compiled file to write (default PATH%s).' % COMPILED_SUFFIX)
+def compile_data(path, output):
+    '''Parse a CSV export once into a compiled columnar file for fast repeated loads.'''
+    output = output or compiled_path(path)
+    with open(path) as t:
+        n = compile_rows(DictReader(t), output, source_stamp(path))
+    print "Compiled %d rows to %s." % (n, output)
+
+@application.cli.command('load-reddit')
+@click.argument('directory', type=click.Path(exists=True, file_okay=False))
+@click.option('--processes', '-p', type=int, default=cpu_count(), help='Parser processes (default: one per CPU).')
+@click.option('--writers', '-w', type=int, default=LOAD_WRITERS, help='Database connections writing batches.')
+@with_db(dbms)
+def load_reddit(db, directory, processes, writers):
+    '''Parse a directory of Reddit thread pages in parallel and load their comment trees.'''
+    def threads():
+        for path, rows in parse_pages(page_paths(directory), processes):
+            if rows is None:
+                print "Skipped %s: no thread found." % path
             else:
-                thread = dict()
-
-                # Extract thread data and clean up
-                thread['title'] = '"%s"' % row['title'].replace('"', '""')
-                thread['body'] = '"%s"' % row['body'].replace('"', '""')
-                thread['creator'] = '"%s"' % row['author_username']
-                thread['comment_count'] = row['comment_count']
-                thread['mongoid'] = '"%s"' % row['mongoid']
-
-                # Load to database
-                query(db, "INSERT INTO threads(%s) VALUES (%s)" % (','.join(thread.keys()), ','.join(thread.values())))
-                threadct += 1
-                thread_ids[row['mongoid']] = threadct  # Store mongoid-threadid mapping
-        print "Loading %d threads to annotator." % threadct
-
-        # Load posts for each thread
-        totct = 0
-        for mongoid in thread_ids.keys():
-            # t.seek(0)  # Reset CSV file head to top
-
-            thread_id = thread_ids[mongoid]
-            rowct = 0
-            post_ids = dict()
-
-            # Extract relevant posts in order
-            ordered = list()
-            for row in rows:
-                if row['mongoid'] == mongoid:
-                    ordered.insert(0, row)  # Top-level post
-                elif row['comment_thread_id'] == mongoid and row['level'] == "2":
-                    ordered.append(row)  # Main reply
-                    for srow in rows:
-                        if srow['parent_ids'] == row['mongoid']:
-                            ordered.append(srow)  # Subthread for this main reply
-
-            # Insert posts to table
-            for row in ordered:
-                post = dict()
-
-                # Extract post data
-                map(lambda x: assign(post, row, x), ['mongoid', 'author_id', 'author_username', 'body', 'level', 'created_at', 'updated_at'])
-
-                # Map context IDs
-                post['thread_id'] = thread_id
-                post['parent_post_id'] = post_ids.get(row['parent_ids'], -1)
-
-                # Clean up post data
-                post['body'] = post['body'].replace('"', '""').decode('utf-8').encode('utf-8')
-                for key in post.keys():
-                    if key not in ['created_at', 'updated_at', 'level', 'comment_count', 'author_id', 'finished', 'pinned', 'anonymous']:
-                        post[key] = '"%s"' % post[key]
-                    if post[key] in ['NA', '0', 'False']:
-                        post[key] = str(0)
-                    if key in ['created_at', 'updated_at']:
-                        post[key] = to_epoch(post[key])
-
-                # Load to database
-                query(db, "SET NAMES utf8mb4;")  # Handle 4-byte UTF-8 characters, e.g. emoji
-                query(db, "INSERT INTO posts(%s) VALUES (%s)" % (','.join(post.keys()), ','.join(post.values())))
-                rowct += 1
-                totct += 1
-                post_ids[row['mongoid']] = totct  # Store mongoid-postid mapping
-
-                # If this is the first post in the thread, update thread metadata
-                if row['mongoid'] == mongoid:
-                    query(db, "UPDATE threads SET first_post_id = (SELECT count(*)+1 FROM posts) WHERE mongoid = '%s'" % mongoid)
-            print "Loaded %d forum posts in thread %s to annotator." % (rowct, thread_id)
+                yield rows
+    load_threads(db, threads(), writer=BatchWriter(dbms, writers) if writers else None)
+
+@application.cli.command('reposition')
+@click.argument('thread_id', type=int, required=False)
+@with_db(dbms)
+def reposition_db(db, thread_id):
+    '''Rebuild coding-order positions for one thread, or all threads.'''
+    if thread_id is None:
+        thread_ids = [row['thread_id'] for row in query(db, "SELECT thread_id FROM threads")]
+    else:
+        thread_ids = [thread_id]
+    reposition(db, thread_ids)
+    print "Repositioned %d threads." % len(thread_ids)
 
 @application.route('/tables/<tablename>/<limit>')
 @application.route('/tables/<tablename>')
@@ -257,6 +286,27 @@ def tables(db, tablename, limit='100'):
 
 # Template context managers
 
+@with_db(dbms)
+def preload_progress(db, task_id=None, user_id=None):
+    '''Fetch assignment progress for a task or user in one query, for O(1) template lookups.'''
+    conditions = list()
+    if task_id is not None:
+        conditions.append("a.task_id = %d" % int(task_id))
+    if user_id is not None:
+        conditions.append("a.user_id = %d" % int(user_id))
+    progress_q = """SELECT a.assn_id, a.thread_id, a.user_id, a.task_id, a.done, t.comment_count AS total, t.title
+                    FROM assignments a
+                    JOIN threads t ON a.thread_id = t.thread_id
+                    WHERE %s
+                    ORDER BY a.assn_id""" % ' AND '.join(conditions)
+
+    # Keyed by (thread_id, user_id, task_id); first assignment wins, as in done()
+    g.progress = dict()
+    g.titles = dict()
+    for row in query(db, progress_q):
+        g.progress.setdefault((row['thread_id'], row['user_id'], row['task_id']), row)
+        g.titles[row['thread_id']] = row['title']
+
 @with_db(dbms)
 def assigned(db, thread_id, user_id, task_id):
     assns = query(db, "SELECT 1 FROM assignments WHERE thread_id = %d AND user_id = %d AND task_id = %d" % (int(thread_id), int(user_id), int(task_id)), fetchall=True)
@@ -266,6 +316,9 @@ def assigned(db, thread_id, user_id, task_id):
 def assignment_processor():
     '''Template utility function: is thread_id assigned to user_id?'''
     def fn(thread_id, user_id, task_id):
+        progress = g.get('progress')
+        if progress is not None:
+            return (int(thread_id), int(user_id), int(task_id)) in progress
         return assigned(thread_id, user_id, task_id)
     return dict(assigned=fn)
 
@@ -273,20 +326,41 @@ def assignment_processor():
 def done_processor():
     '''Template utility function: how many posts in thread X has user Y coded?'''
     @with_db(dbms)
-    def done(db, thread_id, user_id, task_id):
+    def query_done(db, thread_id, user_id, task_id):
         assn_id = query(db, "SELECT assn_id FROM assignments WHERE thread_id = %d AND user_id = %d AND task_id = %d" % (int(thread_id), int(user_id), int(task_id))).next().values()[0]
         count = done_posts(assn_id)
         total = total_posts(thread_id)
         return "%d/%d" % (count, total)
+
+    def done(thread_id, user_id, task_id):
+        row = g.get('progress', dict()).get((int(thread_id), int(user_id), int(task_id)))
+        if row is not None:
+            return "%d/%d" % (row['done'], row['total'])
+        return query_done(thread_id, user_id, task_id)
     return dict(done=done)
 
 @application.context_processor
 def titleof_processor():
     '''Template utility function: get thread title from threadid'''
     def titleof(thread_id):
+        title = g.get('titles', dict()).get(int(thread_id))
+        if title is not None:
+            return title
         return title_of_thread(thread_id)
     return dict(titleof=titleof)
 
+@application.context_processor
+def fragment_processor():
+    '''Template utility function: render a post with a macro from posts/fragments.html, once per variant'''
+    def fragment(macro, post, **flags):
+        key = (post['post_id'], post.get('loaded_at'), macro) + tuple(sorted(flags.items()))  # Post ids restart after a rebuild
+        html = fragment_cache.get(key)
+        if html is None:
+            html = get_template_attribute('posts/fragments.html', macro)(post, **flags)
+            fragment_cache.put(key, html)
+        return html
+    return dict(fragment=fragment)
+
 @application.context_processor
 def zip_processor():
     '''zip() for embedded for loops'''
@@ -318,8 +392,8 @@ def tasks(db):
         restr = '||'.join(restr)
 
         # Record task data
-        query(db, "INSERT INTO tasks(title, label, display, prompt, type, options, restrictions, allow_comments, allow_navigation) VALUES ('%s','%s','%s','%s','%s','%s','%s','%s','%s')" %
-              (request.form['title'], request.form['label'], request.form['display'], request.form['prompt'], request.form['type'], opts, restr, cmnts, 0))
+        query(db, "INSERT INTO tasks(title, label, display, prompt, type, options, restrictions, allow_comments, allow_navigation) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)",
+              args=[request.form['title'], request.form['label'], request.form['display'], request.form['prompt'], request.form['type'], opts, restr, cmnts, 0])
         return redirect(url_for('tasks'))
     tasks = query(db, "SELECT * FROM tasks", fetchall=True)
     return render_template("tasks.html", tasks=tasks)
@@ -338,58 +412,42 @@ def preview_task(db, task_id):
     return render_template("posts/preview.html", task=task, thread=sample_thread, prev=prev_posts, next=next_post)
 
 @with_db(dbms)
-def retrieve_members(db, task_id):
-    '''Retrieve users and threads associated with a task'''
-    # Threads annotated by this task
-    threads_q = """SELECT DISTINCT t.title, t.thread_id
-                   FROM codes c
-                   JOIN assignments a ON c.assn_id = a.assn_id
-                   JOIN threads t ON a.thread_id = t.thread_id
-                   WHERE a.task_id = %s""" % task_id
-    threads = query(db, threads_q, fetchall=True)
-
-    # Users assigned to this task
-    users_q = """SELECT DISTINCT u.id, u.username, u.first_name, u.last_name
-                 FROM codes c
-                 JOIN assignments a on c.assn_id = a.assn_id
-                 JOIN users u ON c.user_id = u.id
-                 WHERE a.task_id = %s""" % task_id
-    users = query(db, users_q, fetchall=True)
-
-    return users, threads
+def retrieve_codes(db, task_id):
+    '''Retrieve a task's coders, threads and codes in one ordered query.
 
-@with_db(dbms)
-def retrieve_codes(db, users, threads, task_id):
-    '''Retrieve and reshape code data'''
-    # Query to fetch codes from database
-    codes_q = """SELECT post_id, code_value, targets
+    Codes are reshaped to codes[thread_id][user_id][post_id] = (code_value, targets),
+    so coders are aligned by post_id rather than by position.'''
+    codes_q = """SELECT a.thread_id, t.title, c.user_id, u.username, u.first_name, u.last_name, c.post_id, c.code_value, c.targets
                  FROM codes c
                  JOIN assignments a ON c.assn_id = a.assn_id
                  JOIN threads t ON a.thread_id = t.thread_id
-                 WHERE a.user_id = %s
-                 AND a.task_id = %s
-                 AND t.thread_id = %s"""
-
-    # Get ordered list of codes per user-thread
-    code_data = dict()
-    target_data = dict()
-    posts_data = dict()
-    for thread in threads:
-        post_ids = None
-        for user in users:
-            codes = query(db, codes_q % (user['id'], task_id, thread['thread_id']))
-            user_codes = list()
-            targets = list()
-            post_ids = list()
-            for code in codes:
-                post_ids.append(code['post_id'])
-                user_codes.append(code['code_value'])
-                targets.append(code['targets'])
-            code_data[(user['id'], thread['thread_id'])] = user_codes
-            target_data[(user['id'], thread['thread_id'])] = targets
-            posts_data[thread['thread_id']] = post_ids
-
-    return code_data, target_data, posts_data
+                 JOIN users u ON c.user_id = u.id
+                 WHERE a.task_id = %s
+                 ORDER BY a.thread_id, c.user_id, c.post_id""" % int(task_id)
+
+    users = dict()
+    threads = list()
+    codes = dict()
+    for row in stream(db, codes_q):
+        if row['thread_id'] not in codes:
+            threads.append({'thread_id': row['thread_id'], 'title': row['title']})
+            codes[row['thread_id']] = dict()
+        if row['user_id'] not in users:
+            users[row['user_id']] = {'id': row['user_id'], 'username': row['username'], 'first_name': row['first_name'], 'last_name': row['last_name']}
+        codes[row['thread_id']].setdefault(row['user_id'], dict())[row['post_id']] = (row['code_value'], row['targets'])
+
+    return sorted(users.values(), key=lambda u: u['id']), threads, codes
+
+def task_agreement(task_id):
+    '''Compute per-thread and pooled agreement statistics for a task.'''
+    users, threads, codes = retrieve_codes(task_id)
+    records = list()
+    for thread_id, user_codes in codes.items():
+        for user_id, posts in user_codes.items():
+            for post_id, (code, targets) in posts.items():
+                records.append((thread_id, user_id, post_id, code, targets))
+    thread_stats, pooled = agreement.task_agreement(records)
+    return users, threads, thread_stats, pooled
 
 @application.route('/tasks/<task_id>/diagnostics')
 @superuser_required
@@ -400,129 +458,104 @@ def diagnostics(db, task_id):
     # Get task parameters
     task = query(db, "SELECT * FROM tasks WHERE task_id = %s" % task_id, fetchall=True)[0]
 
-    # Get users and threads for this task
-    users, threads = retrieve_members(task_id)
-
     # Compute completion statistics for this task
-    completion_q = """SELECT u.username, t.thread_id, count(*) as done, t.comment_count AS total, count(*) / t.comment_count AS proportion
+    completion_q = """SELECT u.id, u.username, u.first_name, u.last_name, t.thread_id, t.title, count(*) as done, t.comment_count AS total, ROUND(count(*) * 1.0 / t.comment_count, 4) AS proportion
                       FROM codes c
                         JOIN users u ON c.user_id = u.id
                         JOIN assignments a ON c.assn_id = a.assn_id
                         JOIN threads t ON a.thread_id = t.thread_id
                       WHERE a.task_id = %s
-                      GROUP BY a.assn_id, t.thread_id""" % task_id
+                      GROUP BY a.assn_id, t.thread_id
+                      ORDER BY t.thread_id, u.id""" % task_id
     completion = query(db, completion_q, fetchall=True)
+    users = dict()
+    threads = list()
     cmpl_data = dict()
+    pairwise = dict()
     for row in completion:
-        cmpl_data[(row.pop('username'), row.pop('thread_id'))] = row
-
-    # Compute pairwise agreement for this task
-    code_data, target_data, _ = retrieve_codes(users, threads, task_id)
-    agreement = dict()
-    for thread in threads:
-        for ui in users:
-            for uj in users:
-                ui_codes = code_data[(ui['id'], thread['thread_id'])]
-                ui_targs = target_data[(ui['id'], thread['thread_id'])]
-                uj_codes = code_data[(uj['id'], thread['thread_id'])]
-                uj_targs = target_data[(uj['id'], thread['thread_id'])]
-                length = min(len(ui_codes), len(uj_codes))
-
-                # Truncate lists to minimum length
-                ui_codes = ui_codes[:length]
-                ui_targs = ui_targs[:length]
-                uj_codes = uj_codes[:length]
-                uj_targs = uj_targs[:length]
-
-                # Compute concordance per item
-                conc = 0
-                for i, x in enumerate(ui_codes):
-                    if x == uj_codes[i] == "commenters":
-                        # Targets must agree where applicable, otherwise disagree
-                        conc += (ui_targs[i] == uj_targs[i])
-                    else:
-                        conc += (x == uj_codes[i])
-
-                # Round off proportion
-                prop = round(float(conc) / length, 4)
-                agreement[(ui['id'], uj['id'], thread['thread_id'])] = prop
-
-    return render_template("diagnostics.html", task=task, threads=threads, users=users, completion=cmpl_data, agreement=agreement)
-
-@with_db(dbms)
-def identify_disagreements(db, threads, users, code_data, target_data, posts_data):
-    # Identify disagreements
-    disagreements = list()
-
-    for thread in threads:
-        thread_id = thread['thread_id']
-        for i, j in combinations(range(0, len(users)), r=2):
-            # Next unique pair of users
-            ui = users[i]
-            uj = users[j]
-            ui_id = ui['id']
-            uj_id = uj['id']
-
-            # Get data for users
-            ui_codes = code_data[(ui_id, thread_id)]
-            ui_targs = target_data[(ui_id, thread_id)]
-            uj_codes = code_data[(uj_id, thread_id)]
-            uj_targs = target_data[(uj_id, thread_id)]
-            length = min(len(ui_codes), len(uj_codes))
-
-            # Truncate lists to minimum length
-            ui_codes = ui_codes[:length]
-            ui_targs = ui_targs[:length]
-            uj_codes = uj_codes[:length]
-            uj_targs = uj_targs[:length]
-
-            # Get post_ids with disagreements
-            for i, x in enumerate(ui_codes):
-
-                if x == uj_codes[i]:
-                    if x == "commenters":
-                        if ui_targs[i] != uj_targs[i]:
-                            disagreements.append({'u1_id': ui_id, 'u2_id': uj_id, 'post_id': posts_data[thread_id][i], 'thread_id': thread_id})
-                else:
-                    disagreements.append({'u1_id': ui_id, 'u2_id': uj_id, 'post_id': posts_data[thread_id][i], 'thread_id': thread_id})
-
-    # Remove ties already broken
-    notie = []
-    for i, disag in enumerate(disagreements):
-        try:
-            broken = query(db, "SELECT 1 FROM tiebreakers WHERE post_id = %d AND (user_id = %d OR user_id = %d)" % (disag['post_id'], disag['u1_id'], disag['u2_id'])).next()
-        except StopIteration:
-            continue
-        print disag['post_id'], broken
-        if broken:
-            print i
-            notie.append(i)
-    disagreements = [i for j, i in enumerate(disagreements) if j not in notie]
-
-    return disagreements
+        if row['id'] not in users:
+            users[row['id']] = {'id': row['id'], 'username': row['username'], 'first_name': row['first_name'], 'last_name': row['last_name']}
+        if not threads or threads[-1]['thread_id'] != row['thread_id']:
+            threads.append({'thread_id': row['thread_id'], 'title': row['title']})
+        pairwise[(row['id'], row['id'], row['thread_id'])] = 1.0
+        cmpl_data[(row['username'], row['thread_id'])] = dict((k, row[k]) for k in ['done', 'total', 'proportion'])
+    users = sorted(users.values(), key=lambda u: u['id'])
+
+    # Pairwise agreement is maintained as codes come in
+    pairwise.update(agreement.cached_agreement(db, task_id))
+
+    # Chance-corrected statistics need the full label matrices, so compute them on request
+    kappa = dict()
+    thread_stats = dict()
+    pooled = None
+    if request.args.get('reliability'):
+        _, _, thread_stats, pooled = task_agreement(task_id)
+        for thread_id, stats in thread_stats.items():
+            for ui, uj, prop, k in stats.pairs():
+                kappa[(ui, uj, thread_id)] = k
+
+    return render_template("diagnostics.html", task=task, threads=threads, users=users, completion=cmpl_data,
+                           agreement=pairwise, kappa=kappa, thread_stats=thread_stats, pooled=pooled, value=agreement.value)
+
+@application.cli.command('agreement')
+@click.argument('task_id', type=int)
+def agreement_report(task_id):
+    '''Print inter-rater agreement statistics for a task.'''
+    users, threads, thread_stats, pooled = task_agreement(task_id)
+    names = dict((u['id'], u['username']) for u in users)
+    for label, stats in [("All threads", pooled)] + [("Thread %s" % t['thread_id'], thread_stats[t['thread_id']]) for t in threads]:
+        print "%s (%d posts): Fleiss' kappa = %s, Krippendorff's alpha = %s" % (label, stats.items, agreement.value(stats.fleiss), agreement.value(stats.alpha))
+        for ui, uj, prop, k in stats.pairs():
+            if ui < uj:
+                print "    %s vs %s: agreement = %s, Cohen's kappa = %s" % (names[ui], names[uj], prop, k)
+
+@application.cli.command('rebuild-agreement')
+@click.argument('task_id', type=int, required=False)
+@with_db(dbms)
+def rebuild_agreement(db, task_id):
+    '''Recompute cached agreement and disagreements for one task, or all tasks.'''
+    if task_id is None:
+        task_ids = [row['task_id'] for row in query(db, "SELECT task_id FROM tasks")]
+    else:
+        task_ids = [task_id]
+    for t in task_ids:
+        agreement.rebuild(db, t)
+        print "Rebuilt agreement cache for task %d." % t
 
 @application.route('/tasks/<task_id>/diagnostics/tiebreaker', methods=['GET', 'POST'])
 @superuser_required
 @with_db(dbms)
 def tiebreaker(db, task_id):
     '''Manually resolve disagreements. Tiebreaking codes are marked as such in the 'comment' column.'''
+    # Queue filters and position, kept across adjudication
+    args = dict((k, request.values[k]) for k in ['thread', 'pair', 'after'] if request.values.get(k))
+    thread_id = int(args['thread']) if args.get('thread', '').isdigit() else None
+    pair = args.get('pair', '').split('-')
+    pair = tuple(int(u) for u in pair) if len(pair) == 2 and all(u.isdigit() for u in pair) else None
+    after = agreement.parse_disagreement_key(args.get('after'))
+
     # Direct data to adjudication interface upon selection
     if request.method == "POST":
-        disag = eval(request.form['disag'])  # Not a good idea, generally
-        session['disag'] = disag
+        key = agreement.parse_disagreement_key(request.form['disag'])
+        if key is None:
+            return redirect(url_for('tiebreaker', task_id=task_id, **args))
+        session['disag'] = dict(zip(['thread_id', 'post_id', 'u1_id', 'u2_id'], key))
+        session['ties_args'] = args
         return redirect(url_for('adjudicate', task_id=task_id))
 
     # Get task parameters
     task = query(db, "SELECT * FROM tasks WHERE task_id = %s" % task_id, fetchall=True)[0]
 
-    # Get users, threads, codes and targets for this task
-    users, threads = retrieve_members(task_id)
-    code_data, target_data, posts_data = retrieve_codes(users, threads, task_id)
-
-    # Identify disagreements
-    disagreements = identify_disagreements(threads, users, code_data, target_data, posts_data)
+    # Next page of unresolved disagreements, maintained as codes and tiebreakers come in
+    disagreements = agreement.cached_disagreements(db, task_id, after=after, thread_id=thread_id, pair=pair, limit=TIES_PER_PAGE + 1)
+    next_after = None
+    if len(disagreements) > TIES_PER_PAGE:
+        disagreements = disagreements[:TIES_PER_PAGE]
+        next_after = agreement.disagreement_key(disagreements[-1])
+    thread_counts, pair_counts = agreement.disagreement_counts(db, task_id)
 
-    return render_template('ties.html', task=task, disagreements=disagreements)
+    return render_template('ties.html', task=task, disagreements=disagreements, key=agreement.disagreement_key, args=args,
+                           thread_counts=thread_counts, pair_counts=pair_counts, next_after=next_after)
 
 @application.route('/tasks/<task_id>/diagnostics/tiebreaker/adjudicate', methods=['GET', 'POST'])
 @superuser_required
@@ -550,8 +583,9 @@ def adjudicate(db, task_id):
         wrong_code_id = codes[codes.keys()[0]]['code_id']
         query(db, "DELETE FROM tiebreakers WHERE code_id = %s" % wrong_code_id)
         query(db, "INSERT INTO tiebreakers SELECT * FROM codes WHERE code_id = %s" % right_code_id)
-        query(db, "UPDATE tiebreakers SET comment = '%s' WHERE code_id = %s" % ("Tie broken by " + str(g.user['id']), right_code_id))
-        return redirect(url_for('tiebreaker', task_id=task_id))
+        query(db, "UPDATE tiebreakers SET comment = %s WHERE code_id = %s", args=["Tie broken by " + str(g.user['id']), right_code_id])
+        agreement.refresh_post(db, task_id, post_id)
+        return redirect(url_for('tiebreaker', task_id=task_id, **session.get('ties_args', dict())))
 
     # Get user data
     u_q = "SELECT username, first_name, last_name FROM users WHERE id = %s"
@@ -568,21 +602,90 @@ def adjudicate(db, task_id):
 @superuser_required
 @with_db(dbms)
 def assign_task(db, task_id):
-    '''Logic for task assigner'''
+    '''Logic for task assigner: balanced assignment to a coder pool, or single threads from the grid'''
     task = query(db, "SELECT task_id, title FROM tasks WHERE task_id = %s" % task_id, fetchall=True)[0]
-    threads = query(db, "SELECT thread_id, title, first_post_id FROM threads", fetchall=True)
+    threads = codable_threads(db)
     users = query(db, "SELECT id, first_name, last_name FROM users ORDER BY id", fetchall=True)
     if request.method == 'POST':
-        for key in request.form.keys():
-            ids = eval(key)
-            value = request.form[key]
-            thread_id = ids['thread']
-            user_id = ids['user']
-            next_id = ids['next']
-            if value == 'on' and not assigned(thread_id, user_id, task_id):
-                query(db, "INSERT INTO assignments(thread_id, user_id, task_id, next_post_id, finished) VALUES ('%s','%s','%s','%s','%s')" % (thread_id, user_id, task_id, next_id, 0))
+        if 'balance' in request.form:
+            coders = [int(key.split('_')[1]) for key in request.form.keys() if key.startswith('coder_')]
+            try:
+                pairs, load = assign_balanced(db, task_id, coders, int(request.form.get('k', 1)), threads=threads)
+            except ValueError as e:
+                flash(str(e))
+            else:
+                flash("Made %d new assignments. Coder workloads (comments): %s" % (len(pairs), ', '.join("U%d: %d" % (u, n) for u, n in sorted(load.items()))))
+        else:
+            pairs = list()
+            for key in request.form.keys():
+                if key.startswith('assign_') and request.form[key] == 'on':
+                    _, thread_id, user_id = key.split('_')
+                    pairs.append((int(thread_id), int(user_id)))
+            if pairs:
+                write_assignments(db, task_id, pairs, threads)
+    preload_progress(task_id=task_id)
     return render_template('assignments.html', users=users, threads=threads, task=task)
 
+@application.cli.command('assign')
+@click.argument('task_id', type=int)
+@click.argument('user_ids', type=int, nargs=-1, required=True)
+@click.option('-k', 'k', type=int, default=2, help='Coders per thread.')
+@click.option('--thread', 'thread_ids', type=int, multiple=True, help='Only assign this thread (repeatable).')
+@click.option('--dry-run', is_flag=True, help='Print the plan without writing it.')
+@with_db(dbms)
+def assign_db(db, task_id, user_ids, k, thread_ids, dry_run):
+    '''Assign every codable thread to K of the given coders, balancing workloads.'''
+    threads = codable_threads(db, thread_ids) if thread_ids else None
+    try:
+        pairs, load = assign_balanced(db, task_id, list(user_ids), k, threads=threads, dry_run=dry_run)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    print "%s %d new assignments." % ("Would make" if dry_run else "Made", len(pairs))
+    for user_id, comments in sorted(load.items()):
+        print "    user %d: %d comments" % (user_id, comments)
+
+
+# Export
+
+EXPORT_MIMETYPES = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+
+@application.cli.command('export')
+@click.argument('table', type=click.Choice(EXPORT_TABLES), default='codes')
+@click.option('--format', 'fmt', type=click.Choice(EXPORT_FORMATS), default='csv', help='Output format.')
+@click.option('--task', 'task_id', type=int, help='Only codes for this task.')
+@click.option('--thread', 'thread_id', type=int, help='Only codes in this thread.')
+@click.option('--since', help='Only codes recorded on or after this date (YYYY-MM-DD).')
+@click.option('--until', help='Only codes recorded on or before this date (YYYY-MM-DD).')
+@click.option('--bodies/--no-bodies', default=False, help='Include the text of each coded post.')
+@click.option('--output', '-o', type=click.File('wb'), default='-', help='File to write (default stdout).')
+@with_db(dbms)
+def export_db(db, table, fmt, task_id, thread_id, since, until, bodies, output):
+    '''Stream codes or tiebreakers, with post, thread and task metadata, as CSV or JSON Lines.'''
+    try:
+        rows = export_rows(db, table, task_id=task_id, thread_id=thread_id, since=since, until=until, bodies=bodies)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    for chunk in export_lines(rows, fmt, bodies):
+        output.write(chunk)
+
+@application.route('/export/<table>')
+@superuser_required
+@with_db(dbms)
+def export(db, table):
+    '''Download route for codes or tiebreakers, filtered by task, thread, since and until.'''
+    fmt = request.args.get('format', 'csv')
+    bodies = bool(request.args.get('bodies'))
+    if table not in EXPORT_TABLES or fmt not in EXPORT_FORMATS:
+        abort(404)
+    try:
+        rows = export_rows(db, table, task_id=request.args.get('task') or None, thread_id=request.args.get('thread') or None,
+                           since=request.args.get('since'), until=request.args.get('until'), bodies=bodies)
+    except ValueError:
+        abort(400)
+    filename = "%s.%s" % (table, fmt)
+    return Response(stream_with_context(export_lines(rows, fmt, bodies)), mimetype=EXPORT_MIMETYPES[fmt],
+                    headers={'Content-Disposition': 'attachment; filename=%s' % filename})
+
 
 # Annotator user views
 
@@ -592,123 +695,268 @@ def assign_task(db, task_id):
 def annotate(db):
     '''Dispatch users to annotation interface'''
     userid = g.user['id']
-    assignments = query(db, "SELECT a.assn_id, a.thread_id, t.label FROM assignments a JOIN tasks t ON a.task_id = t.task_id WHERE user_id = %d" % userid, fetchall=True)
+    assignments = query(db, """SELECT a.assn_id, a.thread_id, t.label, th.title FROM assignments a
+                               JOIN tasks t ON a.task_id = t.task_id JOIN threads th ON a.thread_id = th.thread_id
+                               WHERE user_id = %d""" % userid, fetchall=True)
     if request.method == 'POST':
         assn_id = request.form['assn']
         return redirect(url_for('annotate_thread', assn_id=assn_id))
     return render_template('annotate.html', assigned=assignments)
 
 @with_db(dbms)
-def retrieve_thread(db, thread_id, next_post_id):
+def thread_context(db, thread_id):
+    '''Cached context tree for a thread, re-read only when the thread has been reloaded.'''
+    loaded_at = query(db, "SELECT loaded_at FROM threads WHERE thread_id = %d" % int(thread_id)).next()['loaded_at']
+    tree = thread_cache.get(int(thread_id))
+    if tree is None or tree.loaded_at != loaded_at:
+        posts = query(db, """SELECT p.*, pp.position, pp.depth
+                           FROM post_positions pp JOIN posts p ON pp.post_id = p.post_id
+                           WHERE pp.thread_id = %d""" % int(thread_id), fetchall=True)
+        tree = ThreadContext(posts, loaded_at)
+        thread_cache.put(int(thread_id), tree, tree.size)
+    return tree
+
+def retrieve_thread(thread_id, next_post_id):
     '''Fetch all posts in context up to next post.'''
-    parent_post_id = query(db, "SELECT parent_post_id FROM posts WHERE post_id = %s" % next_post_id, fetchall=True)[0]['parent_post_id']
-    q = ("SELECT * FROM posts WHERE thread_id = {0} AND level = 1 "  # Top-level post
-         "UNION ALL "
-         "SELECT * FROM posts WHERE post_id = {1} "  # Main reply
-         "UNION ALL "
-         "SELECT * FROM posts WHERE thread_id = {0} AND parent_post_id = {1} AND post_id < {2} AND level > 2 "  # Previous commenters
-         "UNION ALL "
-         "SELECT * FROM posts WHERE post_id = {2}"  # Next post to code
-         ).format(thread_id, parent_post_id, next_post_id)
-    thread = query(db, q, fetchall=True)
-
     # Return top-level post, previous replies in context, next post to code
-    return thread[0], thread[1:-1], thread[-1]
+    return thread_context(thread_id).context(next_post_id)
 
 @with_db(dbms)
-def goto_post(db, assn_id, coded_post_id, rel_idx):
-    '''Move persistent pointer to next pointer by value of rel_idx'''
-    bounds = query(db, "SELECT a.done, t.comment_count FROM assignments a JOIN threads t ON a.thread_id = t.thread_id WHERE assn_id = %s" % assn_id, fetchall=True)[0]
-    if bounds['done'] == bounds['comment_count']:
-        query(db, "CALL set_finished(%s)" % assn_id)
+def goto_post(db, assn_id, rel_idx, absolute=False):
+    '''Move persistent pointer rel_idx posts along the thread's coding order (or to position rel_idx, if absolute)
+
+    The move is one UPDATE computed from the stored position, so concurrent moves on an
+    assignment all take effect; the assignment is only read afterwards, to explain a move
+    that wasn't made. next_post_id is set first: MySQL evaluates SET clauses in order.'''
+    target = "%d" % int(rel_idx) if absolute else "assignments.done + %d" % int(rel_idx)
+    past_end = "" if absolute or rel_idx <= 0 else "AND assignments.done < (SELECT comment_count FROM threads WHERE thread_id = assignments.thread_id)"
+    query(db, """UPDATE assignments
+                 SET next_post_id = (SELECT pp.post_id FROM post_positions pp WHERE pp.thread_id = assignments.thread_id AND pp.position = {0}),
+                     done = {0}
+                 WHERE assn_id = {1} AND {0} >= 1 {2}
+                   AND EXISTS (SELECT 1 FROM post_positions pp WHERE pp.thread_id = assignments.thread_id AND pp.position = {0})""".format(target, int(assn_id), past_end))
+    if db.rowcount > 0:
+        return None
+
+    bounds = query(db, "SELECT a.done, t.comment_count FROM assignments a JOIN threads t ON a.thread_id = t.thread_id WHERE assn_id = %d" % int(assn_id), fetchall=True)[0]
+    position = rel_idx if absolute else bounds['done'] + rel_idx
+    if position == bounds['done']:
+        return None  # Already there
+    if not absolute and rel_idx > 0 and bounds['done'] >= bounds['comment_count']:
+        query(db, "CALL set_finished(%s)", args=[int(assn_id)])
         return "Last post. This thread is finished!"
-    elif bounds['done'] + rel_idx < 0:
+    elif position < 1:
         return "First post."
-    else:
-        new_next_post_id = coded_post_id + rel_idx  # Assume posts table is in coding order
-        query(db, "UPDATE assignments SET done = done + %d, next_post_id = %s WHERE assn_id = %s" % (rel_idx, new_next_post_id, assn_id))
-        return None
+    return "There is no post %d in this thread." % position
 
-def handle_replymap(form, method, codes):
+def handle_replymap(target_ids, method, codes):
     '''Special processing for reply mapping view'''
     if method == "replymap" and "commenters" in codes:
-        comment_ids = [request.form[k] for k in request.form.keys() if 'target' in k]
-        return '||'.join(comment_ids)
+        return '||'.join(target_ids)
     else:
         return ""
 
+def prepare_code(task, code_values, target_ids, comment):
+    '''Validate a submitted code. Returns (code, targets, comment text) and an error message.'''
+    if "no_code" in code_values or not code_values:
+        return None, "Submit a code for this post."  # Reject if no code submitted
+    code = "||".join(code_values)
+
+    # Parse user comments
+    comment_text = ""
+    if task['allow_comments']:
+        comment_text = (comment or "").replace("`", "").replace("'", "`")  # This replace 'safely' handles contractions
+
+    # Parse targets for replymap task
+    targets = handle_replymap(target_ids, task['display'], code_values)
+    if not targets and "commenters" in code_values:
+        return None, "Which commenters was this post responding to?"  # Reject if no targets identified
+    return (code, targets, comment_text), None
+
+@with_db(dbms)
+def load_assignment(db, assn_id, user_id=None):
+    '''An assignment joined with its task parameters and thread length, or None.
+
+    With user_id, only that user's assignment is returned.'''
+    assn_q = """SELECT a.assn_id, a.user_id, a.thread_id, a.next_post_id, a.done, a.finished, t.comment_count, t.title AS thread_title, k.*
+                FROM assignments a
+                  JOIN threads t ON a.thread_id = t.thread_id
+                  JOIN tasks k ON a.task_id = k.task_id
+                WHERE a.assn_id = %d""" % int(assn_id)
+    if user_id is not None:
+        assn_q += " AND a.user_id = %d" % int(user_id)
+    assns = query(db, assn_q, fetchall=True)
+    return assns[0] if assns else None
+
+@with_db(dbms)
+def submit_codes(db, assignment, user_id, tree, submitted):
+    '''Upsert codes on an assignment's posts and move its pointer past the last one, in one transaction.
+
+    submitted holds (post, (code, targets, comment text)) pairs; a post of None stands for
+    the assignment's next post, read inside the transaction with the assignment row locked,
+    so concurrent submissions code successive posts instead of overwriting one pointer.
+    Returns the assignment's new done and next_post_id, and whether it is finished.
+
+    The agreement cache is refreshed after COMMIT, so the transaction locks only this
+    assignment's row and codes: refreshing reads the other coders' codes on the thread,
+    and doing that under the transaction's locks would let two coders submitting on one
+    thread deadlock. The refresh is idempotent, and is retried if InnoDB aborts it for a
+    deadlock or lock wait timeout (retry_on_lock).
+
+    Runs SUBMIT_QUERIES statements: START, the locking read, the code upsert, the pointer
+    update and COMMIT, then three agreement cache updates.'''
+    with transaction(db):
+        locked = query(db, "SELECT next_post_id FROM assignments WHERE assn_id = %d FOR UPDATE" % int(assignment['assn_id']), fetchall=True)[0]
+        submitted = [(post if post is not None else tree.posts[locked['next_post_id']], code) for post, code in submitted]
+        last = max([post for post, _ in submitted], key=lambda p: p['position'])
+        following = tree.at(last['position'] + 1)
+        done, next_post_id = (following['position'], following['post_id']) if following else (last['position'], last['post_id'])
+
+        values = list()
+        for post, (code, targets, comment_text) in submitted:
+            values.extend([user_id, post['post_id'], assignment['assn_id'], code, targets, comment_text])
+        query(db, """INSERT INTO codes(user_id, post_id, assn_id, code_value, targets, comment) VALUES %s
+                     ON DUPLICATE KEY UPDATE user_id = VALUES(user_id), code_value = VALUES(code_value), targets = VALUES(targets), comment = VALUES(comment)"""
+                  % ','.join(["(%s, %s, %s, %s, %s, %s)"] * len(submitted)), args=values)
+        query(db, "UPDATE assignments SET done = %d, next_post_id = %d, finished = finished OR %d WHERE assn_id = %d" % (done, next_post_id, following is None, assignment['assn_id']))
+    retry_on_lock(agreement.refresh_codes, db, assignment['task_id'], assignment['assn_id'], [post['post_id'] for post, _ in submitted])
+    return done, next_post_id, following is None
+
 @application.route('/annotate/<assn_id>', methods=['GET', 'POST'])
 @login_required
 @with_db(dbms)
 def annotate_thread(db, assn_id):
     user_id = g.user['id']
 
-    # Retrieve task parameters
-    task = query(db, "SELECT * FROM tasks WHERE task_id = (SELECT task_id FROM assignments WHERE assn_id = %s)" % assn_id, fetchall=True)[0]
+    # Retrieve assignment and task parameters
+    task = load_assignment(assn_id)
+    if task is None:
+        abort(404)
+    tree = thread_context(task['thread_id'])
 
     # Handle code submissions, code updates, navigation
     msg = None
+    moved = False
     while request.method == 'POST':
-        # Just coded post_id
-        coded_post_id = query(db, "SELECT next_post_id FROM assignments WHERE assn_id = %s" % assn_id, fetchall=True)[0]['next_post_id']
-
         # Handle navigation events, mostly for debugging
         if 'next' in request.form.keys():
-            msg = goto_post(assn_id, coded_post_id, 1)
+            msg = goto_post(assn_id, 1)
+            moved = True
             break
 
         if 'prev' in request.form.keys():
-            msg = goto_post(assn_id, coded_post_id, -1)
+            msg = goto_post(assn_id, -1)
+            moved = True
+            break
+
+        if 'goto' in request.form.keys():
+            try:
+                msg = goto_post(assn_id, int(request.form['position']), absolute=True)
+                moved = True
+            except ValueError:
+                msg = "Enter a post number."
             break
 
         # Parse submitted code values
         code_values = [request.form[c] for c in request.form.keys() if 'choice' in c]
-        if "no_code" in code_values or not code_values:
-            msg = "Submit a code for this post."
-            break  # Reject if no code submitted
-        code = "||".join(code_values)
-
-        # Parse user comments
-        comment_text = ""
-        if task['allow_comments']:
-            comment_text = request.form['comment'].replace("`", "").replace("'", "`")  # This replace 'safely' handles contractions
-
-        # Parse targets for replymap task
-        targets = handle_replymap(request.form, task['display'], code_values)
-        if not targets and "commenters" in code_values:
-            msg = "Which commenters was this post responding to?"
-            break  # Reject if no targets identified
-
-        # If code already exists for this post, drop it for new code
-        try:
-            existing = query(db, "SELECT code_id FROM codes WHERE post_id = %s AND user_id = %d AND assn_id = %s" % (coded_post_id, user_id, assn_id)).next()['code_id']
-            if existing:
-                query(db, "DELETE FROM codes WHERE code_id = %s" % existing)
-        except StopIteration:
-            pass  # Move on if no existing code
+        target_ids = [request.form[k] for k in request.form.keys() if 'target' in k]
+        submitted, msg = prepare_code(task, code_values, target_ids, request.form.get('comment'))
+        if msg:
+            break
 
-        # Append code to table
-        query(db, "INSERT INTO codes(user_id, post_id, assn_id, code_value, targets, comment) VALUES ('%s', '%s', '%s', '%s', '%s', '%s')" % (user_id, coded_post_id, assn_id, code, targets, comment_text))
-        msg = goto_post(assn_id, coded_post_id, 1)  # Advance next post pointer
+        # Record code for the post just coded and advance next post pointer
+        task['done'], task['next_post_id'], finished = submit_codes(task, user_id, tree, [(None, submitted)])
+        if finished:
+            msg = "Last post. This thread is finished!"
         break
 
     # Display alerts to user if something bad happened
     if msg:
         flash(msg)
 
-    # Fetch most up-to-date assignment data
-    assignment = query(db, "SELECT * FROM assignments WHERE assn_id = %s" % assn_id, fetchall=True)[0]
-    next_post_id = assignment['next_post_id']
-    thread_id = assignment['thread_id']
+    # Fetch most up-to-date assignment data after navigating
+    if moved:
+        task = load_assignment(assn_id)
 
     # Pull thread data to display and code
-    comments = query(db, "SELECT code_value, comment FROM codes WHERE post_id = %s AND user_id = %d AND assn_id = %s" % (next_post_id, user_id, assn_id), fetchall=True)
-    top_level_post, prev_posts, next_post = retrieve_thread(thread_id, next_post_id)
+    top_level_post, prev_posts, next_post = tree.context(task['next_post_id'])
+    g.titles = {task['thread_id']: task['thread_title']}
 
-    return render_template('code.html', adj=False, task=task, assn_id=assn_id, thread_id=thread_id, tlp=top_level_post, prev=prev_posts, next=next_post, comments=comments)
+    return render_template('code.html', adj=False, task=task, assn_id=assn_id, thread_id=task['thread_id'], tlp=top_level_post, prev=prev_posts, next=next_post,
+                           position=task['done'], total=task['comment_count'], prefetch=PREFETCH_POSTS)
 
 
 
+# Annotation API
+
+def post_json(post):
+    '''Fields needed to render a post client-side.'''
+    return {'post_id': post['post_id'], 'position': post['position'], 'depth': post['depth'], 'level': post['level'],
+            'parent_post_id': post['parent_post_id'], 'author_username': post['author_username'],
+            'body': post['body']}
+
+@application.route('/api/annotate/<int:assn_id>/posts')
+@login_required
+def api_posts(assn_id):
+    '''The posts following position `after` (by default, from the next post to code), each with its context.'''
+    assignment = load_assignment(assn_id, g.user['id'])
+    if assignment is None:
+        return jsonify(error="No such assignment."), 404
+    after = request.args.get('after', assignment['done'] - 1, type=int)
+    count = min(request.args.get('count', PREFETCH_POSTS, type=int), PREFETCH_POSTS)
+
+    tree = thread_context(assignment['thread_id'])
+    posts = dict()
+    items = list()
+    for position in range(max(after + 1, 1), min(after + count, assignment['comment_count']) + 1):
+        post = tree.at(position)
+        if post is None:
+            break
+        _, prev_posts, next_post = tree.context(post['post_id'])
+        for p in prev_posts + [next_post]:
+            posts[p['post_id']] = post_json(p)
+        items.append({'post_id': post['post_id'], 'position': position, 'context': [p['post_id'] for p in prev_posts]})
+
+    return jsonify(thread_id=assignment['thread_id'], position=assignment['done'], total=assignment['comment_count'],
+                   finished=bool(assignment['finished']), top=post_json(tree.top) if tree.top else None, posts=posts, items=items)
+
+@application.route('/api/annotate/<int:assn_id>/codes', methods=['POST'])
+@login_required
+def api_codes(assn_id):
+    '''Record a batch of codes in one transaction and move the pointer past the last post coded.
+
+    Expects {"codes": [{"post_id", "values", "targets", "comment"}, ...]}; if any code is
+    invalid, none are recorded.'''
+    task = load_assignment(assn_id, g.user['id'])
+    if task is None:
+        return jsonify(error="No such assignment."), 404
+    tree = thread_context(task['thread_id'])
+
+    # Validate the whole batch before writing any of it
+    submitted = list()
+    for item in (request.get_json(silent=True) or dict()).get('codes', []):
+        try:
+            post = tree.posts.get(int(item['post_id']))
+            code_values = [unicode(v) for v in item['values']] if isinstance(item['values'], list) else None
+            target_ids = [str(int(t)) for t in item.get('targets', [])]
+        except (KeyError, TypeError, ValueError):
+            return jsonify(error="Malformed code."), 400
+        if code_values is None:
+            return jsonify(error="Malformed code."), 400
+        if post is None or post['position'] < 1:
+            return jsonify(error="Post %s is not coded in this assignment." % item['post_id']), 400
+        code, msg = prepare_code(task, code_values, target_ids, item.get('comment'))
+        if msg:
+            return jsonify(error=msg, post_id=post['post_id']), 400
+        submitted.append((post, code))
+    if not submitted:
+        return jsonify(error="No codes submitted."), 400
+
+    done, next_post_id, finished = submit_codes(task, g.user['id'], tree, submitted)
+    return jsonify(coded=len(submitted), next_post_id=next_post_id, position=done, finished=finished,
+                   message="Last post. This thread is finished!" if finished else None)
+
+
 # Main page
 
 @application.route('/')
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# assign.py
+# Balanced thread assignment for forum data annotator application.
+#
+# Author: Alex Kindel
+# Date: 19 July 2016
+
+import heapq
+from collections import defaultdict
+
+from dbutils import query, insert_many, transaction
+
+
+ASSIGNMENT_COLS = ['thread_id', 'user_id', 'task_id', 'next_post_id', 'done', 'finished']
+
+
+# Planning
+
+def thread_weight(thread):
+    '''Workload of a thread; even a thread without replies takes some effort to read.'''
+    return max(thread['comment_count'], 1)
+
+def plan_assignments(threads, coders, k, existing=()):
+    '''Choose coders so each thread has k of them, keeping coder workloads even.
+
+    threads are dicts with thread_id and comment_count; coders are user_ids. existing
+    holds (thread_id, user_id) pairs already assigned, which count towards a thread's k
+    and, for coders in the pool, towards their workload. Threads are placed heaviest
+    first, each on the least-loaded coders not already on it (ties go to the lower
+    user_id), so workloads end up close to even.
+
+    Returns the new (thread_id, user_id) pairs and each coder's resulting workload.'''
+    if not 1 <= k <= len(coders):
+        raise ValueError("Cannot give each thread %d coders from a pool of %d." % (k, len(coders)))
+    weights = dict((t['thread_id'], thread_weight(t)) for t in threads)
+    on_thread = defaultdict(set)
+    load = dict((user_id, 0) for user_id in coders)
+    for thread_id, user_id in existing:
+        on_thread[thread_id].add(user_id)
+        if user_id in load and thread_id in weights:
+            load[user_id] += weights[thread_id]
+
+    pairs = list()
+    for thread in sorted(threads, key=lambda t: (-weights[t['thread_id']], t['thread_id'])):
+        thread_id = thread['thread_id']
+        needed = k - len(on_thread[thread_id])
+        if needed <= 0:
+            continue
+        candidates = [u for u in coders if u not in on_thread[thread_id]]
+        for user_id in heapq.nsmallest(needed, candidates, key=lambda u: (load[u], u)):
+            pairs.append((thread_id, user_id))
+            on_thread[thread_id].add(user_id)
+            load[user_id] += weights[thread_id]
+    return pairs, load
+
+
+# Database interface
+
+def codable_threads(db, thread_ids=None):
+    '''Threads with at least one post to code, optionally limited to thread_ids.
+
+    A thread's first post to code is read from its coding order (position 1), so threads
+    with no replies are never offered, whatever their first_post_id says.'''
+    threads_q = """SELECT t.thread_id, t.title, t.comment_count, pp.post_id AS first_post_id
+                   FROM threads t JOIN post_positions pp ON pp.thread_id = t.thread_id AND pp.position = 1"""
+    if thread_ids is not None:
+        threads_q += " WHERE t.thread_id IN (%s)" % ','.join(str(int(t)) for t in thread_ids)
+    threads_q += " ORDER BY t.thread_id"
+    return query(db, threads_q, fetchall=True)
+
+def write_assignments(db, task_id, pairs, threads):
+    '''Insert (thread_id, user_id) assignments in bulk, skipping any that already exist.
+
+    Each assignment starts at the thread's first post to code (position 1); pairs for
+    threads not in threads are dropped.'''
+    first_post = dict((t['thread_id'], t['first_post_id']) for t in threads)
+    rows = [(thread_id, user_id, int(task_id), first_post[thread_id], 1, 0) for thread_id, user_id in pairs
+            if thread_id in first_post]
+    with transaction(db):
+        return insert_many(db, 'assignments', ASSIGNMENT_COLS, rows, ignore=True)
+
+def assign_balanced(db, task_id, coders, k, threads=None, dry_run=False):
+    '''Assign threads (by default, every codable thread) to a pool of coders, k coders per thread.
+
+    Returns the planned (thread_id, user_id) pairs and each coder's workload.'''
+    if threads is None:
+        threads = codable_threads(db)
+    existing = [(row['thread_id'], row['user_id']) for row in
+                query(db, "SELECT thread_id, user_id FROM assignments WHERE task_id = %d" % int(task_id))]
+    pairs, load = plan_assignments(threads, coders, k, existing)
+    if pairs and not dry_run:
+        write_assignments(db, task_id, pairs, threads)
+    return pairs, load
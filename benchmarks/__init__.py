@@ -0,0 +1,4 @@
+# benchmarks
+# Synthetic data and timed scenarios for forum data annotator application.
+#
+# Run with `python -m benchmarks --help` from the repository root.
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# __main__.py
+# Command line for the benchmark suite.
+#
+# Loads a synthetic forum into the database configured by DB_* (a local scratch
+# database with the schema built: every table the suite uses is emptied first), codes
+# it with synthetic coders, and times each hot path. Results can be saved as a JSON
+# baseline and later runs compared against it.
+#
+# Usage:
+#   python -m benchmarks --reset --save benchmarks/baseline.json
+#   python -m benchmarks --reset --compare benchmarks/baseline.json
+#   python -m benchmarks --csv forum.csv --threads 5000   # Just write the synthetic export
+
+import argparse
+import sys
+
+from benchmarks.synthetic import DEFAULT_CONFIG, synthetic_rows, write_csv
+
+
+def parse_args(argv, defaults=DEFAULT_CONFIG):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description="Time the annotator's hot paths on a synthetic forum.")
+    corpus = parser.add_argument_group("synthetic forum")
+    corpus.add_argument('--threads', type=int, default=defaults['threads'], help="Threads to generate.")
+    corpus.add_argument('--fanout', type=int, default=defaults['fanout'], help="Most replies per post (main replies per thread: up to twice this).")
+    corpus.add_argument('--depth', type=int, default=defaults['depth'], help="Reply levels below each top-level post.")
+    corpus.add_argument('--body-words', type=int, default=defaults['body_words'], help="Average words per post.")
+    corpus.add_argument('--emoji-share', type=float, default=defaults['emoji_share'], help="Share of posts containing emoji.")
+    corpus.add_argument('--seed', type=int, default=defaults['seed'], help="Random seed for the forum and codes.")
+    coding = parser.add_argument_group("synthetic codes")
+    coding.add_argument('--coders', type=int, default=defaults['coders'], help="Coders in the pool.")
+    coding.add_argument('-k', type=int, default=defaults['k'], help="Coders per thread.")
+    coding.add_argument('--agreement-rate', type=float, default=defaults['agreement_rate'], help="Chance a coder gives a post's reference code.")
+    coding.add_argument('--progress', type=float, default=defaults['progress'], help="Share of each assignment already coded.")
+    run = parser.add_argument_group("run")
+    run.add_argument('--scenario', dest='scenarios', action='append', default=[], help="Scenario to run (repeatable; default all).")
+    run.add_argument('--repeat', type=int, default=5, help="Timed runs per scenario.")
+    run.add_argument('--processes', type=int, default=defaults['processes'], help="Load ordering processes.")
+    run.add_argument('--writers', type=int, default=defaults['writers'], help="Load writer connections (their queries are not counted).")
+    run.add_argument('--reset', action='store_true', help="Confirm the configured database may be emptied.")
+    run.add_argument('--save', metavar='PATH', help="Write results as a JSON baseline.")
+    run.add_argument('--compare', metavar='PATH', help="Compare results with a JSON baseline; exit 1 on regression.")
+    run.add_argument('--tolerance', type=float, default=0.2, help="Growth in wall time or memory tolerated before flagging a regression.")
+    run.add_argument('--csv', metavar='PATH', help="Only write the synthetic forum as a CSV export.")
+    return parser, parser.parse_args(argv)
+
+def main(argv=None):
+    parser, args = parse_args(argv)
+    config = dict((key, getattr(args, key)) for key in DEFAULT_CONFIG)
+
+    if args.csv:
+        n = write_csv(synthetic_rows(args.threads, args.seed, fanout=args.fanout, depth=args.depth,
+                                     body_words=args.body_words, emoji_share=args.emoji_share), args.csv)
+        print >> sys.stderr, "Wrote %d rows to %s." % (n, args.csv)
+        return 0
+    if not args.reset:
+        parser.error("--reset is required: the benchmark empties the configured database")
+
+    # Imported only now: the app reads DB_* from the environment, which writing a CSV doesn't need
+    from benchmarks import scenarios
+    unknown = [name for name in args.scenarios if name not in scenarios.SCENARIO_NAMES]
+    if unknown:
+        parser.error("unknown scenario %s (choose from %s)" % (unknown[0], ', '.join(scenarios.SCENARIO_NAMES)))
+    results = scenarios.run_benchmarks(config, args.scenarios or scenarios.SCENARIO_NAMES, args.repeat)
+    for line in scenarios.report(results):
+        print line
+    if args.save:
+        scenarios.save_baseline(args.save, config, results)
+        print >> sys.stderr, "Saved baseline to %s." % args.save
+    if args.compare:
+        lines, regressions = scenarios.compare(scenarios.load_baseline(args.compare), config, results, args.tolerance)
+        print
+        for line in lines:
+            print line
+        if regressions:
+            print >> sys.stderr, "%d regressions against %s." % (len(regressions), args.compare)
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
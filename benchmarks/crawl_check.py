@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# crawl_check.py
+# Offline check of the Reddit crawler against a stub server on localhost.
+#
+# Author: Alex Kindel
+# Date: 19 July 2016
+#
+# Serves a fake subreddit from a local thread: a paged top listing, thread pages, and
+# pages that fail a few times (503, 429 with Retry-After, a body cut off mid-way, or a
+# connection closed before any response) before answering, fail for good, or are missing. Crawls it with reddit/crawl_reddit.py and checks that
+# requests stay within the token bucket's rate, failures are retried with backoff (and
+# given up on when they should be), and responses are served from the content-addressed
+# cache on a second run. Prints one line per check; exits 1 if any fails.
+#
+# Usage:
+#   python -m benchmarks.crawl_check
+#   python -m benchmarks.crawl_check --threads 60 --rate 40 --burst 5 --workers 8
+
+import argparse
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from contextlib import contextmanager
+from SocketServer import ThreadingMixIn
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'reddit'))  # The crawler is a script, not a package
+
+from crawl_reddit import Crawler, DiskCache, FetchError, LISTING_PAGE, thread_path, top_threads
+
+
+SUBREDDIT = 'stub'
+DEFAULT_CHECK = dict(threads=150, rate=50.0, burst=4, workers=6, backoff=0.05)
+TRUNCATED = 'truncated body'    # Failure: half the body is sent, then the connection is closed
+DROPPED = 'dropped connection'  # Failure: the connection is closed before a status line
+FLAKY = {'flaky503': (503, 2, None), 'flaky429': (429, 1, '1'),  # Thread id -> (failure, failures before answering, Retry-After)
+         'truncated': (TRUNCATED, 2, None), 'hangup': (DROPPED, 1, None)}
+BROKEN = 'broken'    # Always 503
+MISSING = 'missing'  # 404, which isn't retried
+DUPLICATE = 'dupe'   # Same page as DUPLICATE_OF, so cached once
+DUPLICATE_OF = 't000'
+RATE_SLACK = 1       # Requests allowed over the bucket's limit in any window, for timing noise
+
+
+# Stub server
+
+def thread_ids(n):
+    return ["t%03d" % i for i in range(n)]
+
+def page(thread_id):
+    if thread_id == DUPLICATE:
+        thread_id = DUPLICATE_OF
+    return "<html><body><div class=\"thing\" data-fullname=\"t3_%s\">Thread %s</div></body></html>" % (thread_id, thread_id)
+
+class StubReddit(object):
+    '''Responses of a fake subreddit of n threads, with a log of when each path was requested.'''
+
+    LISTING = re.compile(r'^/r/%s/top/\.json\?(.*)$' % SUBREDDIT)
+    THREAD = re.compile(r'^(?:/r/%s)?/comments/(\w+)$' % SUBREDDIT)
+
+    def __init__(self, n):
+        self.ids = thread_ids(n)
+        self.requests = list()  # (time, path)
+        self.failures = dict()  # Thread id -> failures served so far
+        self._lock = threading.Lock()
+
+    def respond(self, path):
+        '''(status, headers, body, bytes of the body to send) for a request path.
+
+        A status of None closes the connection without a response; bytes to send of None sends the whole body.'''
+        with self._lock:
+            self.requests.append((time.time(), path))
+            match = self.LISTING.match(path)
+            if match:
+                return self.listing(dict(p.split('=', 1) for p in match.group(1).split('&')))
+            match = self.THREAD.match(path)
+            if not match or match.group(1) == MISSING:
+                return 404, {}, "Not found", None
+            thread_id = match.group(1)
+            if thread_id == BROKEN:
+                return 503, {}, "Unavailable", None
+            html = {'Content-Type': 'text/html'}
+            if thread_id in FLAKY:
+                failure, failures, retry_after = FLAKY[thread_id]
+                if self.failures.get(thread_id, 0) < failures:
+                    self.failures[thread_id] = self.failures.get(thread_id, 0) + 1
+                    if failure == TRUNCATED:
+                        return 200, html, page(thread_id), len(page(thread_id)) // 2
+                    if failure == DROPPED:
+                        return None, {}, "", None
+                    return failure, {'Retry-After': retry_after} if retry_after else {}, "Try again", None
+            return 200, html, page(thread_id), None
+
+    def listing(self, params):
+        start = self.ids.index(params['after'][3:]) + 1 if 'after' in params else 0
+        children = self.ids[start:start + int(params['limit'])]
+        after = "t3_%s" % children[-1] if children and start + len(children) < len(self.ids) else None
+        body = '{"data": {"after": %s, "children": [%s]}}' % ('"%s"' % after if after else 'null',
+                                                             ', '.join('{"data": {"id": "%s"}}' % t for t in children))
+        return 200, {'Content-Type': 'application/json'}, body, None
+
+    def times(self, pattern=None):
+        return [t for t, path in self.requests if pattern is None or re.search(pattern, path)]
+
+class ThreadedServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+@contextmanager
+def serving(stub):
+    '''Serve stub on a free localhost port for the duration, yielding its base URL.'''
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            status, headers, body, sent = stub.respond(self.path)
+            if status is None:
+                return  # The server closes the connection after each request
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body if sent is None else body[:sent])
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadedServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield "http://127.0.0.1:%d" % server.server_address[1]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+# Checks
+
+def over_rate(times, rate, burst):
+    '''Most requests by which any window of times exceeds what a bucket of rate and burst allows.'''
+    times = sorted(times)
+    worst = 0
+    for i in range(len(times)):
+        for j in range(i, len(times)):
+            worst = max(worst, (j - i + 1) - (burst + rate * (times[j] - times[i])))
+    return worst
+
+def gaps(times):
+    return [b - a for a, b in zip(times, times[1:])]
+
+def cache_files(root, kind):
+    found = list()
+    for dirpath, _, filenames in os.walk(os.path.join(root, kind)):
+        found.extend(os.path.join(dirpath, f) for f in filenames)
+    return found
+
+def run_checks(config, cache_root):
+    '''Crawl the stub twice, yielding (check, passed, detail) for each check.'''
+    stub = StubReddit(config['threads'])
+    with serving(stub) as base_url:
+        def crawler():
+            return Crawler(DiskCache(cache_root), base_url=base_url, workers=config['workers'], rate=config['rate'],
+                           burst=config['burst'], retries=3, backoff=config['backoff'], max_backoff=2.0, timeout=10)
+
+        # First crawl: listing, then every thread page concurrently
+        first = crawler()
+        start = time.time()
+        listed = top_threads(first, SUBREDDIT, config['threads'])
+        pages = len(stub.times('/top/'))
+        yield ("listing is paged", listed == stub.ids and pages == -(-config['threads'] // LISTING_PAGE),
+               "%d of %d ids in %d requests" % (len(listed), len(stub.ids), pages))
+
+        extra = sorted(FLAKY) + [BROKEN, MISSING, DUPLICATE]
+        paths = [thread_path(t, SUBREDDIT) for t in listed + extra]
+        results = dict((path.rsplit('/', 1)[1], (body, error)) for path, body, error in first.fetch_all(paths))
+        elapsed = time.time() - start
+        fetched = [t for t in listed + [DUPLICATE] + sorted(FLAKY) if results[t][0] == page(t)]
+        yield ("pages fetched", len(fetched) == len(listed) + 1 + len(FLAKY),
+               "%d of %d pages in %.2f s" % (len(fetched), len(listed) + 1 + len(FLAKY), elapsed))
+
+        excess = over_rate(stub.times(), config['rate'], config['burst'])
+        yield ("token bucket holds the rate", excess <= RATE_SLACK,
+               "%d requests, at most %.1f over %d + %.0f/s in any window" % (len(stub.requests), excess, config['burst'], config['rate']))
+
+        for thread_id, (failure, failures, retry_after) in sorted(FLAKY.items()):
+            times = stub.times('/comments/%s$' % thread_id)
+            least = [float(retry_after)] * failures if retry_after else [config['backoff'] * 2 ** a * 0.5 for a in range(failures)]
+            waited = gaps(times)
+            yield ("%s retried with backoff" % ("HTTP %d" % failure if isinstance(failure, int) else failure),
+                   len(times) == failures + 1 and results[thread_id][1] is None and all(w >= l for w, l in zip(waited, least)),
+                   "%d requests, waits %s s (at least %s s)" % (len(times), ', '.join('%.2f' % w for w in waited) or 'none', ', '.join('%.2f' % l for l in least)))
+
+        broken = stub.times('/comments/%s$' % BROKEN)
+        yield ("persistent failure given up on", isinstance(results[BROKEN][1], FetchError) and len(broken) == first.retries + 1,
+               "%d requests: %s" % (len(broken), results[BROKEN][1]))
+        missing = stub.times('/comments/%s$' % MISSING)
+        yield ("HTTP 404 not retried", isinstance(results[MISSING][1], FetchError) and len(missing) == 1,
+               "%d requests: %s" % (len(missing), results[MISSING][1]))
+
+        refs, objects = cache_files(cache_root, 'refs'), cache_files(cache_root, 'objects')
+        partial = [f for f in refs + objects if f.endswith('.tmp')]
+        yield ("cache is content-addressed", len(refs) == len(objects) + 1 and not partial,
+               "%d URLs, %d bodies, %d partial files" % (len(refs), len(objects), len(partial)))
+
+        # Second crawl: everything fetched before comes from the cache
+        before = len(stub.requests)
+        second = crawler()
+        relisted = top_threads(second, SUBREDDIT, config['threads'])
+        again = dict((path.rsplit('/', 1)[1], body) for path, body, _ in second.fetch_all(paths))
+        refetched = [path for _, path in stub.requests[before:]]
+        same = all(again[t] == results[t][0] for t in fetched)
+        yield ("re-run served from cache", relisted == listed and same and sorted(set(refetched)) == sorted(thread_path(t, SUBREDDIT) for t in [BROKEN, MISSING]),
+               "%d requests, for %s (only failed pages should be)" % (len(refetched), ', '.join(sorted(set(refetched))) or 'none'))
+
+        before = len(stub.requests)
+        second.fetch(thread_path(listed[0], SUBREDDIT), refresh=True)
+        yield ("refresh bypasses cache", len(stub.requests) == before + 1, "%d requests" % (len(stub.requests) - before))
+
+
+# Command line
+
+def parse_args(argv, defaults=DEFAULT_CHECK):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.crawl_check', description="Check the Reddit crawler against a local stub server.")
+    parser.add_argument('--threads', type=int, default=defaults['threads'], help="Threads in the stub subreddit's top listing.")
+    parser.add_argument('--rate', type=float, default=defaults['rate'], help="Crawler requests per second.")
+    parser.add_argument('--burst', type=int, default=defaults['burst'], help="Crawler token bucket size.")
+    parser.add_argument('--workers', type=int, default=defaults['workers'], help="Concurrent crawler requests.")
+    parser.add_argument('--backoff', type=float, default=defaults['backoff'], help="Seconds before the first retry.")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    config = dict((key, getattr(args, key)) for key in DEFAULT_CHECK)
+    cache_root = tempfile.mkdtemp(prefix='crawl-check-')
+    failed = 0
+    try:
+        for check, passed, detail in run_checks(config, cache_root):
+            failed += not passed
+            print "%-4s %-40s %s" % ('ok' if passed else 'FAIL', check, detail)
+    finally:
+        shutil.rmtree(cache_root, ignore_errors=True)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+# loadtest.py
+# Concurrent-coder load test for forum data annotator application.
+#
+# Author: Alex Kindel
+# Date: 19 July 2016
+#
+# Loads a synthetic forum into the database configured by DB_* (emptying the app's
+# tables first, as the benchmark suite does), assigns it to synthetic coders, then
+# has coders arrive at a running app at a set rate. Each logs in and works through
+# one of their assignments on /annotate/<assn_id>: viewing, coding, navigating and
+# re-coding posts. Reports throughput, latency percentiles and errors per action,
+# and checks every assignment's position (assignments.done) for lost updates.
+#
+# Usage:
+#   python -m benchmarks.loadtest --reset --serve --coders 50 --rate 5 --duration 60
+#   python -m benchmarks.loadtest --reset --url http://127.0.0.1:8000 --tabs 2   # App already running
+
+import argparse
+import cookielib
+import httplib
+import json
+import math
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib
+import urllib2
+from contextlib import contextmanager
+from Queue import Queue
+from urlparse import urlparse
+
+from benchmarks.synthetic import BENCH_PASSWORD, CODE_OPTIONS, DEFAULT_CONFIG, synthetic_rows, synthetic_codes
+from dbutils import query
+from loader import load_rows
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PREFIX = 'load'  # Synthetic usernames are load-coder1, load-coder2...
+CORPUS_PARAMS = ['threads', 'seed', 'fanout', 'depth', 'body_words', 'emoji_share']
+DEFAULT_LOAD = dict(DEFAULT_CONFIG, coders=50, progress=0.0, rate=5.0, duration=60, actions=20, think=0.5, tabs=1, timeout=30)
+ACTIONS = ['login', 'view', 'code', 'next', 'prev']
+STEPS = [('code', 0.6), ('view', 0.15), ('next', 0.1), ('recode', 0.15)]  # Session steps and their chances; recode is prev, then code
+MOVES = {'code': 1, 'next': 1, 'prev': -1}  # Change in assignments.done when a request moves the pointer
+PERCENTILES = [50, 90, 95, 99]
+LOST_LISTED = 20  # Lost updates listed individually in the report
+SERVER_START_TIMEOUT = 30  # Seconds to wait for a --serve app to answer
+
+# Flashed messages on a page; the app flashes one whenever a code or move doesn't advance the pointer
+FLASHES = re.compile(r'<div class="alert alert-warning" role="alert">\s*<ul>(.*?)</ul>', re.S)
+FLASH = re.compile(r'<li>(.*?)</li>', re.S)
+FINISHED = "This thread is finished!"
+
+
+# Results
+
+def percentile(values, p):
+    '''Nearest-rank p-th percentile of sorted values.'''
+    if not values:
+        return 0.0
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+class Stats(object):
+    '''Thread-safe record of every request made, by action.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = dict((action, []) for action in ACTIONS)  # action -> [(seconds, ok, queries, db ms)]
+        self.errors = dict()  # (action, reason) -> count
+
+    def add(self, action, seconds, error=None, headers=None):
+        queries = db_ms = None
+        if headers is not None and headers.getheader('X-Query-Count') is not None:
+            queries = int(headers.getheader('X-Query-Count'))
+            db_ms = float(headers.getheader('X-DB-Time'))
+        with self._lock:
+            self.requests[action].append((seconds, error is None, queries, db_ms))
+            if error is not None:
+                self.errors[(action, error)] = self.errors.get((action, error), 0) + 1
+
+    def summary(self, wall):
+        '''Per-action (and overall) request counts, error rates, throughput and latency percentiles in ms.'''
+        with self._lock:
+            rows = [(action, list(self.requests[action])) for action in ACTIONS]
+        rows.append(('all', [r for _, requests in rows for r in requests]))
+        summary = list()
+        for action, requests in rows:
+            latencies = sorted(1000 * r[0] for r in requests)
+            errors = sum(1 for r in requests if not r[1])
+            profiled = [r for r in requests if r[2] is not None]
+            s = {'action': action, 'requests': len(requests), 'errors': errors,
+                 'error_rate': errors / float(len(requests)) if requests else 0.0,
+                 'per_s': len(requests) / wall if wall else 0.0,
+                 'max_ms': latencies[-1] if latencies else 0.0,
+                 'queries': sum(r[2] for r in profiled) / float(len(profiled)) if profiled else None,
+                 'db_ms': sum(r[3] for r in profiled) / float(len(profiled)) if profiled else None}
+            for p in PERCENTILES:
+                s['p%d_ms' % p] = percentile(latencies, p)
+            summary.append(s)
+        return summary
+
+class Ledger(object):
+    '''Moves of each assignment's pointer that the app reported making.
+
+    However concurrent requests on an assignment interleave, its final done must be its
+    initial done plus the moves reported: a shortfall or excess is a lost update. A request
+    that failed may or may not have been applied, so its assignment can't be checked.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.moves = dict()        # assn_id -> net change in done
+        self.unknown = set()       # Assignments with a write of unknown outcome
+        self.finished = set()      # Assignments whose last post has been coded
+
+    def add(self, assn_id, move):
+        with self._lock:
+            self.moves[assn_id] = self.moves.get(assn_id, 0) + move
+
+    def touch(self, assn_id):
+        with self._lock:
+            self.moves.setdefault(assn_id, 0)
+
+    def void(self, assn_id):
+        with self._lock:
+            self.unknown.add(assn_id)
+
+    def finish(self, assn_id):
+        with self._lock:
+            self.finished.add(assn_id)
+
+def check_positions(db, ledger, initial):
+    '''Compare each assignment the load test moved with the ledger, and its pointer with its position.
+
+    Returns the number of assignments checked, the lost updates ((assn_id, expected done,
+    actual done) triples), and assignments whose next_post_id isn't the post at done.'''
+    assn_ids = sorted(set(ledger.moves) - ledger.unknown)
+    if not assn_ids:
+        return 0, [], []
+    rows = query(db, """SELECT a.assn_id, a.done, a.next_post_id, p.post_id AS post_at_done
+                        FROM assignments a
+                        LEFT JOIN post_positions p ON a.thread_id = p.thread_id AND a.done = p.position
+                        WHERE a.assn_id IN (%s)""" % ','.join(str(int(assn_id)) for assn_id in assn_ids), fetchall=True)
+    lost = list()
+    mismatched = list()
+    for row in rows:
+        expected = initial[row['assn_id']] + ledger.moves[row['assn_id']]
+        if row['done'] != expected:
+            lost.append((row['assn_id'], expected, row['done']))
+        if row['next_post_id'] != row['post_at_done']:
+            mismatched.append(row['assn_id'])
+    return len(rows), lost, mismatched
+
+
+# Coders
+
+class Client(object):
+    '''One browser session on the app, recording each request it makes.'''
+
+    def __init__(self, url, stats, timeout):
+        self.url = url.rstrip('/')
+        self.stats = stats
+        self.timeout = timeout
+        self.opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(cookielib.CookieJar()))
+
+    def request(self, action, path, fields=None, expect=None):
+        '''GET path, or POST fields to it; returns the page, or None (recording why) on failure.
+
+        A page without the text expect is a failure too, e.g. a login form in place of the page asked for.'''
+        data = urllib.urlencode(fields) if fields is not None else None
+        start = time.time()
+        page = headers = error = None
+        try:
+            response = self.opener.open(self.url + path, data, self.timeout)
+            page, headers = response.read(), response.info()
+        except urllib2.HTTPError as e:
+            error = "HTTP %d" % e.code
+        except (urllib2.URLError, socket.error, httplib.HTTPException) as e:
+            error = type(getattr(e, 'reason', e)).__name__  # e.g. timeout, or error for a refused connection
+        if page is not None and expect is not None and expect not in page:
+            page, error = None, "unexpected page"
+        self.stats.add(action, time.time() - start, error, headers)
+        return page
+
+    def login(self, username):
+        return self.request('login', '/login', {'username': username, 'password': BENCH_PASSWORD}, expect='Log out') is not None
+
+def flashed(page):
+    block = FLASHES.search(page)
+    return FLASH.findall(block.group(1)) if block else []
+
+def pick_step(rng):
+    r = rng.random()
+    for step, chance in STEPS:
+        if r < chance:
+            return step
+        r -= chance
+    return STEPS[-1][0]
+
+def act(client, action, assn_id, rng, ledger):
+    '''Make one request on an assignment's coding page and enter any move it made in the ledger.'''
+    path = '/annotate/%d' % assn_id
+    fields = None
+    if action == 'code':
+        fields = {'choice': rng.choice(CODE_OPTIONS)}  # The app reads every field named choice*, not the submit button
+    elif action in MOVES:
+        fields = {action: action}
+    page = client.request(action, path, fields, expect='id="codeform"')
+    if page is None:
+        if fields is not None:
+            ledger.void(assn_id)
+        return False
+    if fields is not None:
+        messages = flashed(page)
+        if not messages:
+            ledger.add(assn_id, MOVES[action])
+        elif any(FINISHED in m for m in messages):
+            ledger.finish(assn_id)
+    return True
+
+def session(url, username, assn_id, config, seed, stats, ledger):
+    '''A coder's visit: log in, open the assignment, and take config['actions'] steps with think time between.'''
+    rng = random.Random(seed)
+    client = Client(url, stats, config['timeout'])
+    if not client.login(username):
+        return
+    ledger.touch(assn_id)
+    if not act(client, 'view', assn_id, rng, ledger):
+        return
+    for _ in range(config['actions']):
+        if config['think']:
+            time.sleep(rng.expovariate(1.0 / config['think']))
+        step = pick_step(rng)
+        for action in (['prev', 'code'] if step == 'recode' else [step]):
+            if not act(client, action, assn_id, rng, ledger):
+                return
+
+
+# Load
+
+def prepare(db, config):
+    '''Load the synthetic forum and assign it to synthetic coders.
+
+    Returns each coder's username and assignments, and every assignment's initial done.'''
+    load_rows(db, synthetic_rows(**dict((p, config[p]) for p in CORPUS_PARAMS)), processes=config['processes'])
+    task_id, _, coder_ids = synthetic_codes(db, coders=config['coders'], k=config['k'], progress=config['progress'],
+                                            seed=config['seed'], prefix=PREFIX)
+    names = dict((row['id'], row['username']) for row in
+                 query(db, "SELECT id, username FROM users WHERE id IN (%s)" % ','.join(str(i) for i in coder_ids)))
+    coders = dict((user_id, {'username': names[user_id], 'assignments': []}) for user_id in coder_ids)
+    initial = dict()
+    for row in query(db, "SELECT assn_id, user_id, done FROM assignments WHERE task_id = %d ORDER BY assn_id" % task_id):
+        coders[row['user_id']]['assignments'].append(row['assn_id'])
+        initial[row['assn_id']] = row['done']
+    return [c for c in coders.values() if c['assignments']], initial
+
+def run_load(url, coders, config, stats, ledger):
+    '''Start coder visits at Poisson arrivals of config['rate'] per second for config['duration'] seconds.
+
+    Each visit is by an idle coder (an arrival waits for one if all are busy), on one of
+    their unfinished assignments if any are left, in config['tabs'] concurrent sessions.
+    Returns the run's wall time and how late visits started, in seconds.'''
+    rng = random.Random(config['seed'])
+    idle = Queue()
+    for coder in coders:
+        idle.put(coder)
+
+    def visit(coder, assn_id, seed):
+        tabs = [threading.Thread(target=session, args=(url, coder['username'], assn_id, config, seed + tab, stats, ledger))
+                for tab in range(config['tabs'])]
+        for tab in tabs:
+            tab.start()
+        for tab in tabs:
+            tab.join()
+        idle.put(coder)
+
+    visits = list()
+    delays = list()
+    start = due = time.time()
+    while True:
+        due += rng.expovariate(config['rate'])
+        if due - start > config['duration']:
+            break
+        time.sleep(max(0, due - time.time()))
+        coder = idle.get()
+        delays.append(max(0, time.time() - due))
+        open_assignments = [a for a in coder['assignments'] if a not in ledger.finished] or coder['assignments']
+        visits.append(threading.Thread(target=visit, args=(coder, rng.choice(open_assignments), rng.randint(0, sys.maxint))))
+        visits[-1].start()
+    for v in visits:
+        v.join()
+    return time.time() - start, delays
+
+@contextmanager
+def serving(url, log_path=None):
+    '''Run the app on url's port with flask's threaded server, until the block exits.'''
+    env = dict(os.environ, FLASK_APP='annotator.py')
+    log = open(log_path or os.devnull, 'w')
+    server = subprocess.Popen([sys.executable, '-m', 'flask', 'run', '--port', str(urlparse(url).port or 80), '--with-threads', '--no-reload'],
+                              cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        deadline = time.time() + SERVER_START_TIMEOUT
+        while True:
+            if server.poll() is not None:
+                raise RuntimeError("The app exited on startup (code %d)." % server.returncode)
+            try:
+                urllib2.urlopen(url.rstrip('/') + '/login', timeout=1).read()
+                break
+            except (urllib2.URLError, socket.error, httplib.HTTPException):
+                if time.time() > deadline:
+                    raise RuntimeError("The app didn't answer within %d seconds." % SERVER_START_TIMEOUT)
+                time.sleep(0.2)
+        yield server
+    finally:
+        if server.poll() is None:
+            server.terminate()
+            server.wait()
+        log.close()
+
+
+# Reporting
+
+def format_ms(value):
+    return '-' if value is None else "%.1f" % value
+
+def report(summary, errors, delays, checked, lost, mismatched, unknown):
+    lines = ["%-6s %8s %7s %7s %8s %s %8s %8s %8s" % ('action', 'requests', 'errors', 'error %', 'req/s',
+                                                  ' '.join("%7s" % ('p%d ms' % p) for p in PERCENTILES), 'max ms', 'queries', 'db ms')]
+    for s in summary:
+        lines.append("%-6s %8d %7d %7.2f %8.2f %s %8.1f %8s %8s" % (s['action'], s['requests'], s['errors'], 100 * s['error_rate'], s['per_s'],
+                                                                  ' '.join("%7.1f" % s['p%d_ms' % p] for p in PERCENTILES), s['max_ms'],
+                                                                  format_ms(s['queries']), format_ms(s['db_ms'])))
+    for (action, reason), n in sorted(errors.items()):
+        lines.append("  %s: %s x%d" % (action, reason, n))
+    lines.append("")
+    delays = sorted(delays)
+    lines.append("Visits: %d, started a median %.2f s (p95 %.2f s) after arriving" % (len(delays), percentile(delays, 50), percentile(delays, 95)))
+    lines.append("assignments.done: %d assignments checked, %d lost updates (%d moves), %d pointers off their position, %d unchecked after failed writes"
+                 % (checked, len(lost), sum(abs(expected - done) for _, expected, done in lost), len(mismatched), unknown))
+    for assn_id, expected, done in lost[:LOST_LISTED]:
+        lines.append("  assignment %d: done is %d, moves made add up to %d" % (assn_id, done, expected))
+    if len(lost) > LOST_LISTED:
+        lines.append("  ...and %d more" % (len(lost) - LOST_LISTED))
+    return lines
+
+
+def parse_args(argv, defaults=DEFAULT_LOAD):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.loadtest', description="Drive many concurrent coders against a running annotator.")
+    app = parser.add_argument_group("app")
+    app.add_argument('--url', default='http://127.0.0.1:5000', help="Where the app is served.")
+    app.add_argument('--serve', action='store_true', help="Start the app (flask's threaded server) on the --url port for the run.")
+    app.add_argument('--server-log', metavar='PATH', help="With --serve, write the app's output (including slow-query warnings) here.")
+    app.add_argument('--reset', action='store_true', help="Confirm the configured database may be emptied.")
+    data = parser.add_argument_group("synthetic data")
+    data.add_argument('--threads', type=int, default=defaults['threads'], help="Threads to generate.")
+    data.add_argument('--coders', type=int, default=defaults['coders'], help="Coders in the pool, each with their own login.")
+    data.add_argument('-k', type=int, default=defaults['k'], help="Coders per thread.")
+    data.add_argument('--progress', type=float, default=defaults['progress'], help="Share of each assignment already coded.")
+    data.add_argument('--seed', type=int, default=defaults['seed'], help="Random seed for the forum and the coders' behavior.")
+    load = parser.add_argument_group("load")
+    load.add_argument('--rate', type=float, default=defaults['rate'], help="Coder visits starting per second, on average.")
+    load.add_argument('--duration', type=float, default=defaults['duration'], help="Seconds over which visits start.")
+    load.add_argument('--actions', type=int, default=defaults['actions'], help="Steps per visit (code, view, next, or prev then re-code).")
+    load.add_argument('--think', type=float, default=defaults['think'], help="Mean seconds a coder pauses between steps.")
+    load.add_argument('--tabs', type=int, default=defaults['tabs'], help="Concurrent sessions per visit on the same assignment, as with several open tabs.")
+    load.add_argument('--timeout', type=float, default=defaults['timeout'], help="Seconds before a request counts as failed.")
+    load.add_argument('--json', metavar='PATH', help="Also write the results as JSON.")
+    return parser, parser.parse_args(argv)
+
+def main(argv=None):
+    parser, args = parse_args(argv)
+    if not args.reset:
+        parser.error("--reset is required: the load test empties the configured database")
+    config = dict(DEFAULT_LOAD)
+    config.update((key, getattr(args, key)) for key in DEFAULT_LOAD if hasattr(args, key))
+
+    # Imported only now: the app reads DB_* from the environment, which --help doesn't need
+    from annotator import dbms
+    from benchmarks.scenarios import reset_database
+    from dbutils import with_db
+
+    reset_database()
+    coders, initial = with_db(dbms)(prepare)(config)
+    print >> sys.stderr, "%d coders with %d assignments; visits start at %.1f/s for %d s..." % (len(coders), len(initial), config['rate'], config['duration'])
+
+    stats = Stats()
+    ledger = Ledger()
+    if args.serve:
+        with serving(args.url, args.server_log):
+            wall, delays = run_load(args.url, coders, config, stats, ledger)
+    else:
+        wall, delays = run_load(args.url, coders, config, stats, ledger)
+    checked, lost, mismatched = with_db(dbms)(check_positions)(ledger, initial)
+
+    summary = stats.summary(wall)
+    for line in report(summary, stats.errors, delays, checked, lost, mismatched, len(ledger.unknown)):
+        print line
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'created_at': int(time.time()), 'config': config, 'wall_s': wall, 'actions': summary,
+                       'errors': [{'action': a, 'reason': r, 'count': n} for (a, r), n in sorted(stats.errors.items())],
+                       'checked': checked, 'lost_updates': [{'assn_id': a, 'expected': e, 'done': d} for a, e, d in lost],
+                       'mismatched': mismatched, 'unchecked': len(ledger.unknown)}, f, indent=2, sort_keys=True)
+    return 1 if lost or mismatched else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+# scenarios.py
+# Timed hot-path scenarios for forum data annotator application.
+#
+# Author: Alex Kindel
+# Date: 19 July 2016
+
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+from multiprocessing import Process, Pipe
+
+from flask import g
+
+import agreement
+from annotator import application, dbms, thread_cache, fragment_cache, retrieve_thread, goto_post
+from dataset import read_rows
+from dbutils import with_db, query, dev_only
+from loader import BatchWriter, load_rows
+from benchmarks.synthetic import CODE_OPTIONS, synthetic_rows, synthetic_codes, write_csv
+
+
+# Tables emptied before each load; the benchmark database holds nothing else
+BENCH_TABLES = ['threads', 'posts', 'post_positions', 'users', 'tasks', 'assignments', 'codes',
+                'tiebreakers', 'pair_agreement', 'disagreements']
+CORPUS_PARAMS = ['threads', 'seed', 'fanout', 'depth', 'body_words', 'emoji_share']
+CODE_PARAMS = ['coders', 'k', 'agreement_rate', 'progress', 'seed']
+RETRIEVE_SAMPLE = 50  # Threads whose context is rebuilt per retrieve_thread run
+METRICS = [('wall_s', "wall (s)"), ('queries', "queries"), ('peak_rss_kb', "peak RSS (KB)")]
+
+
+class ScenarioFailed(Exception):
+    def __init__(self, name, reason):
+        self.name = name
+        self.reason = reason
+
+    def __str__(self):
+        return "%s: %s" % (self.name, self.reason)
+
+
+# Measurement
+
+def peak_rss_kb():
+    '''Peak resident set size of this process so far, in KB.'''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak  # Bytes on OS X, KB elsewhere
+
+def in_child(name, f, *args):
+    '''Run f(*args) in a forked process and return its result.
+
+    Every scenario starts from the same small parent process, so peak memory is
+    comparable between scenarios and between runs.'''
+    reader, writer = Pipe(duplex=False)
+    def run():
+        try:
+            writer.send((f(*args), None))
+        except Exception:
+            writer.send((None, traceback.format_exc()))
+    child = Process(target=run)
+    child.start()
+    result, error = reader.recv()
+    child.join()
+    if error is not None:
+        raise ScenarioFailed(name, error)
+    return result
+
+def measure(run, repeat, prepare=None, warm_up=True):
+    '''Time repeat calls of run(), after an untimed warm-up call, counting the queries each makes.
+
+    prepare() is called untimed before every call. Calls share one app context, so
+    requests made with the test client count their queries too.'''
+    walls = list()
+    queries = list()
+    with application.app_context():
+        skip = 1 if warm_up else 0
+        for i in range(repeat + skip):
+            if prepare is not None:
+                prepare()
+            g.query_count = 0
+            start = time.time()
+            run()
+            if i >= skip:
+                walls.append(time.time() - start)
+                queries.append(g.query_count)
+    walls.sort()
+    return {'wall_s': walls[len(walls) // 2], 'wall_s_min': walls[0], 'runs': walls,
+            'queries': max(queries), 'peak_rss_kb': peak_rss_kb()}
+
+def client_as(user_id):
+    client = application.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = user_id
+    return client
+
+def get_page(client, name, url):
+    response = client.get(url)
+    if response.status_code != 200:
+        raise ScenarioFailed(name, "GET %s returned %d" % (url, response.status_code))
+    return response
+
+
+# Setup
+
+@dev_only
+@with_db(dbms)
+def reset_database(db):
+    '''Empty every table the benchmark writes to.'''
+    for table in BENCH_TABLES:
+        query(db, "TRUNCATE TABLE %s" % table)
+    thread_cache.clear()
+    fragment_cache.clear()
+
+def measure_load(config, repeat):
+    '''Write the synthetic corpus as a CSV export and time loading it into an empty database.
+
+    The database is left loaded for the other scenarios.'''
+    tmp = tempfile.mkdtemp(prefix='forum-bench-')
+    try:
+        path = os.path.join(tmp, 'forum.csv')
+        write_csv(synthetic_rows(**dict((p, config[p]) for p in CORPUS_PARAMS)), path)
+
+        @with_db(dbms)
+        def load(db):
+            writer = BatchWriter(dbms, config['writers']) if config['writers'] else None
+            load_rows(db, read_rows(path), processes=config['processes'], writer=writer)
+        return measure(load, repeat, prepare=reset_database, warm_up=False)
+    finally:
+        shutil.rmtree(tmp)
+
+@with_db(dbms)
+def prepare_codes(db, config):
+    '''Code the loaded corpus with synthetic coders; returns what the scenarios need.'''
+    task_id, admin_id, coder_ids = synthetic_codes(db, **dict((p, config[p]) for p in CODE_PARAMS))
+    ctx = {'task_id': task_id, 'admin_id': admin_id}
+
+    # The unfinished assignment on the longest thread, for the coding page
+    for row in query(db, """SELECT a.assn_id, a.user_id, a.done FROM assignments a JOIN threads t ON a.thread_id = t.thread_id
+                            WHERE a.task_id = %d AND NOT a.finished
+                            ORDER BY t.comment_count DESC, a.assn_id LIMIT 1""" % task_id):
+        ctx.update(assn_id=row['assn_id'], user_id=row['user_id'], done=row['done'])
+
+    # Next posts of the longest threads, for rebuilding context
+    ctx['contexts'] = [(row['thread_id'], row['next_post_id']) for row in
+                       query(db, """SELECT a.thread_id, MIN(a.next_post_id) AS next_post_id
+                                    FROM assignments a JOIN threads t ON a.thread_id = t.thread_id
+                                    WHERE a.task_id = %d
+                                    GROUP BY a.thread_id, t.comment_count
+                                    ORDER BY t.comment_count DESC, a.thread_id LIMIT %d""" % (task_id, RETRIEVE_SAMPLE))]
+    return ctx
+
+
+# Scenarios, each timed over a database loaded and coded by the setup above
+
+def annotate_thread_scenario(ctx):
+    '''The coding page for one assignment, with thread context cached.'''
+    client = client_as(ctx['user_id'])
+    url = '/annotate/%d' % ctx['assn_id']
+    return lambda: get_page(client, 'annotate_thread', url)
+
+def submit_code_scenario(ctx):
+    '''Coding the next post from the coding page, which records it and renders the following post.
+
+    The assignment's pointer is moved back before each run, so every run codes the same post.'''
+    client = client_as(ctx['user_id'])
+    url = '/annotate/%d' % ctx['assn_id']
+    def run():
+        response = client.post(url, data={'choice': CODE_OPTIONS[0]})
+        if response.status_code != 200:
+            raise ScenarioFailed('submit_code', "POST %s returned %d" % (url, response.status_code))
+    return run, lambda: goto_post(ctx['assn_id'], ctx['done'], absolute=True)
+
+def retrieve_thread_scenario(ctx):
+    '''Thread context for the sample threads, rebuilt from the database.'''
+    def run():
+        thread_cache.clear()
+        for thread_id, next_post_id in ctx['contexts']:
+            retrieve_thread(thread_id, next_post_id)
+    return run
+
+def diagnostics_scenario(ctx):
+    '''The task diagnostics page, with chance-corrected reliability statistics.'''
+    client = client_as(ctx['admin_id'])
+    url = '/tasks/%d/diagnostics?reliability=1' % ctx['task_id']
+    return lambda: get_page(client, 'diagnostics', url)
+
+def disagreements_scenario(ctx):
+    '''The first page of the task's disagreement queue.'''
+    client = client_as(ctx['admin_id'])
+    url = '/tasks/%d/diagnostics/tiebreaker' % ctx['task_id']
+    return lambda: get_page(client, 'disagreements', url)
+
+def rebuild_agreement_scenario(ctx):
+    '''Recomputing the task's cached agreement and disagreements from its codes.'''
+    @with_db(dbms)
+    def run(db):
+        agreement.rebuild(db, ctx['task_id'])
+    return run
+
+SCENARIOS = [('annotate_thread', annotate_thread_scenario),
+             ('submit_code', submit_code_scenario),
+             ('retrieve_thread', retrieve_thread_scenario),
+             ('diagnostics', diagnostics_scenario),
+             ('disagreements', disagreements_scenario),
+             ('rebuild_agreement', rebuild_agreement_scenario)]
+SCENARIO_NAMES = ['load'] + [name for name, _ in SCENARIOS]
+
+def measure_scenario(name, ctx, repeat):
+    '''Measure a scenario; its setup returns run, or (run, prepare) for a scenario with untimed preparation.'''
+    scenario = dict(SCENARIOS)[name](ctx)
+    run, prepare = scenario if isinstance(scenario, tuple) else (scenario, None)
+    return measure(run, repeat, prepare=prepare)
+
+def run_benchmarks(config, names=SCENARIO_NAMES, repeat=5):
+    '''Load and code a synthetic forum, then measure the named scenarios, each in its own process.
+
+    The load is always run, since the other scenarios need its data, but only timed
+    repeatedly if 'load' is named.'''
+    results = dict()
+    load = in_child('load', measure_load, config, repeat if 'load' in names else 1)
+    if 'load' in names:
+        results['load'] = load
+    ctx = in_child('codes', prepare_codes, config)
+    for name, _ in SCENARIOS:
+        if name in names:
+            print >> sys.stderr, "Measuring %s..." % name
+            results[name] = in_child(name, measure_scenario, name, ctx, repeat)
+    return results
+
+
+# Baselines
+
+def save_baseline(path, config, results):
+    with open(path, 'w') as f:
+        json.dump({'created_at': int(time.time()), 'config': config, 'results': results}, f, indent=2, sort_keys=True)
+
+def load_baseline(path):
+    with open(path) as f:
+        return json.load(f)
+
+def compare(baseline, config, results, tolerance=0.2):
+    '''Lines comparing results to a baseline, and the regressions among them.
+
+    Wall time and peak memory regress when they grow by more than tolerance (a share of
+    the baseline); query counts regress when they grow at all.'''
+    lines = list()
+    regressions = list()
+    if baseline['config'] != config:
+        lines.append("Warning: baseline was measured with different settings: %s" % json.dumps(baseline['config'], sort_keys=True))
+    for name in SCENARIO_NAMES:
+        if name not in results:
+            continue
+        old = baseline['results'].get(name)
+        if old is None:
+            lines.append("%-18s not in baseline" % name)
+            continue
+        for metric, label in METRICS:
+            new_value, old_value = results[name][metric], old[metric]
+            change = (new_value - old_value) / float(old_value) if old_value else 0.0
+            limit = 0 if metric == 'queries' else tolerance
+            flag = ''
+            if change > limit:
+                flag = 'REGRESSED'
+                regressions.append((name, metric))
+            lines.append("%-18s %-14s %12s -> %-12s %+7.1f%% %s" % (name, label, format_metric(old_value), format_metric(new_value), 100 * change, flag))
+    return lines, regressions
+
+def format_metric(value):
+    return "%.4f" % value if isinstance(value, float) else str(value)
+
+def report(results):
+    '''Lines summarizing results, one per scenario.'''
+    lines = ["%-18s %10s %10s %8s %14s" % ('scenario', 'median (s)', 'min (s)', 'queries', 'peak RSS (KB)')]
+    for name in SCENARIO_NAMES:
+        if name in results:
+            r = results[name]
+            lines.append("%-18s %10.4f %10.4f %8d %14d" % (name, r['wall_s'], r['wall_s_min'], r['queries'], r['peak_rss_kb']))
+    return lines
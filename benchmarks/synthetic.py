@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# synthetic.py
+# Synthetic forums and codes for benchmarking forum data annotator application.
+#
+# Author: Alex Kindel
+# Date: 19 July 2016
+
+import random
+import time
+from csv import DictWriter
+from itertools import chain
+
+from werkzeug import generate_password_hash
+
+import agreement
+from assign import assign_balanced
+from dbutils import query, insert_many, transaction
+from loader import ROW_COLS
+
+
+WORDS = ('the a of to and in that is it for on was with as be this have not are but you they at or '
+         'forum course week answer question problem lecture quiz thanks anyone think really agree '
+         'point example video reading exam grade help understand idea post reply comment').split()
+EMOJI = [u'\U0001F600', u'\U0001F44D', u'\U0001F914', u'\U0001F525', u'\u2764\ufe0f', u'\U0001F389']
+START_TIME = 1451606400  # 2016-01-01, so generated timestamps don't depend on when they were made
+CODE_OPTIONS = ['agree', 'disagree', 'question', 'answer', 'other']
+CODE_COLS = ['user_id', 'post_id', 'assn_id', 'code_value', 'targets', 'comment']
+BENCH_PASSWORD = 'bench'
+DEFAULT_CONFIG = {'threads': 200, 'fanout': 4, 'depth': 2, 'body_words': 60, 'emoji_share': 0.05, 'seed': 0,
+                  'coders': 4, 'k': 2, 'agreement_rate': 0.8, 'progress': 0.5, 'processes': 1, 'writers': 0}
+
+
+# Forum corpus
+
+def text(rng, words, emoji_share):
+    '''About words words of filler, UTF-8 encoded; with probability emoji_share, with emoji in it.'''
+    body = [rng.choice(WORDS) for _ in range(max(1, int(rng.uniform(0.5, 1.5) * words)))]
+    if rng.random() < emoji_share:
+        for _ in range(rng.randint(1, 3)):
+            body.insert(rng.randint(0, len(body)), rng.choice(EMOJI))
+    return u' '.join(body).encode('UTF-8')
+
+def timestamp(epoch):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(epoch))
+
+def synthetic_thread(rng, n, prefix='bench', fanout=4, depth=2, body_words=60, emoji_share=0.05, authors=1000):
+    '''Rows in forum CSV layout for one thread, in coding order, top-level post first.
+
+    The thread gets between 1 and 2 * fanout main replies, and every post fewer than depth
+    levels below the top-level post gets between 0 and fanout replies of its own.'''
+    mongoid = "%s-t%06d" % (prefix, n)
+    created = START_TIME + n * 3600
+    posts = list()
+
+    def post(parent, level):
+        post_id = "%s-p%06d-%04d" % (prefix, n, len(posts))
+        author = rng.randint(1, authors)
+        stamp = timestamp(created + 60 * (len(posts) + 1))
+        posts.append({'X_type': 'Comment', 'mongoid': post_id, 'comment_thread_id': mongoid,
+                      'parent_ids': parent or '', 'level': str(level), 'author_id': str(author),
+                      'author_username': "user%d" % author, 'body': text(rng, body_words, emoji_share),
+                      'created_at': stamp, 'updated_at': stamp, 'title': '', 'comment_count': '0'})
+        if level <= depth:
+            for _ in range(rng.randint(0, fanout)):
+                post(post_id, level + 1)
+
+    for _ in range(rng.randint(1, 2 * fanout)):
+        post(None, 2)
+
+    author = rng.randint(1, authors)
+    thread = {'X_type': 'CommentThread', 'mongoid': mongoid, 'comment_thread_id': '', 'parent_ids': '',
+              'level': '1', 'author_id': str(author), 'author_username': "user%d" % author,
+              'body': text(rng, body_words, emoji_share), 'created_at': timestamp(created),
+              'updated_at': timestamp(created), 'title': text(rng, 8, emoji_share),
+              'comment_count': str(len(posts))}
+    return [thread] + posts
+
+def synthetic_threads(threads=200, seed=0, **params):
+    '''Generate threads (lists of rows, see synthetic_thread); the same seed gives the same forum.'''
+    rng = random.Random(seed)
+    for n in xrange(threads):
+        yield synthetic_thread(rng, n, **params)
+
+def synthetic_rows(threads=200, seed=0, **params):
+    return chain.from_iterable(synthetic_threads(threads, seed, **params))
+
+def write_csv(rows, path):
+    '''Write forum rows as a CSV export; returns the number of rows written.'''
+    n = 0
+    with open(path, 'wb') as f:
+        writer = DictWriter(f, ROW_COLS)
+        writer.writeheader()
+        for n, row in enumerate(rows, 1):
+            writer.writerow(row)
+    return n
+
+
+# Coders and codes
+
+def create_users(db, prefix, coders):
+    '''A superuser and coders users named after prefix; returns (admin id, coder ids).'''
+    pass_hash = generate_password_hash(BENCH_PASSWORD)
+    ids = list()
+    for n, name in enumerate(['admin'] + ['coder%d' % i for i in range(1, coders + 1)]):
+        query(db, "INSERT INTO users(username, first_name, last_name, email, pass_hash, superuser) VALUES (%s, %s, %s, %s, %s, %s)",
+              args=["%s-%s" % (prefix, name), name.capitalize(), prefix.capitalize(), "%s-%s@example.com" % (prefix, name), pass_hash, int(n == 0)])
+        ids.append(query(db, "SELECT LAST_INSERT_ID() AS id").next()['id'])
+    return ids[0], ids[1:]
+
+def create_task(db, prefix, options=CODE_OPTIONS):
+    query(db, "INSERT INTO tasks(title, label, display, prompt, type, options, restrictions, allow_comments) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)",
+          args=["%s task" % prefix, prefix, 'cumthread', "What is this post doing?", 'singlelist',
+                '||'.join(options), '||'.join(['_'] * len(options)), 0])
+    return query(db, "SELECT LAST_INSERT_ID() AS id").next()['id']
+
+def synthetic_codes(db, coders=4, k=2, agreement_rate=0.8, progress=0.5, seed=0, prefix='bench', options=CODE_OPTIONS):
+    '''Create a task coded by a pool of synthetic coders over every loaded thread.
+
+    Threads are assigned k coders each with assign_balanced. Each coder codes the first
+    progress share of their thread's posts, giving a post's reference code with probability
+    agreement_rate and a different code otherwise, so pairs agree on a little more than
+    agreement_rate ** 2 of posts. Agreement caches are rebuilt afterwards.
+
+    Returns the task_id, the superuser's id, and the coders' ids.'''
+    rng = random.Random(seed)
+    admin_id, coder_ids = create_users(db, prefix, coders)
+    task_id = create_task(db, prefix, options)
+    assign_balanced(db, task_id, coder_ids, k)
+
+    positions = dict()  # thread_id -> post_ids in coding order, from position 1
+    for row in query(db, "SELECT thread_id, position, post_id FROM post_positions WHERE position > 0 ORDER BY thread_id, position"):
+        positions.setdefault(row['thread_id'], []).append(row['post_id'])
+    reference = dict()
+
+    codes = list()
+    pointers = list()
+    assignments = query(db, "SELECT assn_id, user_id, thread_id FROM assignments WHERE task_id = %d ORDER BY assn_id" % task_id, fetchall=True)
+    for assn in assignments:
+        posts = positions.get(assn['thread_id'], [])
+        coded = int(round(progress * len(posts)))
+        for post_id in posts[:coded]:
+            if post_id not in reference:
+                reference[post_id] = rng.choice(options)
+            code = reference[post_id]
+            if rng.random() >= agreement_rate:
+                code = rng.choice([o for o in options if o != code])
+            codes.append((assn['user_id'], post_id, assn['assn_id'], code, '', ''))
+        if coded:
+            finished = coded == len(posts)
+            position = coded if finished else coded + 1
+            pointers.append((position, posts[position - 1], int(finished), assn['assn_id']))
+
+    with transaction(db):
+        insert_many(db, 'codes', CODE_COLS, codes)
+        db.executemany("UPDATE assignments SET done = %s, next_post_id = %s, finished = %s WHERE assn_id = %s", pointers)
+    agreement.rebuild(db, task_id)
+    return task_id, admin_id, coder_ids
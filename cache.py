@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# cache.py
+# In-process caches for forum data annotator application.
+#
+# Author: Alex Kindel
+# Date: 19 July 2016
+
+import sys
+import time
+import threading
+from collections import OrderedDict
+
+
+def approx_size(value):
+    '''Approximate memory footprint of a value in bytes, following dicts, lists and tuples.'''
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(approx_size(k) + approx_size(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(approx_size(v) for v in value)
+    return size
+
+
+class LRUCache(object):
+    '''Thread-safe least-recently-used cache bounded by the total size of its entries.
+
+    Each entry is stored with its size in bytes; least recently used entries are evicted
+    until the total fits in max_bytes. An entry larger than max_bytes is not cached.
+    With a ttl, entries also expire that many seconds after they are put.'''
+
+    def __init__(self, max_bytes, ttl=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (value, size, expiry time), most recently used last
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[2] is not None and entry[2] < time.time():
+                self.size -= entry[1]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size=None):
+        if size is None:
+            size = approx_size(value)
+        expires = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            self._discard(key)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, size, expires)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= evicted[1]
+
+    def invalidate(self, key):
+        with self._lock:
+            self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
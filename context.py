@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# context.py
+# Thread context trees for forum data annotator application.
+#
+# Author: Alex Kindel
+# Date: 19 July 2016
+
+from collections import defaultdict
+
+from cache import approx_size
+
+
+class ThreadContext(object):
+    '''All posts of a thread indexed by post_id, position and parent, for slicing out coding context.
+
+    Posts are rows of posts joined with post_positions. loaded_at is the thread's load
+    stamp when they were read; a cached context is stale once the stamp in the threads
+    table moves on. Each post is stamped with it too, so output cached per post can tell
+    a reloaded post from an earlier one that had the same post_id.'''
+
+    def __init__(self, posts, loaded_at=0):
+        self.loaded_at = loaded_at
+        self.posts = dict()
+        self.positions = dict()
+        self.children = defaultdict(list)  # parent_post_id -> post_ids, in coding order
+        self.top = None
+        for post in sorted(posts, key=lambda p: p['position']):
+            post['loaded_at'] = loaded_at
+            self.posts[post['post_id']] = post
+            self.positions[post['position']] = post
+            self.children[post['parent_post_id']].append(post['post_id'])
+            if post['depth'] == 0 and self.top is None:
+                self.top = post
+        self.size = approx_size(posts)
+
+    def at(self, position):
+        '''Post at a coding-order position, or None past either end.'''
+        return self.positions.get(int(position))
+
+    def context(self, next_post_id):
+        '''Top-level post, posts shown in context, and the post to code.
+
+        Context is the next post's main reply, then earlier comments on that reply.'''
+        next_post = self.posts[int(next_post_id)]
+        parent_id = next_post['parent_post_id']
+        prev = list()
+        if parent_id in self.posts:
+            prev.append(self.posts[parent_id])
+        for post_id in self.children.get(parent_id, []):
+            post = self.posts[post_id]
+            if post['position'] >= next_post['position']:
+                break
+            if post['depth'] > 1:
+                prev.append(post)
+        return self.top, prev, next_post
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# dataset.py
+# Compiled columnar forum datasets for forum data annotator application.
+#
+# Author: Alex Kindel
+# Date: 19 July 2016
+
+import json
+import mmap
+import os
+import struct
+import tempfile
+from array import array
+from csv import DictReader
+
+import numpy as np
+
+from loader import to_epoch, to_int, to_text
+
+
+# File layout: MAGIC, header length (uint64), JSON header, then 8-byte aligned column
+# arrays and one blob holding every string field, row after row in STR_COLS order.
+# String field k of row i spans offsets[i * len(STR_COLS) + k] up to the next offset.
+MAGIC = 'FORUMCOL1\n'
+COMPILED_SUFFIX = '.col'
+INT_COLS = [('level', '<i2', to_int), ('author_id', '<i8', to_int), ('comment_count', '<i4', to_int),
+            ('created_at', '<i8', to_epoch), ('updated_at', '<i8', to_epoch)]
+STR_COLS = ['X_type', 'mongoid', 'comment_thread_id', 'parent_ids', 'author_username', 'title', 'body']
+
+
+# Compiling
+
+def source_stamp(path):
+    '''Size and modification time of a source file, to tell whether a compiled copy is current.'''
+    st = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': st.st_size, 'mtime': int(st.st_mtime)}
+
+def compile_rows(rows, path, source=None):
+    '''Write forum CSV rows to a compiled file at path, converting every field once.
+
+    Returns the number of rows written.'''
+    ints = dict((name, array('l')) for name, _, _ in INT_COLS)
+    offsets = array('l', [0])
+    blob = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(path)))
+    offset = 0
+    n = 0
+    for row in rows:
+        for name, _, convert in INT_COLS:
+            ints[name].append(convert(row.get(name, '')))
+        for name in STR_COLS:
+            value = to_text(row.get(name) or '').encode('UTF-8')
+            blob.write(value)
+            offset += len(value)
+            offsets.append(offset)
+        n += 1
+
+    columns = [(name, np.array(ints[name], dtype=dtype)) for name, dtype, _ in INT_COLS]
+    columns.append(('offsets', np.array(offsets, dtype='<i8')))
+
+    header = {'rows': n, 'source': source, 'columns': dict(), 'blob': None}
+    position = 0
+    for name, values in columns:
+        header['columns'][name] = {'dtype': values.dtype.str, 'offset': position, 'count': len(values)}
+        position += align(values.nbytes)
+    header['blob'] = {'offset': position, 'size': offset}
+
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        encoded = json.dumps(header)
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(encoded)))
+        f.write(encoded)
+        f.write('\0' * (align(f.tell()) - f.tell()))
+        for name, values in columns:
+            f.write(values.tostring())
+            f.write('\0' * (align(values.nbytes) - values.nbytes))
+        blob.seek(0)
+        while True:
+            chunk = blob.read(1 << 20)
+            if not chunk:
+                break
+            f.write(chunk)
+    blob.close()
+    os.rename(tmp, path)  # Readers never see a partial file
+    return n
+
+def align(size, to=8):
+    return (size + to - 1) // to * to
+
+
+# Reading
+
+class CompiledRow(object):
+    '''One row of a compiled dataset, read like a CSV DictReader row.'''
+    __slots__ = ['data', 'i']
+
+    def __init__(self, data, i):
+        self.data = data
+        self.i = i
+
+    def __getitem__(self, name):
+        return self.data.value(name, self.i)
+
+    def get(self, name, default=None):
+        if name in self.data.names:
+            return self[name]
+        return default
+
+class CompiledData(object):
+    '''Memory-mapped view of a compiled dataset.
+
+    Columns are numpy arrays over the mapped file; string fields are sliced out of the
+    blob only when read.'''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            raise ValueError("%s is not a compiled dataset." % path)
+        size, = struct.unpack('<Q', self.map[len(MAGIC):len(MAGIC) + 8])
+        start = len(MAGIC) + 8
+        self.header = json.loads(self.map[start:start + size])
+        base = align(start + size)
+        self.rows = self.header['rows']
+        self.columns = dict()
+        for name, col in self.header['columns'].items():
+            self.columns[name] = np.frombuffer(self.map, dtype=col['dtype'], count=col['count'], offset=base + col['offset'])
+        self.offsets = self.columns.pop('offsets')
+        self.blob = base + self.header['blob']['offset']
+        self.strings = dict((name, k) for k, name in enumerate(STR_COLS))
+        self.names = set(self.columns) | set(self.strings)
+
+    def value(self, name, i):
+        if name in self.columns:
+            return int(self.columns[name][i])
+        k = i * len(STR_COLS) + self.strings[name]
+        return self.map[self.blob + int(self.offsets[k]):self.blob + int(self.offsets[k + 1])]
+
+    def __len__(self):
+        return self.rows
+
+    def __iter__(self):
+        for i in xrange(self.rows):
+            yield CompiledRow(self, i)
+
+    def current(self, source):
+        '''Was this dataset compiled from source as it is now?'''
+        return self.header['source'] == source_stamp(source)
+
+    def close(self):
+        self.columns = dict()
+        self.offsets = None
+        self.map.close()
+
+def compiled_path(path):
+    return path + COMPILED_SUFFIX
+
+def is_compiled(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def open_dataset(path):
+    '''Compiled data for path: path itself if it is compiled, or its compiled copy if current.
+
+    Returns None if only the CSV can be used.'''
+    if is_compiled(path):
+        return CompiledData(path)
+    compiled = compiled_path(path)
+    if os.path.exists(compiled):
+        data = CompiledData(compiled)
+        if data.current(path):
+            return data
+        data.close()
+    return None
+
+def read_rows(path):
+    '''Rows of a CSV export, read from its compiled copy when that is current.'''
+    data = open_dataset(path)
+    if data is None:
+        with open(path) as f:
+            for row in DictReader(f):
+                yield row
+        return
+    print "Reading compiled data from %s." % data.path
+    try:
+        for row in data:
+            yield row
+    finally:
+        data.close()
@@ -0,0 +1,440 @@
+#!/usr/bin/env python
+# dbutils.py
+# Database connection utilities for forum data annotator application.
+#
+# Author: Alex Kindel
+# Date: 19 July 2016
+
+import os
+import sqlite3
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import g, has_app_context, current_app
+
+import sqlite_backend
+import metrics
+
+try:
+    import MySQLdb
+    import MySQLdb.cursors
+except ImportError:
+    MySQLdb = None  # Only the SQLite backend is available
+
+
+# Pool configuration (override with configure_pool or init_app)
+DEV_INSTANCE = True
+POOL_SIZE = 10        # Maximum open connections per database config, per process
+POOL_TIMEOUT = 10     # Seconds to wait for a free connection before giving up
+POOL_MAX_IDLE = 300   # Seconds an unused connection may sit in the pool
+POOL_PING_AFTER = 30  # Seconds of idleness after which a connection is pinged before reuse
+
+# Statements aborted by InnoDB for lock contention, retried by retry_on_lock
+LOCK_ERRORS = [1205, 1213]  # Lock wait timeout, deadlock
+LOCK_RETRIES = 3            # Attempts in all
+LOCK_BACKOFF = 0.01         # Seconds before the first retry, doubling after each
+
+# Errors raised by either backend
+DatabaseError = (sqlite3.Error,) + ((MySQLdb.Error,) if MySQLdb else ())
+OperationalError = (sqlite3.OperationalError,) + ((MySQLdb.OperationalError,) if MySQLdb else ())
+
+
+class Database(object):
+    '''Context manager yielding cursors on a single database connection.'''
+
+    def __init__(self, username=None, password=None, db=None, host='127.0.0.1', port=3306, connection=None, backend='mysql', path=None):
+        self.username = username
+        self.password = password
+        self.db = db
+        self.pooled = connection is not None
+        if self.pooled:
+            self.connection = connection
+        else:
+            self.connection = connect(username, password, db, host, port, backend, path)
+        self.cursors = []
+
+    def __enter__(self):
+        curs = self.connection.cursor()
+        self.cursors.append(curs)
+        return curs
+
+    def __exit__(self, *args):
+        for cursor in self.cursors:
+            cursor.close()
+        self.cursors = []
+        if not self.pooled:
+            self.connection.close()
+
+
+def connect(username=None, password=None, db=None, host='127.0.0.1', port=3306, backend='mysql', path=None):
+    '''Open a new autocommitting connection returning rows as dicts, with text as unicode.
+
+    A database config picks its backend: MySQL by default, or with backend 'sqlite',
+    the SQLite file at path.'''
+    if backend == 'sqlite':
+        return sqlite_backend.connect(path)
+    if MySQLdb is None:
+        raise ImportError("MySQL-python is needed for a MySQL database; set DB_BACKEND=sqlite to use SQLite.")
+    connection = MySQLdb.connect(host=host, port=port, user=username, passwd=password, db=db,
+                                 charset='utf8mb4', use_unicode=True,  # 4-byte UTF-8 characters, e.g. emoji
+                                 cursorclass=MySQLdb.cursors.DictCursor)
+    connection.autocommit(True)
+    return connection
+
+
+class PoolExhausted(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+class ConnectionPool(object):
+    '''Bounded, thread-safe pool of database connections.
+
+    Connections idle for longer than max_idle are closed rather than reused, and
+    connections idle for longer than ping_after are pinged before being handed out.
+    The pool forgets (without closing) connections inherited across a fork, since
+    their sockets belong to the parent process.'''
+
+    def __init__(self, dbcfg, maxsize=None, timeout=None, max_idle=None, ping_after=None):
+        self.dbcfg = dict(dbcfg)
+        self.maxsize = maxsize or POOL_SIZE
+        self.timeout = timeout or POOL_TIMEOUT
+        self.max_idle = max_idle or POOL_MAX_IDLE
+        self.ping_after = ping_after or POOL_PING_AFTER
+        self._lock = threading.Condition(threading.Lock())
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = deque()  # (connection, last used) pairs, most recently used on the right
+        self._size = 0        # Connections checked out plus idle
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            self._reset()
+
+    def _evict_idle(self, now):
+        while self._idle and now - self._idle[0][1] > self.max_idle:
+            conn, _ = self._idle.popleft()
+            self._size -= 1
+            _close_quietly(conn)
+
+    def acquire(self):
+        '''Check out a healthy connection, opening one if the pool has room.'''
+        deadline = time.time() + self.timeout
+        with self._lock:
+            while True:
+                self._check_fork()
+                now = time.time()
+                self._evict_idle(now)
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    if now - last_used > self.ping_after and not _is_alive(conn):
+                        self._size -= 1
+                        _close_quietly(conn)
+                        continue
+                    return conn
+                if self._size < self.maxsize:
+                    self._size += 1
+                    break
+                remaining = deadline - now
+                if remaining <= 0:
+                    raise PoolExhausted("No free connection after %d seconds (pool size %d)." % (self.timeout, self.maxsize))
+                self._lock.wait(remaining)
+
+        # Connect outside the lock so slow handshakes don't block other threads
+        try:
+            return connect(**self.dbcfg)
+        except Exception:
+            with self._lock:
+                self._size -= 1
+                self._lock.notify()
+            raise
+
+    def release(self, conn, discard=False):
+        '''Return a connection to the pool, or close it if it is broken.'''
+        with self._lock:
+            if self._pid != os.getpid():
+                return  # Connection belongs to the parent process's pool
+            if discard:
+                self._size -= 1
+                _close_quietly(conn)
+            else:
+                self._idle.append((conn, time.time()))
+            self._lock.notify()
+
+    def close(self):
+        '''Close every idle connection.'''
+        with self._lock:
+            self._check_fork()
+            while self._idle:
+                conn, _ = self._idle.popleft()
+                self._size -= 1
+                _close_quietly(conn)
+
+
+def _is_alive(conn):
+    try:
+        conn.ping()
+        return True
+    except DatabaseError:
+        return False
+
+def _close_quietly(conn):
+    try:
+        conn.close()
+    except DatabaseError:
+        pass
+
+
+# Pool registry, one pool per database config
+_pools = dict()
+_pools_lock = threading.Lock()
+
+def _pool_key(dbcfg):
+    return tuple(sorted(dbcfg.items()))
+
+def get_pool(dbcfg):
+    '''Get (or create) the connection pool for this database config.'''
+    key = _pool_key(dbcfg)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(dbcfg)
+        return _pools[key]
+
+def configure_pool(maxsize=None, timeout=None, max_idle=None, ping_after=None):
+    '''Set pool parameters for pools created from now on.'''
+    global POOL_SIZE, POOL_TIMEOUT, POOL_MAX_IDLE, POOL_PING_AFTER
+    if maxsize is not None:
+        POOL_SIZE = maxsize
+    if timeout is not None:
+        POOL_TIMEOUT = timeout
+    if max_idle is not None:
+        POOL_MAX_IDLE = max_idle
+    if ping_after is not None:
+        POOL_PING_AFTER = ping_after
+
+
+# Request-scoped connections
+
+def _scoped_cursor(dbcfg):
+    '''Cursor on the connection checked out for the current app context, if any.'''
+    if not has_app_context() or 'dbutils' not in current_app.extensions:
+        return None
+    scoped = getattr(g, '_db_scoped', None)
+    if scoped is None:
+        scoped = g._db_scoped = dict()
+    key = _pool_key(dbcfg)
+    if key not in scoped:
+        conn = get_pool(dbcfg).acquire()
+        scoped[key] = (conn, conn.cursor())
+    return scoped[key][1]
+
+def release_db(exc=None):
+    '''Return connections held by the current app context to their pools.'''
+    scoped = getattr(g, '_db_scoped', None)
+    if not scoped:
+        return
+    g._db_scoped = dict()
+    for key, (conn, cursor) in scoped.items():
+        broken = False
+        try:
+            cursor.close()
+            if exc is not None:
+                conn.rollback()
+        except DatabaseError:
+            broken = True
+        get_pool(dict(key)).release(conn, discard=broken)
+
+def init_app(app):
+    '''Share one pooled connection per app context, profile its statements, and release it on teardown.'''
+    configure_pool(maxsize=app.config.get('DB_POOL_SIZE'),
+                   timeout=app.config.get('DB_POOL_TIMEOUT'),
+                   max_idle=app.config.get('DB_POOL_MAX_IDLE'))
+    app.extensions['dbutils'] = True
+    metrics.init_app(app)
+    app.teardown_appcontext(release_db)
+
+
+# Query interface (every statement is timed and recorded with metrics.record_query)
+
+def query(cursor, query, fetchall=False, args=None):
+    '''Run a query, with %s placeholders filled from args if given.'''
+    start = time.time()
+    cursor.execute(query, args)
+    results = cursor.fetchall()
+    metrics.record_query(query, time.time() - start, len(results))
+    if fetchall:
+        return results
+    else:
+        return (row for row in results)
+
+def stream(cursor, query, batch_size=1000, args=None):
+    '''Iterate over query results with a server-side cursor, holding one batch in memory.
+
+    Other queries on the same connection must wait until the results are exhausted.
+    Only time spent fetching is recorded, not time spent by the caller between batches.'''
+    curs = cursor.connection.cursor(MySQLdb.cursors.SSDictCursor if MySQLdb else None)
+    elapsed = 0.0
+    n = 0
+    try:
+        start = time.time()
+        curs.execute(query, args)
+        elapsed += time.time() - start
+        while True:
+            start = time.time()
+            rows = curs.fetchmany(batch_size)
+            elapsed += time.time() - start
+            if not rows:
+                break
+            n += len(rows)
+            for row in rows:
+                yield row
+    finally:
+        curs.close()
+        metrics.record_query(query, elapsed, n)
+
+def insert(cursor, table, cols, vals):
+    query = "INSERT INTO %s (`%s`) VALUES ('%s')" % (table, '`,`'.join(cols), "','".join(vals))
+    start = time.time()
+    status = cursor.execute(query)
+    metrics.record_query(query, time.time() - start, status)
+    return status
+
+def insert_many(cursor, table, cols, rows, batch_size=1000, ignore=False):
+    '''Insert rows (sequences ordered as cols) with one multi-row INSERT per batch.
+
+    With ignore, rows that would duplicate a unique key are skipped.'''
+    query = "INSERT %sINTO %s (`%s`) VALUES (%s)" % ("IGNORE " if ignore else "", table, '`,`'.join(cols), ','.join(['%s'] * len(cols)))
+    status = 0
+    batch = list()
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            status += _execute_batch(cursor, query, batch)
+            batch = list()
+    if batch:
+        status += _execute_batch(cursor, query, batch)
+    return status
+
+def _execute_batch(cursor, query, batch):
+    start = time.time()
+    status = cursor.executemany(query, batch)
+    metrics.record_query(query, time.time() - start, status)
+    return status
+
+@contextmanager
+def transaction(cursor):
+    '''Run the enclosed queries as one transaction, rolling back if they raise.'''
+    start = time.time()
+    cursor.execute("START TRANSACTION")
+    metrics.record_query("START TRANSACTION", time.time() - start)
+    try:
+        yield cursor
+    except Exception:
+        cursor.connection.rollback()
+        raise
+    start = time.time()
+    cursor.connection.commit()
+    metrics.record_query("COMMIT", time.time() - start)
+
+def retry_on_lock(fn, *args):
+    '''Call fn(*args), retrying if InnoDB aborts a statement for a deadlock or lock wait timeout.
+
+    Only for idempotent work run outside a transaction: each autocommitted statement
+    is rolled back alone, so the whole of fn can safely run again.'''
+    for attempt in range(LOCK_RETRIES):
+        try:
+            return fn(*args)
+        except OperationalError as e:
+            if e.args[0] not in LOCK_ERRORS or attempt == LOCK_RETRIES - 1:
+                raise
+            time.sleep(LOCK_BACKOFF * 2 ** attempt)
+
+def with_db(dbcfg):
+    '''Pass a database cursor as the first argument to the decorated function.
+
+    Inside a Flask app context every decorated call shares one pooled connection;
+    outside one, each call gets a pooled connection of its own.'''
+    def db_call(f):
+        @wraps(f)
+        def db_wrap(*args, **kwargs):
+            cursor = _scoped_cursor(dbcfg)
+            if cursor is not None:
+                return f(cursor, *args, **kwargs)
+            pool = get_pool(dbcfg)
+            conn = pool.acquire()
+            broken = False
+            try:
+                with Database(connection=conn, **dbcfg) as db:
+                    return f(db, *args, **kwargs)
+            except OperationalError:
+                broken = True
+                raise
+            finally:
+                pool.release(conn, discard=broken)
+        return db_wrap
+    return db_call
+
+
+# Instance management
+
+class InstanceException(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+def dev_only(f):
+    @wraps(f)
+    def dev_wrap(*args, **kwargs):
+        if DEV_INSTANCE:
+            return f(*args, **kwargs)
+        else:
+            raise InstanceException("Method is disabled for instances not in development.")
+    return dev_wrap
+
+
+if __name__ == "__main__":
+    # Run some tests
+    dbcfg = {'username': 'unittest', 'password': 'unittest', 'db': 'unittest'}
+
+    print "Testing query()"
+    with Database(**dbcfg) as db:
+        for result in query(db, "SELECT * FROM unittest.unittest"):
+            print result
+        assert result
+
+    print "Testing insert()"
+    with Database(**dbcfg) as db:
+        status = insert(db, table='unittest.unittest', cols=['b'], vals=['unittest'])
+        assert status
+
+    print "Testing @with_db"
+    @with_db(dbcfg)
+    def get_results(db, query_text):
+        for row in query(db, query_text):
+            print row
+    get_results("SELECT * FROM unittest.unittest")
+
+    print "Testing ConnectionPool"
+    pool = ConnectionPool(dbcfg, maxsize=2, timeout=1)
+    c1 = pool.acquire()
+    c2 = pool.acquire()
+    try:
+        pool.acquire()
+        assert False
+    except PoolExhausted:
+        pass
+    pool.release(c1)
+    assert pool.acquire() is c1
+    pool.release(c1)
+    pool.release(c2)
+    pool.close()
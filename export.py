@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# export.py
+# Streaming export of annotation results for forum data annotator application.
+#
+# Author: Alex Kindel
+# Date: 19 July 2016
+
+import csv
+import json
+from collections import OrderedDict
+from cStringIO import StringIO
+from datetime import datetime, timedelta
+
+from dbutils import stream
+
+
+# Export queries
+
+EXPORT_TABLES = ['codes', 'tiebreakers']
+EXPORT_FORMATS = ['csv', 'jsonl']
+
+# Columns of every exported row, in output order
+EXPORT_COLS = ['code_id', 'coded_at', 'task_id', 'task_label', 'assn_id', 'user_id', 'username',
+               'thread_id', 'thread_title', 'post_id', 'post_mongoid', 'author_username', 'level',
+               'parent_post_id', 'post_created_at', 'code_value', 'targets', 'comment']
+BODY_COLS = ['post_body']
+
+EXPORT_Q = """SELECT c.code_id, c.coded_at, a.task_id, k.label AS task_label, c.assn_id, c.user_id, u.username,
+                     a.thread_id, t.title AS thread_title, c.post_id, p.mongoid AS post_mongoid, p.author_username,
+                     p.level, p.parent_post_id, p.created_at AS post_created_at, c.code_value, c.targets, c.comment%s
+              FROM %s c
+              JOIN assignments a ON c.assn_id = a.assn_id
+              JOIN tasks k ON a.task_id = k.task_id
+              JOIN threads t ON a.thread_id = t.thread_id
+              JOIN posts p ON c.post_id = p.post_id
+              JOIN users u ON c.user_id = u.id
+              WHERE %s
+              ORDER BY c.code_id"""
+
+def parse_date(value):
+    '''Parse a YYYY-MM-DD date filter, raising ValueError on anything else.'''
+    return datetime.strptime(value, '%Y-%m-%d')
+
+def export_query(table, task_id=None, thread_id=None, since=None, until=None, bodies=False):
+    '''Build the export query and its arguments for codes or tiebreakers.
+
+    since and until are YYYY-MM-DD dates on coded_at; until is inclusive.'''
+    if table not in EXPORT_TABLES:
+        raise ValueError("Cannot export %s; choose one of %s." % (table, ', '.join(EXPORT_TABLES)))
+    where = ['1 = 1']
+    args = list()
+    if task_id is not None:
+        where.append("a.task_id = %s")
+        args.append(int(task_id))
+    if thread_id is not None:
+        where.append("a.thread_id = %s")
+        args.append(int(thread_id))
+    if since:
+        where.append("c.coded_at >= %s")
+        args.append(parse_date(since))
+    if until:
+        where.append("c.coded_at < %s")
+        args.append(parse_date(until) + timedelta(days=1))
+    body = ", p.body AS post_body" if bodies else ""
+    return EXPORT_Q % (body, table, ' AND '.join(where)), args
+
+def export_rows(db, table, batch_size=1000, **filters):
+    '''Stream export rows from a server-side cursor.'''
+    q, args = export_query(table, **filters)
+    return stream(db, q, batch_size=batch_size, args=args)
+
+
+# Output formats
+
+CHUNK_BYTES = 64 * 1024  # Output is yielded in chunks of about this size
+
+def to_csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('UTF-8')
+    return str(value)
+
+def csv_lines(rows, cols, chunk_bytes=CHUNK_BYTES):
+    '''Yield a CSV header and rows, UTF-8 encoded, in chunks of about chunk_bytes.'''
+    buf = StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(cols)
+    for row in rows:
+        writer.writerow([to_csv_value(row[col]) for col in cols])
+        if buf.tell() >= chunk_bytes:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+def to_json_value(value):
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    return value
+
+def jsonl_lines(rows, cols, chunk_bytes=CHUNK_BYTES):
+    '''Yield one JSON object per row and line, in chunks of about chunk_bytes.'''
+    chunk = list()
+    size = 0
+    for row in rows:
+        line = json.dumps(OrderedDict((col, to_json_value(row[col])) for col in cols)) + '\n'
+        chunk.append(line)
+        size += len(line)
+        if size >= chunk_bytes:
+            yield ''.join(chunk)
+            chunk = list()
+            size = 0
+    yield ''.join(chunk)
+
+def export_lines(rows, fmt, bodies=False):
+    '''Format streamed export rows as CSV or JSON Lines.'''
+    cols = EXPORT_COLS + BODY_COLS if bodies else EXPORT_COLS
+    if fmt == 'csv':
+        return csv_lines(rows, cols)
+    elif fmt == 'jsonl':
+        return jsonl_lines(rows, cols)
+    raise ValueError("Cannot export as %s; choose one of %s." % (fmt, ', '.join(EXPORT_FORMATS)))
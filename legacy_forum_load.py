@@ -1,49 +1,53 @@
 #!/usr/bin/env python
+# legacy_forum_load.py
+# Load legacy thread-format forum exports through the annotator's loading pipeline.
+#
+# Usage: ./legacy_forum_load.py export.csv [export.csv ...]
+# Legacy exports hold one row per thread, in the columns of the old threads table
+# (mongoid, creator, title, body, comment_count, created_at, updated_at, pinned, ...);
+# their rows are converted to forum rows, and exports already in the forum layout can
+# be loaded alongside them. Otherwise the same as `flask load`: threads are ordered
+# across all CPUs and written on LOAD_WRITERS connections, and posts already loaded
+# (by mongoid) are skipped.
 
 import sys
-import time
 import os
-from csv import DictReader
-from dbutils import with_db, query
-
-def to_epoch(timestamp):
-    '''Convert post timestamp string to epoch time.'''
-    if not timestamp:
-        return "0"
-    else:
-        try:
-            return str(int(time.mktime(time.strptime(timestamp, '%Y-%m-%d %H:%M:%S.%f %Z'))))
-        except ValueError:
-            return str(int(time.mktime(time.strptime(timestamp, '%Y-%m-%d %H:%M:%S %Z'))))
-
-dbms = {'username': os.environ['DB_USER'],
-        'password': os.environ['DB_PASS'],
-        'db': os.environ['DB_NAME'],
-        'host': os.environ['DB_HOST'],
-        'port': int(os.environ['DB_PORT'])}
+from itertools import chain
+from multiprocessing import cpu_count
+
+from dbutils import with_db
+from dataset import read_rows
+from loader import BatchWriter, load_rows
+
+LOAD_WRITERS = 2
+
+LEGACY_COLUMNS = {'creator': 'author_username'}  # Old threads table columns named differently in forum rows
+THREAD_ROW = {'X_type': 'CommentThread', 'comment_thread_id': '', 'parent_ids': '', 'level': '1'}
+
+if os.environ.get('DB_BACKEND', 'mysql') == 'sqlite':
+    dbms = {'backend': 'sqlite',
+            'path': os.environ.get('DB_PATH', 'data/annotator.db')}
+else:
+    dbms = {'username': os.environ['DB_USER'],
+            'password': os.environ['DB_PASS'],
+            'db': os.environ['DB_NAME'],
+            'host': os.environ['DB_HOST'],
+            'port': int(os.environ['DB_PORT'])}
+
+def forum_row(row):
+    '''A legacy thread row as a forum row (top-level post of its thread); forum rows pass through.
+
+    Columns the forum layout doesn't have (pinned, anonymous, finished, upvotes) are dropped by the loader.'''
+    if row.get('X_type'):
+        return row
+    converted = dict((LEGACY_COLUMNS.get(col, col), value) for col, value in row.items())
+    converted.update(THREAD_ROW)
+    return converted
 
 @with_db(dbms)
-def load(db):
-    with open(sys.argv[1]) as t:
-        rows = DictReader(t)
-        rowct = 0
-        for row in rows:
-            row['body'] = row['body'].replace('"', '""')
-            row['title'] = row['title'].replace('"', '""')
-            row.pop('upvotes')
-            for key in row.keys():
-                if key not in ['created_at', 'updated_at', 'level', 'comment_count', 'author_id', 'finished', 'pinned', 'anonymous']:
-                    row[key] = '"%s"' % row[key]
-                elif row[key] in ['NA', '0', 'False']:
-                    row[key] = str(0)
-            if not row['pinned']:
-                row['pinned'] = str(0)
-            row['created_at'] = to_epoch(row['created_at'])
-            row['updated_at'] = to_epoch(row['updated_at'])
-            q = "INSERT INTO threads(%s) VALUES (%s)" % (','.join(row.keys()), ','.join(row.values()))
-            query(db, q)
-            rowct += 1
-        print "Loaded %d forum posts to annotator." % rowct
+def load(db, paths):
+    rows = (forum_row(row) for row in chain.from_iterable(read_rows(path) for path in paths))
+    load_rows(db, rows, processes=cpu_count(), writer=BatchWriter(dbms, LOAD_WRITERS))
 
 if __name__ == "__main__":
-    load()
+    load(sys.argv[1:])
@@ -0,0 +1,442 @@
+#!/usr/bin/env python
+# loader.py
+# Forum data loading for forum data annotator application.
+#
+# Author: Alex Kindel
+# Date: 19 July 2016
+
+import threading
+import time
+from collections import defaultdict, OrderedDict
+from itertools import count
+from multiprocessing import Pool
+from Queue import Queue
+
+from dbutils import query, insert_many, transaction, get_pool
+
+
+SHARD_ROWS = 5000  # Rows per shard handed to an ordering process
+ROW_COLS = ['X_type', 'mongoid', 'comment_thread_id', 'parent_ids', 'level', 'author_id', 'author_username',
+            'body', 'created_at', 'updated_at', 'title', 'comment_count']
+THREAD_COLS = ['thread_id', 'mongoid', 'creator', 'title', 'body', 'comment_count', 'first_post_id', 'loaded_at']
+POST_COLS = ['post_id', 'thread_id', 'mongoid', 'author_id', 'author_username', 'body', 'level', 'created_at', 'updated_at', 'parent_post_id']
+POSITION_COLS = ['thread_id', 'position', 'post_id', 'parent_post_id', 'depth']
+
+
+# Field conversion
+
+def to_epoch(timestamp):
+    '''Convert post timestamp string to epoch time; epoch times pass through.'''
+    if isinstance(timestamp, (int, long)):
+        return timestamp
+    if not timestamp or timestamp in ['NA', '0']:
+        return 0
+    for fmt in ['%Y-%m-%d %H:%M:%S.%f %Z', '%Y-%m-%d %H:%M:%S %Z', '%Y-%m-%d %H:%M:%S']:
+        try:
+            return int(time.mktime(time.strptime(timestamp, fmt)))
+        except ValueError:
+            continue
+    raise ValueError("Unrecognized timestamp: %s" % timestamp)
+
+def to_int(value):
+    '''Convert numeric CSV field to int; NA and False become 0, and ints pass through.'''
+    if not value or value in ['NA', 'False']:
+        return 0
+    return int(value)
+
+
+def to_text(value):
+    '''Decode UTF-8 CSV field to unicode, dropping undecodable bytes.'''
+    if isinstance(value, unicode):
+        return value
+    return value.decode('UTF-8', 'ignore')
+
+
+# Thread ordering
+
+def index_rows(rows):
+    '''Index forum rows by thread, main reply and parent in a single pass.'''
+    threads = list()
+    replies = defaultdict(list)   # Thread mongoid -> level 2 replies, in file order
+    children = defaultdict(list)  # Reply mongoid -> comments on that reply, in file order
+    for row in rows:
+        if row['X_type'] == "CommentThread":
+            threads.append(row)
+        elif to_int(row['level']) == 2:
+            replies[row['comment_thread_id']].append(row)
+        if row['parent_ids']:
+            children[row['parent_ids']].append(row)
+    return threads, replies, children
+
+def coding_order(mongoid, replies, children, thread=None):
+    '''Posts of a thread in coding order: top-level post, then each main reply followed by its comments.
+
+    Comments on comments follow their parent, as position_rows orders them.'''
+    ordered = [thread] if thread is not None else []
+    seen = set()
+    stack = list(reversed(replies.get(mongoid, [])))
+    while stack:
+        post = stack.pop()
+        if post['mongoid'] in seen:
+            continue  # Listed twice, or a reply to itself
+        seen.add(post['mongoid'])
+        ordered.append(post)
+        stack.extend(reversed(children.get(post['mongoid'], [])))
+    return ordered
+
+def position_rows(thread_id, posts):
+    '''Position table rows for a thread's posts (dicts with post_id, parent_post_id, level).
+
+    Rebuilds coding order from the reply structure: the top-level post, then each main
+    reply followed by its comments, with siblings in load (post_id) order.'''
+    posts = sorted(posts, key=lambda p: p['post_id'])
+    ids = set(p['post_id'] for p in posts)
+    top = [p for p in posts if p['level'] == 1][:1]
+    children = defaultdict(list)
+    replies = list()
+    for post in posts:
+        if top and post is top[0]:
+            continue
+        if post['parent_post_id'] in ids:
+            children[post['parent_post_id']].append(post)
+        else:
+            replies.append(post)  # Main replies have no parent post
+
+    rows = list()
+    first = 0 if top else 1  # Position 0 is reserved for the top-level post
+    stack = [(post, 1) for post in reversed(replies)] + [(post, 0) for post in top]
+    while stack:
+        post, depth = stack.pop()
+        rows.append((thread_id, first + len(rows), post['post_id'], post['parent_post_id'], depth))
+        stack.extend((child, depth + 1) for child in reversed(children[post['post_id']]))
+    return rows
+
+def reposition(db, thread_ids, batch_size=1000):
+    '''Rewrite the coding-order positions of existing threads and move assignment progress to match.'''
+    thread_ids = sorted(set(thread_ids))
+    for start in range(0, len(thread_ids), batch_size):
+        chunk = ','.join(str(int(t)) for t in thread_ids[start:start + batch_size])
+        posts = defaultdict(list)
+        for row in query(db, "SELECT thread_id, post_id, parent_post_id, level FROM posts WHERE thread_id IN (%s)" % chunk):
+            posts[row['thread_id']].append(row)
+        query(db, "DELETE FROM post_positions WHERE thread_id IN (%s)" % chunk)
+        insert_many(db, 'post_positions', POSITION_COLS, (row for t in sorted(posts) for row in position_rows(t, posts[t])), batch_size)
+
+        # Keep first posts and assignment pointers consistent with the new order, and expire cached context
+        query(db, "UPDATE threads SET loaded_at = UNIX_TIMESTAMP() WHERE thread_id IN (%s)" % chunk)
+        query(db, """UPDATE threads
+                     SET first_post_id = COALESCE((SELECT pp.post_id FROM post_positions pp
+                                                   WHERE pp.thread_id = threads.thread_id AND pp.position = 1), 0)
+                     WHERE thread_id IN (%s)""" % chunk)
+        query(db, """UPDATE assignments
+                     SET done = COALESCE((SELECT pp.position FROM post_positions pp WHERE pp.post_id = assignments.next_post_id), done)
+                     WHERE thread_id IN (%s)""" % chunk)
+
+
+# Sharding
+
+def thread_key(row):
+    '''Mongoid of the thread a row belongs to.'''
+    return row.get('mongoid', '') if row.get('X_type') == "CommentThread" else row.get('comment_thread_id', '')
+
+def shard_rows(rows, shard_size=SHARD_ROWS):
+    '''Group rows by thread, in order of each thread's first row, into shards of about shard_size rows.
+
+    Rows are copied to plain dicts of ROW_COLS, so shards can be sent to worker processes.'''
+    groups = OrderedDict()
+    for row in rows:
+        groups.setdefault(thread_key(row), []).append(dict((col, row.get(col, '')) for col in ROW_COLS))
+    shard = list()
+    size = 0
+    while groups:
+        mongoid, group = groups.popitem(last=False)
+        shard.append((mongoid, group))
+        size += len(group)
+        if size >= shard_size:
+            yield shard
+            shard = list()
+            size = 0
+    if shard:
+        yield shard
+
+def encode_row(row):
+    '''Convert a row's fields to the values written to the database.'''
+    encoded = dict(row)
+    for col in ['level', 'author_id', 'comment_count']:
+        encoded[col] = to_int(row[col])
+    for col in ['created_at', 'updated_at']:
+        encoded[col] = to_epoch(row[col])
+    for col in ['author_username', 'body', 'title']:
+        encoded[col] = to_text(row[col])
+    return encoded
+
+def order_shard(shard):
+    '''Put each thread of a shard in coding order, with fields converted.
+
+    Returns (mongoid, thread row or None, posts in coding order, leftovers) per thread,
+    where leftovers are comments whose parent is not among the thread's rows, e.g. one loaded earlier.'''
+    ordered = list()
+    for mongoid, rows in shard:
+        rows = [encode_row(row) for row in rows]
+        threads, replies, children = index_rows(rows)
+        thread = threads[0] if threads else None
+        posts = coding_order(mongoid, replies, children, thread)
+        emitted = set(row['mongoid'] for row in posts)
+        leftovers = [row for row in rows if row['parent_ids'] and row['parent_ids'] not in emitted and row['mongoid'] not in emitted]
+        ordered.append((mongoid, thread, posts, leftovers))
+    return ordered
+
+def map_shards(f, shards, processes=1):
+    '''Map f over shards in order, in a pool of processes if more than one.'''
+    if processes == 1:
+        for shard in shards:
+            yield f(shard)
+        return
+    pool = Pool(processes)
+    try:
+        for result in pool.imap(f, shards):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+# Loading
+
+class Progress(object):
+    '''Periodic rows/sec report for long loads.'''
+
+    def __init__(self, every=10000):
+        self.every = every
+        self.count = 0
+        self.start = time.time()
+
+    def tick(self):
+        self.count += 1
+        if self.count % self.every == 0:
+            self.report()
+
+    def report(self):
+        elapsed = max(time.time() - self.start, 1e-6)
+        print "Loaded %d posts (%d rows/sec)." % (self.count, self.count / elapsed)
+
+def write_batch(db, batch, batch_size=1000):
+    '''Write one batch of (new threads, thread updates, posts, positions) in a single transaction.'''
+    new_threads, thread_updates, posts, positions = batch
+    with transaction(db):
+        insert_many(db, 'threads', THREAD_COLS, new_threads, batch_size)
+        if thread_updates:
+            db.executemany("UPDATE threads SET comment_count = %s, first_post_id = %s, loaded_at = %s WHERE thread_id = %s", thread_updates)
+        insert_many(db, 'posts', POST_COLS, posts, batch_size)
+        insert_many(db, 'post_positions', POSITION_COLS, positions, batch_size)
+
+class BatchWriter(object):
+    '''Write Loader batches on a few connections of their own, in background threads.
+
+    Ids are assigned before batches are queued, so batches can commit in any order.
+    The queue is bounded, so a loader never runs more than a few batches ahead of the
+    database. The first write error is raised from the next submit() or from close().'''
+
+    def __init__(self, dbcfg, writers=2, batch_size=1000):
+        self.dbcfg = dbcfg
+        self.writers = writers
+        self.batch_size = batch_size
+        self.queue = Queue(maxsize=2 * writers)
+        self.threads = list()
+        self.error = None
+
+    def submit(self, batch):
+        if self.error is not None:
+            raise self.error
+        if not self.threads:
+            # Started on first use, after any ordering processes have been forked
+            for _ in range(self.writers):
+                thread = threading.Thread(target=self.run)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+        self.queue.put(batch)
+
+    def run(self):
+        pool = get_pool(self.dbcfg)
+        conn = pool.acquire()
+        cursor = conn.cursor()
+        try:
+            while True:
+                batch = self.queue.get()
+                if batch is None:
+                    break
+                if self.error is None:
+                    try:
+                        write_batch(cursor, batch, self.batch_size)
+                    except Exception as e:
+                        self.error = e
+        finally:
+            cursor.close()
+            pool.release(conn, discard=self.error is not None)
+
+    def close(self):
+        '''Wait for queued batches to be written.'''
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = list()
+        if self.error is not None:
+            raise self.error
+
+def next_id(db, table, column):
+    return query(db, "SELECT COALESCE(MAX(%s), 0) + 1 AS next_id FROM %s" % (column, table)).next()['next_id']
+
+class Loader(object):
+    '''Batched writer of forum threads and posts, keyed on mongoid.
+
+    Threads and posts already in the database are skipped, so a load can be re-run
+    over the same or an overlapping export. Each flush writes its threads and posts
+    in one transaction, so an interrupted load resumes cleanly from the batches written.
+    Every thread written or extended is stamped with the load time in loaded_at.
+
+    New threads get their coding-order positions as they are written; threads that
+    gained posts in an earlier load are repositioned from the database on finish.
+    With a BatchWriter, batches are written in the background on its connections.'''
+
+    def __init__(self, db, batch_size=1000, writer=None):
+        self.db = db
+        self.batch_size = batch_size
+        self.writer = writer
+
+        # Mongoids already loaded
+        self.known_threads = dict()  # Thread mongoid -> (thread_id, first_post_id)
+        for row in query(db, "SELECT thread_id, mongoid, first_post_id FROM threads"):
+            self.known_threads[row['mongoid']] = (row['thread_id'], row['first_post_id'])
+        self.known_posts = dict()  # Post mongoid -> post_id
+        for row in query(db, "SELECT post_id, mongoid FROM posts"):
+            self.known_posts[row['mongoid']] = row['post_id']
+
+        self.thread_ids = count(next_id(db, 'threads', 'thread_id'))
+        self.post_ids = count(next_id(db, 'posts', 'post_id'))
+        self.new_threads = list()
+        self.thread_updates = list()
+        self.posts = list()
+        self.positions = list()
+        self.recount = set()  # Existing threads extended without a fresh thread row
+        self.reposition = set()  # Existing threads extended by this load
+        self.skipped = 0
+        self.orphaned = 0
+        self.progress = Progress()
+        self.loaded_at = int(time.time())
+
+    def add_thread(self, mongoid, posts, thread=None):
+        '''Queue a thread's posts (in coding order) for writing, skipping posts already loaded.'''
+        known = self.known_threads.get(mongoid)
+        if known is None and thread is None:
+            self.orphaned += len(posts)  # Replies to a thread we have never seen
+            return
+        thread_id, first_post_id = known or (next(self.thread_ids), 0)
+
+        positions = list()
+        depth = dict()
+        for row in posts:
+            if row['mongoid'] in self.known_posts:
+                self.skipped += 1
+                continue
+            post_id = next(self.post_ids)
+            self.known_posts[row['mongoid']] = post_id  # Store mongoid-postid mapping
+            parent_post_id = self.known_posts.get(row['parent_ids'], -1)
+            if row is thread:
+                depth[post_id] = 0
+            else:
+                depth[post_id] = depth.get(parent_post_id, 0) + 1
+            positions.append((thread_id, len(positions), post_id, parent_post_id, depth[post_id]))
+            self.posts.append((post_id, thread_id, row['mongoid'], to_int(row['author_id']),
+                               to_text(row['author_username']), to_text(row['body']),
+                               to_int(row['level']), to_epoch(row['created_at']), to_epoch(row['updated_at']),
+                               parent_post_id))
+            self.progress.tick()
+
+        # Positions of a wholly new thread follow its coding order; anything else is rebuilt on finish
+        if known is None and len(positions) == len(posts):
+            self.positions.extend(positions)
+            first_post_id = positions[1][2] if len(positions) > 1 else 0  # Position 1 is the first post to code, if any
+        elif positions:
+            self.reposition.add(thread_id)
+
+        if thread is None:
+            self.recount.add(thread_id)
+        elif known is not None:
+            self.thread_updates.append((to_int(thread['comment_count']), first_post_id, self.loaded_at, thread_id))
+        else:
+            self.known_threads[mongoid] = (thread_id, first_post_id)
+            self.new_threads.append((thread_id, mongoid, to_text(thread['author_username']),
+                                     to_text(thread['title']), to_text(thread['body']),
+                                     to_int(thread['comment_count']), first_post_id, self.loaded_at))
+
+        if len(self.posts) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        '''Write queued threads with their posts and positions.'''
+        batch = (self.new_threads, self.thread_updates, self.posts, self.positions)
+        if self.writer is not None:
+            self.writer.submit(batch)
+        else:
+            write_batch(self.db, batch, self.batch_size)
+        self.new_threads = list()
+        self.thread_updates = list()
+        self.posts = list()
+        self.positions = list()
+
+    def finish(self):
+        '''Flush remaining rows, then recount and reposition threads that gained posts.'''
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+        if self.recount:
+            self.db.executemany("UPDATE threads SET comment_count = (SELECT count(*) - 1 FROM posts WHERE thread_id = %s), loaded_at = %s WHERE thread_id = %s",
+                                [(t, self.loaded_at, t) for t in sorted(self.recount)])
+        if self.reposition:
+            reposition(self.db, self.reposition, self.batch_size)
+        self.progress.report()
+        if self.skipped:
+            print "Skipped %d posts already loaded." % self.skipped
+        if self.orphaned:
+            print "Skipped %d posts in threads missing from the database and the input." % self.orphaned
+
+def load_rows(db, rows, batch_size=1000, processes=1, writer=None):
+    '''Load forum CSV rows into the threads and posts tables, appending to what is already loaded.
+
+    Rows are sharded by thread and put in coding order by a pool of processes; ids are
+    then assigned in shard order, so they do not depend on the number of processes.'''
+    loader = Loader(db, batch_size, writer)
+
+    # Threads present in the input
+    n = 0
+    extended = defaultdict(list)
+    for ordered in map_shards(order_shard, shard_rows(rows), processes):
+        for mongoid, thread, posts, leftovers in ordered:
+            if thread is not None:
+                loader.add_thread(mongoid, posts, thread)
+                n += 1
+            elif posts:
+                extended[mongoid].extend(posts)
+            leftovers = [row for row in leftovers if row['parent_ids'] in loader.known_posts]
+            if leftovers:
+                extended[mongoid].extend(leftovers)
+    print "Loaded %d threads to annotator." % n
+
+    # New replies and comments on threads loaded by an earlier run
+    for mongoid in sorted(extended.keys(), key=lambda m: loader.known_threads.get(m)):
+        loader.add_thread(mongoid, extended[mongoid])
+
+    loader.finish()
+
+def load_threads(db, threads, batch_size=1000, writer=None):
+    '''Load whole threads, each a list of forum rows in coding order starting with its top-level post.
+
+    Threads are written as they arrive, so a long stream of them never has to fit in memory.'''
+    loader = Loader(db, batch_size, writer)
+    n = 0
+    for n, posts in enumerate(threads, 1):
+        loader.add_thread(posts[0]['mongoid'], posts, posts[0])
+    print "Loaded %d threads to annotator." % n
+    loader.finish()
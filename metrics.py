@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# metrics.py
+# Query instrumentation and per-route latency metrics for forum data annotator application.
+#
+# Author: Alex Kindel
+# Date: 19 July 2016
+
+import bisect
+import logging
+import re
+import threading
+import time
+
+from flask import g, request, has_app_context
+
+
+# Instrumentation configuration (override with configure or init_app)
+SLOW_QUERY_MS = 250        # Statements taking longer are written to the slow-query log
+N_PLUS_ONE_THRESHOLD = 20  # More runs of one fingerprint in a single request are logged as a likely N+1
+MAX_FINGERPRINTS = 500     # Distinct statements totalled separately; later ones are pooled under OTHER
+SLOW_QUERY_TEXT = 1000     # Characters of a slow statement written to the log
+FINGERPRINT_CACHE_SIZE = 1024
+BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]  # Histogram bucket upper bounds; a last bucket holds the rest
+OTHER = '(other statements)'
+NO_ROUTE = '(outside requests)'
+UNMATCHED = '(unmatched URLs)'  # Requests no route handles (404s, 405s), pooled rather than named per URL
+
+log = logging.getLogger('annotator.queries')
+
+
+# Statement fingerprints: the statement with its values masked, so repeats of one query group together
+
+STRING = re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.)*\"")
+NUMBER = re.compile(r'(?<![\w$.])\d+(?:\.\d+)?\b')
+VALUE_LIST = re.compile(r'\b(IN|VALUES)\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', re.I)  # IN lists and VALUES rows of any length
+VALUE_LISTS = re.compile(r'\(\?\+\)(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))+')
+SPACE = re.compile(r'\s+')
+
+_fingerprints = dict()
+
+def fingerprint(statement):
+    '''The statement with literals and placeholders replaced by ?, lists of them by (?+), and whitespace collapsed.'''
+    fp = _fingerprints.get(statement)
+    if fp is None:
+        fp = STRING.sub('?', statement).replace('%s', '?')
+        fp = NUMBER.sub('?', fp)
+        fp = VALUE_LISTS.sub('(?+)', VALUE_LIST.sub(r'\1 (?+)', fp))
+        fp = SPACE.sub(' ', fp).strip()
+        if len(_fingerprints) >= FINGERPRINT_CACHE_SIZE:
+            _fingerprints.clear()  # Statements with values built in rarely repeat
+        _fingerprints[statement] = fp
+    return fp
+
+
+# Totals
+
+class Histogram(object):
+    '''Counts of durations in ms by bucket (see BUCKETS_MS), with their total and maximum.'''
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms):
+        self.counts[bisect.bisect_left(BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, p):
+        '''Upper bound of the bucket holding the p-th quantile (0 < p <= 1), at most the maximum.'''
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= p * self.count:
+                return min(BUCKETS_MS[i], self.max) if i < len(BUCKETS_MS) else self.max
+        return 0.0
+
+def bucket_labels():
+    return ["<= %d ms" % ms for ms in BUCKETS_MS] + ["> %d ms" % BUCKETS_MS[-1]]
+
+
+class RouteStats(object):
+    def __init__(self):
+        self.latency = Histogram()  # Whole request, in ms
+        self.db = Histogram()       # Time in statements per request, in ms
+        self.queries = 0
+        self.slow = 0
+        self.n_plus_one = 0         # Requests that ran some fingerprint more than N_PLUS_ONE_THRESHOLD times
+
+class StatementStats(object):
+    def __init__(self):
+        self.latency = Histogram()
+        self.rows = 0
+        self.routes = set()
+
+
+class Metrics(object):
+    '''Thread-safe totals of this process's requests by route and statements by fingerprint.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started_at = time.time()
+            self.routes = dict()
+            self.statements = dict()
+
+    def add_statement(self, fp, ms, rows, route):
+        with self._lock:
+            stats = self.statements.get(fp)
+            if stats is None:
+                if len(self.statements) >= MAX_FINGERPRINTS:
+                    fp = OTHER
+                stats = self.statements.setdefault(fp, StatementStats())
+            stats.latency.add(ms)
+            stats.rows += rows or 0
+            stats.routes.add(route or NO_ROUTE)
+
+    def add_request(self, route, ms, profile, repeated):
+        with self._lock:
+            stats = self.routes.get(route)
+            if stats is None:
+                stats = self.routes[route] = RouteStats()
+            stats.latency.add(ms)
+            stats.db.add(profile.db_ms)
+            stats.queries += profile.queries
+            stats.slow += profile.slow
+            stats.n_plus_one += bool(repeated)
+
+    def route_summary(self):
+        '''Per-route request counts, latency percentiles and histograms, slowest total first.'''
+        with self._lock:
+            routes = [{'route': route,
+                       'requests': s.latency.count,
+                       'mean_ms': s.latency.mean(),
+                       'p50_ms': s.latency.percentile(0.5),
+                       'p95_ms': s.latency.percentile(0.95),
+                       'max_ms': s.latency.max,
+                       'total_ms': s.latency.total,
+                       'queries': s.queries / float(s.latency.count),
+                       'db_ms': s.db.mean(),
+                       'slow': s.slow,
+                       'n_plus_one': s.n_plus_one,
+                       'histogram': list(s.latency.counts)} for route, s in self.routes.items()]
+        return sorted(routes, key=lambda r: -r['total_ms'])
+
+    def statement_summary(self, limit=50):
+        '''The limit statements taking the most time in total, with their counts, latencies, rows and routes.'''
+        with self._lock:
+            statements = [{'fingerprint': fp,
+                           'count': s.latency.count,
+                           'mean_ms': s.latency.mean(),
+                           'max_ms': s.latency.max,
+                           'total_ms': s.latency.total,
+                           'rows': s.rows / float(s.latency.count),
+                           'routes': sorted(s.routes)} for fp, s in self.statements.items()]
+        return sorted(statements, key=lambda s: -s['total_ms'])[:limit]
+
+registry = Metrics()
+
+
+# Per-request profiles
+
+class RequestProfile(object):
+    '''Statements run while handling one request, by fingerprint.'''
+
+    def __init__(self, route):
+        self.route = route
+        self.started_at = time.time()
+        self.queries = 0
+        self.db_ms = 0.0
+        self.slow = 0
+        self.runs = dict()  # fingerprint -> times run
+
+    def add(self, fp, ms, slow):
+        self.queries += 1
+        self.db_ms += ms
+        self.slow += slow
+        self.runs[fp] = self.runs.get(fp, 0) + 1
+
+    def repeated(self, threshold):
+        '''Fingerprints run more than threshold times, with their counts, most first.'''
+        return sorted(((fp, n) for fp, n in self.runs.items() if n > threshold), key=lambda r: -r[1])
+
+def record_query(statement, seconds, rows=None):
+    '''Account for one statement: counted for the app context (g.query_count), added to its
+    fingerprint's totals and the current request's profile, and logged if slow.'''
+    ms = seconds * 1000
+    fp = fingerprint(statement)
+    slow = ms > SLOW_QUERY_MS
+    route = None
+    if has_app_context():
+        g.query_count = g.get('query_count', 0) + 1
+        profile = g.get('query_profile')
+        if profile is not None:
+            profile.add(fp, ms, slow)
+            route = profile.route
+    registry.add_statement(fp, ms, rows, route)
+    if slow:
+        log.warning("Slow query: %.1f ms, %s rows, %s: %s", ms, '?' if rows is None else rows,
+                    route or NO_ROUTE, SPACE.sub(' ', statement)[:SLOW_QUERY_TEXT])
+
+def start_request():
+    g.query_profile = RequestProfile(request.endpoint or UNMATCHED)
+
+def finish_request(response):
+    '''Summarize the request's statements in its headers, warn of repeated ones, and add it to its route's totals.
+
+    Statements run while a streamed response is sent come after this, so they are
+    only in the statement totals.'''
+    profile = g.pop('query_profile', None)
+    if profile is None:
+        return response
+    ms = (time.time() - profile.started_at) * 1000
+    response.headers['X-Query-Count'] = str(profile.queries)
+    response.headers['X-DB-Time'] = '%.2f' % profile.db_ms
+    response.headers['Server-Timing'] = 'db;dur=%.2f;desc="%d queries", app;dur=%.2f' % (profile.db_ms, profile.queries, ms)
+    repeated = profile.repeated(N_PLUS_ONE_THRESHOLD)
+    for fp, n in repeated:
+        log.warning("Likely N+1 query: %d runs in one request to %s: %s", n, profile.route, fp)
+    if profile.route != 'static':
+        registry.add_request(profile.route, ms, profile, repeated)
+    return response
+
+
+# Configuration
+
+def configure(slow_query_ms=None, n_plus_one_threshold=None):
+    '''Set the slow-query threshold (ms) and the runs of one statement per request that warn of an N+1.'''
+    global SLOW_QUERY_MS, N_PLUS_ONE_THRESHOLD
+    if slow_query_ms is not None:
+        SLOW_QUERY_MS = slow_query_ms
+    if n_plus_one_threshold is not None:
+        N_PLUS_ONE_THRESHOLD = n_plus_one_threshold
+
+def init_app(app):
+    '''Profile each request's statements, writing warnings to SLOW_QUERY_LOG (a file) or stderr.'''
+    configure(slow_query_ms=app.config.get('SLOW_QUERY_MS'),
+              n_plus_one_threshold=app.config.get('N_PLUS_ONE_THRESHOLD'))
+    if not log.handlers:
+        path = app.config.get('SLOW_QUERY_LOG')
+        handler = logging.FileHandler(path) if path else logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(process)d] %(message)s'))
+        log.addHandler(handler)
+        log.setLevel(logging.WARNING)
+        log.propagate = False
+    app.before_request(start_request)
+    app.after_request(finish_request)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# migrate.py
+# Versioned schema migrations for forum data annotator application.
+#
+# Author: Alex Kindel
+# Date: 19 July 2016
+
+import os
+import re
+import time
+
+from dbutils import query, DatabaseError, OperationalError
+
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sql', 'migrations')
+MIGRATION_FILE = re.compile(r'^(\d+)_(\w+)\.sql$')
+ALREADY_APPLIED = [1060, 1061]  # Duplicate column name, duplicate key name
+
+# Hot-path queries to EXPLAIN and time, filled in with a sample assignment and comment
+CORE_QUERIES = [
+    ("user login", "SELECT id, pass_hash FROM users WHERE username = '{username}'"),
+    ("user assignments", "SELECT assn_id, thread_id FROM assignments WHERE user_id = {user_id}"),
+    ("assignment lookup", "SELECT assn_id FROM assignments WHERE thread_id = {thread_id} AND user_id = {user_id} AND task_id = {task_id}"),
+    ("thread stamp", "SELECT loaded_at FROM threads WHERE thread_id = {thread_id}"),
+    ("thread context", "SELECT p.*, pp.position, pp.depth FROM post_positions pp JOIN posts p ON pp.post_id = p.post_id WHERE pp.thread_id = {thread_id}"),
+    ("next post", "SELECT post_id FROM post_positions WHERE thread_id = {thread_id} AND position = {done}"),
+    ("existing code", "SELECT code_id FROM codes WHERE post_id = {post_id} AND user_id = {user_id} AND assn_id = {assn_id}"),
+    ("post by mongoid", "SELECT post_id FROM posts WHERE mongoid = '{mongoid}'"),
+]
+
+
+# Migration files
+
+def available():
+    '''List (version, name, path) for each migration file, in version order.'''
+    migrations = list()
+    for filename in os.listdir(MIGRATIONS_DIR):
+        match = MIGRATION_FILE.match(filename)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2), os.path.join(MIGRATIONS_DIR, filename)))
+    return sorted(migrations)
+
+def statements(path):
+    '''Split a migration file into statements, dropping comment lines.'''
+    with open(path) as f:
+        lines = [line for line in f if not line.strip().startswith('--')]
+    return [stmt.strip() for stmt in ''.join(lines).split(';') if stmt.strip()]
+
+def applied(db):
+    '''Versions already applied to this database.'''
+    query(db, """CREATE TABLE IF NOT EXISTS schema_migrations (
+                     version INTEGER PRIMARY KEY,
+                     name TEXT NOT NULL,
+                     applied_at INTEGER NOT NULL
+                 ) ENGINE=InnoDB DEFAULT CHARSET=utf8""")
+    return set(row['version'] for row in query(db, "SELECT version FROM schema_migrations"))
+
+def pending(db):
+    done = applied(db)
+    return [m for m in available() if m[0] not in done]
+
+
+# Applying migrations
+
+def apply_migrations(db):
+    '''Apply pending migrations in version order.'''
+    for version, name, path in pending(db):
+        print "Applying migration %03d (%s)..." % (version, name)
+        for stmt in statements(path):
+            start = time.time()
+            try:
+                query(db, stmt)
+            except OperationalError as e:
+                if e.args[0] not in ALREADY_APPLIED:
+                    raise
+                print "  Already applied: %s" % e.args[1]
+                continue
+            print "  %s (%.2fs)" % (stmt.split('\n')[0], time.time() - start)
+        query(db, "INSERT INTO schema_migrations(version, name, applied_at) VALUES (%d, '%s', %d)" % (version, name, time.time()))
+
+
+# Query plans
+
+def sample_parameters(db):
+    '''Representative parameters for CORE_QUERIES from existing data.'''
+    params = {'username': '', 'user_id': 0, 'thread_id': 0, 'task_id': 0, 'assn_id': 0, 'done': 1,
+              'post_id': 0, 'parent_post_id': 0, 'mongoid': ''}
+    for row in query(db, "SELECT a.assn_id, a.user_id, a.task_id, a.thread_id, a.done, u.username FROM assignments a JOIN users u ON a.user_id = u.id LIMIT 1"):
+        params.update(row)
+    for row in query(db, "SELECT post_id, thread_id, parent_post_id, mongoid FROM posts WHERE level > 2 LIMIT 1"):
+        params.update(row)
+    return params
+
+def explain_core_queries(db, repeat=5):
+    '''Print the query plan and mean run time of each core query.'''
+    params = sample_parameters(db)
+    for label, template in CORE_QUERIES:
+        q = template.format(**params)
+        try:
+            plans = query(db, "EXPLAIN " + q, fetchall=True)
+        except DatabaseError as e:
+            print "%-20s not available before migrating (%s)" % (label, e.args[-1])
+            continue
+        start = time.time()
+        for _ in range(repeat):
+            query(db, q, fetchall=True)
+        elapsed = (time.time() - start) / repeat
+        for plan in plans:
+            if 'detail' in plan:  # SQLite's EXPLAIN QUERY PLAN
+                print "%-20s %-70s %.2f ms" % (label, plan['detail'], elapsed * 1000)
+                continue
+            print "%-20s %-12s type=%-6s key=%-30s rows=%-8s %.2f ms" % (label, plan['table'], plan['type'], plan['key'], plan['rows'], elapsed * 1000)
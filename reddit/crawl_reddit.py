@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# crawl_reddit.py
+# Concurrent, rate-limited Reddit thread crawler with an on-disk response cache.
+#
+# Fetches a subreddit's top threads, or a list of thread ids, with a pool of worker
+# threads sharing one token bucket. Failed requests (429, 5xx, network errors, truncated
+# responses) back off exponentially. Responses are cached on disk by content hash, so a re-run only fetches what it has not seen.
+# --base-url points the crawler elsewhere, e.g. at a local stub server for offline runs.
+# `python -m benchmarks.crawl_check` checks it that way.
+#
+# Usage:
+#   ./crawl_reddit.py --subreddit Republican --limit 500
+#   ./crawl_reddit.py --subreddit Republican 12go74 5c8civ 13x6gq
+
+import argparse
+import errno
+import hashlib
+import httplib
+import json
+import os
+import random
+import sys
+import threading
+import time
+import urllib
+import urllib2
+from multiprocessing.dummy import Pool
+
+
+BASE_URL = 'https://www.reddit.com'
+USER_AGENT = 'forum-annotator crawler (research use)'
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+LISTING_PAGE = 100  # Most threads Reddit returns per listing request
+
+
+# Rate limiting
+
+class TokenBucket(object):
+    '''Thread-safe token bucket: rate tokens per second, holding at most burst.'''
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def take(self):
+        '''Block until a token is available, then spend it.'''
+        while True:
+            with self._lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# Response cache
+
+class DiskCache(object):
+    '''Content-addressed store of response bodies, with a ref per request URL.
+
+    Bodies live under objects/ named by their SHA-256; refs/ maps the SHA-1 of each URL
+    to the hash of its body. Files are written to a temporary name and renamed, so an
+    interrupted run never leaves a partial entry.'''
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, kind, digest):
+        return os.path.join(self.root, kind, digest[:2], digest[2:])
+
+    def _write(self, path, data):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        tmp = "%s.%d.%d.tmp" % (path, os.getpid(), threading.current_thread().ident)
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, path)
+
+    def get(self, url):
+        ref = self._path('refs', hashlib.sha1(url).hexdigest())
+        if not os.path.exists(ref):
+            return None
+        with open(ref) as f:
+            digest = f.read().strip()
+        try:
+            with open(self._path('objects', digest), 'rb') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def put(self, url, body):
+        digest = hashlib.sha256(body).hexdigest()
+        obj = self._path('objects', digest)
+        if not os.path.exists(obj):
+            self._write(obj, body)
+        self._write(self._path('refs', hashlib.sha1(url).hexdigest()), digest)
+
+
+# Fetching
+
+class FetchError(Exception):
+    def __init__(self, url, reason):
+        self.url = url
+        self.reason = reason
+
+    def __str__(self):
+        return "%s: %s" % (self.url, self.reason)
+
+def read_body(response):
+    '''A response's whole body. urllib2 returns whatever arrived before the connection
+    closed, so a body short of its Content-Length raises IncompleteRead here.'''
+    body = response.read()
+    length = response.info().get('Content-Length', '')
+    if length.isdigit() and len(body) < int(length):
+        raise httplib.IncompleteRead(body, int(length) - len(body))
+    return body
+
+class Crawler(object):
+    '''Fetch pages under base_url through a shared cache, rate limit and worker pool.'''
+
+    def __init__(self, cache, base_url=BASE_URL, workers=4, rate=1.0, burst=4,
+                 retries=6, backoff=2.0, max_backoff=120.0, timeout=30):
+        self.cache = cache
+        self.base_url = base_url.rstrip('/')
+        self.workers = workers
+        self.bucket = TokenBucket(rate, burst)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+
+    def url(self, path, params=None):
+        url = self.base_url + path
+        if params:
+            url += '?' + urllib.urlencode(sorted(params.items()))
+        return url
+
+    def delay(self, attempt, retry_after=None):
+        '''Seconds to wait before retry number attempt: exponential with jitter, or as the server asks.'''
+        if retry_after is not None and retry_after.isdigit():
+            return min(float(retry_after), self.max_backoff)
+        return min(self.backoff * 2 ** attempt, self.max_backoff) * random.uniform(0.5, 1.0)
+
+    def fetch(self, path, params=None, refresh=False):
+        '''Body of a page, from the cache or fetched with retries.'''
+        url = self.url(path, params)
+        if not refresh:
+            body = self.cache.get(url)
+            if body is not None:
+                return body
+        request = urllib2.Request(url, headers={'User-Agent': USER_AGENT})
+        for attempt in range(self.retries + 1):
+            self.bucket.take()
+            retry_after = None
+            try:
+                body = read_body(urllib2.urlopen(request, timeout=self.timeout))
+            except urllib2.HTTPError as e:
+                if e.code not in RETRY_STATUSES:
+                    raise FetchError(url, "HTTP %d" % e.code)
+                reason = "HTTP %d" % e.code
+                retry_after = e.headers.get('Retry-After')
+            except (urllib2.URLError, IOError, httplib.HTTPException) as e:
+                reason = "%s: %s" % (type(e).__name__, e)  # e.g. timeout, IncompleteRead, BadStatusLine
+            else:
+                self.cache.put(url, body)
+                return body
+            if attempt < self.retries:
+                time.sleep(self.delay(attempt, retry_after))
+        raise FetchError(url, "%s after %d attempts" % (reason, self.retries + 1))
+
+    def fetch_all(self, paths):
+        '''Fetch many paths concurrently, yielding (path, body, error) as each finishes.'''
+        def fetch_one(path):
+            try:
+                return path, self.fetch(path), None
+            except FetchError as e:
+                return path, None, e
+        pool = Pool(self.workers)
+        try:
+            for result in pool.imap_unordered(fetch_one, paths):
+                yield result
+        finally:
+            pool.close()
+            pool.join()
+
+
+# Reddit paths
+
+def thread_path(thread_id, subreddit=None):
+    if subreddit:
+        return "/r/%s/comments/%s" % (subreddit, thread_id)
+    return "/comments/%s" % thread_id
+
+def top_threads(crawler, subreddit, limit, period='all'):
+    '''Ids of a subreddit's top threads, read from the JSON listing a page at a time.'''
+    thread_ids = list()
+    after = None
+    while len(thread_ids) < limit:
+        params = {'t': period, 'limit': min(LISTING_PAGE, limit - len(thread_ids))}
+        if after:
+            params['after'] = after
+        listing = json.loads(crawler.fetch("/r/%s/top/.json" % subreddit, params))['data']
+        thread_ids.extend(child['data']['id'] for child in listing['children'])
+        after = listing.get('after')
+        if not after or not listing['children']:
+            break
+    return thread_ids[:limit]
+
+
+# Command line
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fetch Reddit threads as HTML, concurrently and with caching.")
+    parser.add_argument('thread_ids', nargs='*', help="Thread ids to fetch (default: the subreddit's top threads).")
+    parser.add_argument('--subreddit', help="Subreddit to list top threads from and fetch threads under.")
+    parser.add_argument('--limit', type=int, default=100, help="Number of top threads to fetch.")
+    parser.add_argument('--out', help="Directory for <thread_id>.html files (default raw/<subreddit>).")
+    parser.add_argument('--cache', default='cache', help="Response cache directory.")
+    parser.add_argument('--base-url', default=BASE_URL, help="Site to fetch from.")
+    parser.add_argument('--workers', type=int, default=4, help="Concurrent requests.")
+    parser.add_argument('--rate', type=float, default=1.0, help="Requests per second, across workers.")
+    parser.add_argument('--burst', type=int, default=4, help="Requests that may go out at once after a pause.")
+    parser.add_argument('--retries', type=int, default=6, help="Retries per request on 429, 5xx and network errors.")
+    args = parser.parse_args(argv)
+    if not args.thread_ids and not args.subreddit:
+        parser.error("give thread ids or a --subreddit")
+
+    crawler = Crawler(DiskCache(args.cache), base_url=args.base_url, workers=args.workers,
+                      rate=args.rate, burst=args.burst, retries=args.retries)
+    thread_ids = args.thread_ids or top_threads(crawler, args.subreddit, args.limit)
+    out = args.out or os.path.join('raw', (args.subreddit or 'threads').lower())
+    if not os.path.isdir(out):
+        os.makedirs(out)
+
+    paths = dict((thread_path(t, args.subreddit), t) for t in thread_ids)
+    failed = 0
+    for n, (path, body, error) in enumerate(crawler.fetch_all(sorted(paths)), 1):
+        if error is not None:
+            failed += 1
+            print >> sys.stderr, "Failed: %s" % error
+            continue
+        with open(os.path.join(out, paths[path] + '.html'), 'wb') as f:
+            f.write(body)
+        if n % 100 == 0:
+            print >> sys.stderr, "%d/%d threads" % (n, len(paths))
+    print >> sys.stderr, "Fetched %d threads into %s (%d failed)." % (len(paths) - failed, out, failed)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# reddit_parser.py
+# Reddit thread page parsing for forum data annotator application.
+#
+# Author: Alex Kindel
+# Date: 19 July 2016
+
+import os
+import re
+from itertools import izip
+from HTMLParser import HTMLParser, HTMLParseError
+from htmlentitydefs import name2codepoint
+from multiprocessing import Pool
+
+
+BLOCK_TAGS = ['p', 'li', 'blockquote', 'pre', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6']
+
+
+# Page parsing
+
+class ThreadPageParser(HTMLParser):
+    '''Pull the submission and comment tree out of an old-style Reddit thread page.
+
+    Each post is a div.thing with a data-fullname (t3_ for the submission, t1_ for
+    comments); replies are nested inside their parent comment's div. Post text is the
+    first div.md inside the thing, before any nested reply.'''
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.divs = list()    # Open divs: a post dict for a div.thing, 'md' for captured text, else None
+        self.things = list()  # Open post divs, outermost first
+        self.posts = list()   # Posts in document order
+        self.capture = None   # Post whose text is being read
+        self.title = None     # Post whose title is being read
+
+    def start_post(self, attrs, classes):
+        fullname = attrs['data-fullname']
+        author_id = attrs.get('data-author-fullname', '')
+        post = {'fullname': fullname,
+                'author': attrs.get('data-author', '[deleted]'),
+                'author_id': str(int(author_id[3:], 36)) if author_id.startswith('t2_') else '0',
+                'parent': self.things[-1]['fullname'] if self.things else None,
+                'depth': len(self.things),
+                'url': attrs.get('data-url', ''),
+                'text': list(), 'title': list(), 'created': None, 'edited': None, 'read': False}
+        # Only the first submission on the page is the thread; later t3 things are ads or sidebars
+        if fullname.startswith('t1_') or not any(p['fullname'].startswith('t3_') for p in self.posts):
+            self.posts.append(post)
+        self.things.append(post)
+        return post
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        classes = (attrs.get('class') or '').split()
+        post = self.things[-1] if self.things else None
+        if tag == 'div':
+            label = None
+            if 'thing' in classes and ('comment' in classes or 'link' in classes) and attrs.get('data-fullname'):
+                label = self.start_post(attrs, classes)
+            elif 'md' in classes and post is not None and self.capture is None and not post['read']:
+                label = 'md'
+                self.capture = post
+            self.divs.append(label)
+        elif tag == 'time' and post is not None and self.capture is None:
+            field = 'edited' if 'edited-timestamp' in classes else 'created'
+            if post[field] is None:
+                post[field] = attrs.get('datetime')
+        elif tag == 'a' and 'title' in classes and post is not None and post['fullname'].startswith('t3_') and not post['title']:
+            self.title = post
+        elif tag == 'br' and self.capture is not None:
+            self.capture['text'].append('\n')
+
+    def handle_endtag(self, tag):
+        if tag == 'div' and self.divs:
+            label = self.divs.pop()
+            if label == 'md':
+                self.capture['read'] = True
+                self.capture = None
+            elif label is not None:
+                self.things.pop()
+        elif tag == 'a':
+            self.title = None
+        elif tag in BLOCK_TAGS and self.capture is not None:
+            self.capture['text'].append('\n\n')
+
+    def handle_data(self, data):
+        if self.capture is not None:
+            self.capture['text'].append(data.replace('\n', ' '))
+        if self.title is not None:
+            self.title['title'].append(data)
+
+    def handle_entityref(self, name):
+        self.handle_data(unichr(name2codepoint[name]) if name in name2codepoint else '&%s;' % name)
+
+    def handle_charref(self, name):
+        self.handle_data(unichr(int(name[1:], 16) if name[0] in 'xX' else int(name)))
+
+def clean_text(parts):
+    text = re.sub(r'[ \t]+', ' ', ''.join(parts))
+    text = re.sub(r' ?\n ?', '\n', text)
+    return re.sub(r'\n{3,}', '\n\n', text).strip()
+
+def to_timestamp(iso):
+    '''Reddit's ISO 8601 UTC datetime as the loader's timestamp format.'''
+    if not iso:
+        return ''
+    return iso[:19].replace('T', ' ')
+
+def parse_page(html):
+    '''Rows in forum CSV layout for a thread page, in coding order, top-level post first.
+
+    Returns None if the page has no submission.'''
+    parser = ThreadPageParser()
+    parser.feed(html.decode('UTF-8', 'ignore') if isinstance(html, str) else html)
+    parser.close()
+    if not parser.posts or not parser.posts[0]['fullname'].startswith('t3_'):
+        return None
+
+    submission = parser.posts[0]
+    thread_id = submission['fullname']
+    comments = parser.posts[1:]
+    rows = list()
+    for post in parser.posts:
+        is_thread = post is submission
+        rows.append({'X_type': 'CommentThread' if is_thread else 'Comment',
+                     'mongoid': post['fullname'],
+                     'comment_thread_id': thread_id,
+                     'parent_ids': post['parent'] if post['parent'] and post['parent'].startswith('t1_') else '',
+                     'level': '1' if is_thread else str(post['depth'] + 2),
+                     'author_id': post['author_id'],
+                     'author_username': post['author'],
+                     'title': clean_text(post['title']) if is_thread else '',
+                     'body': clean_text(post['text']) or (post['url'] if is_thread else ''),
+                     'comment_count': str(len(comments)) if is_thread else '0',
+                     'created_at': to_timestamp(post['created']),
+                     'updated_at': to_timestamp(post['edited'] or post['created'])})
+    return rows
+
+def parse_file(path):
+    '''parse_page for a file, for use in worker processes; unparseable pages give None.'''
+    with open(path) as f:
+        html = f.read()
+    try:
+        return parse_page(html)
+    except HTMLParseError:
+        return None
+
+
+# Parallel parsing
+
+def page_paths(directory):
+    '''Thread page files (*.html) in a directory, in name order.'''
+    return [os.path.join(directory, name) for name in sorted(os.listdir(directory)) if name.endswith('.html')]
+
+def parse_pages(paths, processes=None, chunksize=8):
+    '''Parse thread pages across a process pool, yielding (path, rows) in path order.
+
+    rows is None for a page without a submission.'''
+    pool = Pool(processes)
+    try:
+        for path, rows in izip(paths, pool.imap(parse_file, paths, chunksize)):
+            yield path, rows
+    finally:
+        pool.close()
+        pool.join()
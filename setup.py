@@ -11,6 +11,7 @@ setup(
         'Jinja2>=2.8',
         'MarkupSafe>=0.23',
         'MySQL-python>=1.2.5',
+        'numpy>=1.11',
         'Werkzeug>=0.11.11'
     ]
 )
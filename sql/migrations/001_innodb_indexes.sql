@@ -0,0 +1,112 @@
+-- Move tables to InnoDB and index hot query paths --
+-- Each table is altered in one statement, so a partially applied migration can be re-run. --
+-- Before each unique key, rows duplicating an earlier one's key are merged into the latest (highest id): --
+-- references to the others are moved to it, then the others are deleted. These steps find nothing to do on a re-run. --
+
+-- Logins look up users by username --
+UPDATE `assignments` r
+    JOIN `users` d ON r.user_id = d.id
+    JOIN (SELECT username, MAX(id) AS id FROM `users` GROUP BY username) k ON k.username = d.username AND k.id <> d.id
+    SET r.user_id = k.id;
+
+UPDATE `codes` r
+    JOIN `users` d ON r.user_id = d.id
+    JOIN (SELECT username, MAX(id) AS id FROM `users` GROUP BY username) k ON k.username = d.username AND k.id <> d.id
+    SET r.user_id = k.id;
+
+UPDATE `tiebreakers` r
+    JOIN `users` d ON r.user_id = d.id
+    JOIN (SELECT username, MAX(id) AS id FROM `users` GROUP BY username) k ON k.username = d.username AND k.id <> d.id
+    SET r.user_id = k.id;
+
+DELETE d FROM `users` d
+    JOIN (SELECT username, MAX(id) AS id FROM `users` GROUP BY username) k ON k.username = d.username AND k.id <> d.id;
+
+ALTER TABLE `users`
+    MODIFY username VARCHAR(255) NOT NULL,
+    ADD UNIQUE KEY users_username (username),
+    ENGINE=InnoDB;
+
+-- Loads look up threads and posts by mongoid --
+UPDATE `posts` r
+    JOIN `threads` d ON r.thread_id = d.thread_id
+    JOIN (SELECT mongoid, MAX(thread_id) AS thread_id FROM `threads` GROUP BY mongoid) k ON k.mongoid = d.mongoid AND k.thread_id <> d.thread_id
+    SET r.thread_id = k.thread_id;
+
+UPDATE `assignments` r
+    JOIN `threads` d ON r.thread_id = d.thread_id
+    JOIN (SELECT mongoid, MAX(thread_id) AS thread_id FROM `threads` GROUP BY mongoid) k ON k.mongoid = d.mongoid AND k.thread_id <> d.thread_id
+    SET r.thread_id = k.thread_id;
+
+DELETE d FROM `threads` d
+    JOIN (SELECT mongoid, MAX(thread_id) AS thread_id FROM `threads` GROUP BY mongoid) k ON k.mongoid = d.mongoid AND k.thread_id <> d.thread_id;
+
+ALTER TABLE `threads`
+    MODIFY mongoid VARCHAR(64) NOT NULL,
+    ADD UNIQUE KEY threads_mongoid (mongoid),
+    ENGINE=InnoDB;
+
+-- Thread context is fetched by (thread_id, level) and (thread_id, parent_post_id) in post order --
+UPDATE `posts` r
+    JOIN `posts` d ON r.parent_post_id = d.post_id
+    JOIN (SELECT mongoid, MAX(post_id) AS post_id FROM `posts` GROUP BY mongoid) k ON k.mongoid = d.mongoid AND k.post_id <> d.post_id
+    SET r.parent_post_id = k.post_id;
+
+UPDATE `codes` r
+    JOIN `posts` d ON r.post_id = d.post_id
+    JOIN (SELECT mongoid, MAX(post_id) AS post_id FROM `posts` GROUP BY mongoid) k ON k.mongoid = d.mongoid AND k.post_id <> d.post_id
+    SET r.post_id = k.post_id;
+
+UPDATE `tiebreakers` r
+    JOIN `posts` d ON r.post_id = d.post_id
+    JOIN (SELECT mongoid, MAX(post_id) AS post_id FROM `posts` GROUP BY mongoid) k ON k.mongoid = d.mongoid AND k.post_id <> d.post_id
+    SET r.post_id = k.post_id;
+
+DELETE d FROM `posts` d
+    JOIN (SELECT mongoid, MAX(post_id) AS post_id FROM `posts` GROUP BY mongoid) k ON k.mongoid = d.mongoid AND k.post_id <> d.post_id;
+
+ALTER TABLE `posts`
+    MODIFY mongoid VARCHAR(64) NOT NULL,
+    ADD UNIQUE KEY posts_mongoid (mongoid),
+    ADD INDEX posts_thread_level (thread_id, level),
+    ADD INDEX posts_thread_parent (thread_id, parent_post_id, post_id),
+    ENGINE=InnoDB;
+
+ALTER TABLE `tasks`
+    ENGINE=InnoDB;
+
+-- One assignment per (thread, user, task); coders list their assignments by user_id --
+UPDATE `codes` r
+    JOIN `assignments` d ON r.assn_id = d.assn_id
+    JOIN (SELECT thread_id, user_id, task_id, MAX(assn_id) AS assn_id FROM `assignments` GROUP BY thread_id, user_id, task_id) k
+        ON k.thread_id = d.thread_id AND k.user_id = d.user_id AND k.task_id = d.task_id AND k.assn_id <> d.assn_id
+    SET r.assn_id = k.assn_id;
+
+UPDATE `tiebreakers` r
+    JOIN `assignments` d ON r.assn_id = d.assn_id
+    JOIN (SELECT thread_id, user_id, task_id, MAX(assn_id) AS assn_id FROM `assignments` GROUP BY thread_id, user_id, task_id) k
+        ON k.thread_id = d.thread_id AND k.user_id = d.user_id AND k.task_id = d.task_id AND k.assn_id <> d.assn_id
+    SET r.assn_id = k.assn_id;
+
+DELETE d FROM `assignments` d
+    JOIN (SELECT thread_id, user_id, task_id, MAX(assn_id) AS assn_id FROM `assignments` GROUP BY thread_id, user_id, task_id) k
+        ON k.thread_id = d.thread_id AND k.user_id = d.user_id AND k.task_id = d.task_id AND k.assn_id <> d.assn_id;
+
+ALTER TABLE `assignments`
+    ADD UNIQUE KEY assignments_thread_user_task (thread_id, user_id, task_id),
+    ADD INDEX assignments_user (user_id),
+    ENGINE=InnoDB;
+
+-- One code per post per assignment --
+DELETE d FROM `codes` d
+    JOIN (SELECT assn_id, post_id, MAX(code_id) AS code_id FROM `codes` GROUP BY assn_id, post_id) k
+        ON k.assn_id = d.assn_id AND k.post_id = d.post_id AND k.code_id <> d.code_id;
+
+ALTER TABLE `codes`
+    ADD UNIQUE KEY codes_assn_post (assn_id, post_id),
+    ADD INDEX codes_post_user_assn (post_id, user_id, assn_id),
+    ENGINE=InnoDB;
+
+ALTER TABLE `tiebreakers`
+    ADD INDEX tiebreakers_post_user (post_id, user_id),
+    ENGINE=InnoDB;
@@ -0,0 +1,21 @@
+-- Cache of agreement counts per coder pair, maintained as codes are written --
+CREATE TABLE IF NOT EXISTS `pair_agreement` (
+    task_id INTEGER NOT NULL,
+    thread_id INTEGER NOT NULL,
+    user1_id INTEGER NOT NULL,
+    user2_id INTEGER NOT NULL,
+    overlap INTEGER NOT NULL,
+    agree INTEGER NOT NULL,
+    PRIMARY KEY (task_id, thread_id, user1_id, user2_id)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+-- Cache of unresolved disagreements between coder pairs (user1_id < user2_id) --
+CREATE TABLE IF NOT EXISTS `disagreements` (
+    task_id INTEGER NOT NULL,
+    thread_id INTEGER NOT NULL,
+    post_id INTEGER NOT NULL,
+    user1_id INTEGER NOT NULL,
+    user2_id INTEGER NOT NULL,
+    PRIMARY KEY (task_id, post_id, user1_id, user2_id),
+    INDEX disagreements_thread (task_id, thread_id, post_id)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
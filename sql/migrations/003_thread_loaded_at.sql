@@ -0,0 +1,3 @@
+-- Stamp threads with the time their posts were last loaded, so cached thread context can be checked for staleness --
+ALTER TABLE `threads`
+    ADD COLUMN loaded_at INTEGER NOT NULL DEFAULT 0;
@@ -0,0 +1,12 @@
+-- Coding order of each thread's posts, written by the loader --
+-- Position 0 is the top-level post; assignments.done is the position of assignments.next_post_id. --
+-- Run `flask reposition` once after this migration to index threads loaded before it. --
+CREATE TABLE IF NOT EXISTS `post_positions` (
+    thread_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    post_id INTEGER NOT NULL,
+    parent_post_id INTEGER,
+    depth INTEGER NOT NULL,
+    PRIMARY KEY (thread_id, position),
+    UNIQUE KEY post_positions_post (post_id)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
@@ -0,0 +1,10 @@
+-- Stamp codes with the time they were last recorded, so exports can be filtered by date --
+-- Codes recorded before this migration are stamped with the time it was applied. --
+-- tiebreakers copies rows from codes with SELECT *, so both tables gain the same column. --
+ALTER TABLE `codes`
+    ADD COLUMN coded_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    ADD INDEX codes_coded_at (coded_at);
+
+ALTER TABLE `tiebreakers`
+    ADD COLUMN coded_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    ADD INDEX tiebreakers_coded_at (coded_at);
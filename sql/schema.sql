@@ -3,6 +3,13 @@
 CREATE DATABASE IF NOT EXISTS ForumAnnotator;
 USE ForumAnnotator;
 
+-- Migration history and tables created by migrations (migrations in sql/migrations are applied after build) --
+
+DROP TABLE IF EXISTS `schema_migrations`;
+DROP TABLE IF EXISTS `pair_agreement`;
+DROP TABLE IF EXISTS `disagreements`;
+DROP TABLE IF EXISTS `post_positions`;
+
 -- User table --
 
 DROP TABLE IF EXISTS `users`;
@@ -0,0 +1,175 @@
+-- Initialize SQLite database --
+-- The MySQL schema in sql/schema.sql with every migration in sql/migrations applied. --
+-- A migration added to sql/migrations needs its SQLite equivalent added here. --
+
+DROP TABLE IF EXISTS `schema_migrations`;
+DROP TABLE IF EXISTS `pair_agreement`;
+DROP TABLE IF EXISTS `disagreements`;
+DROP TABLE IF EXISTS `post_positions`;
+DROP TABLE IF EXISTS `users`;
+DROP TABLE IF EXISTS `threads`;
+DROP TABLE IF EXISTS `posts`;
+DROP TABLE IF EXISTS `tasks`;
+DROP TABLE IF EXISTS `assignments`;
+DROP TABLE IF EXISTS `codes`;
+DROP TABLE IF EXISTS `tiebreakers`;
+
+-- Migration history --
+
+CREATE TABLE `schema_migrations` (
+    version INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    applied_at INTEGER NOT NULL
+);
+INSERT INTO `schema_migrations` (version, name, applied_at) VALUES
+    (1, 'innodb_indexes', CAST(strftime('%s', 'now') AS INTEGER)),
+    (2, 'agreement_cache', CAST(strftime('%s', 'now') AS INTEGER)),
+    (3, 'thread_loaded_at', CAST(strftime('%s', 'now') AS INTEGER)),
+    (4, 'post_positions', CAST(strftime('%s', 'now') AS INTEGER)),
+    (5, 'code_timestamps', CAST(strftime('%s', 'now') AS INTEGER));
+
+-- User table --
+
+-- Usernames are case-insensitive, as with MySQL's default collation --
+CREATE TABLE `users` (
+    id INTEGER PRIMARY KEY,
+    username TEXT NOT NULL COLLATE NOCASE,
+    first_name TEXT NOT NULL,
+    last_name TEXT NOT NULL,
+    email TEXT NOT NULL,
+    pass_hash TEXT NOT NULL,
+    superuser BOOLEAN NOT NULL
+);
+CREATE UNIQUE INDEX users_username ON `users` (username);
+
+-- Forum data tables --
+
+CREATE TABLE `threads` (
+    thread_id INTEGER PRIMARY KEY,
+    mongoid TEXT NOT NULL,
+    creator TEXT NOT NULL,
+    title TEXT NOT NULL,
+    body TEXT NOT NULL,
+    comment_count INTEGER NOT NULL,
+    first_post_id INTEGER DEFAULT 0,
+    loaded_at INTEGER NOT NULL DEFAULT 0
+);
+CREATE UNIQUE INDEX threads_mongoid ON `threads` (mongoid);
+
+CREATE TABLE `posts` (
+    post_id INTEGER PRIMARY KEY,
+    thread_id INTEGER NOT NULL,
+    mongoid TEXT NOT NULL,
+    author_id INTEGER NOT NULL,
+    author_username TEXT NOT NULL,
+    body TEXT NOT NULL,
+    level INTEGER NOT NULL,
+    created_at INTEGER NOT NULL,
+    updated_at INTEGER NOT NULL,
+    parent_post_id INTEGER
+);
+CREATE UNIQUE INDEX posts_mongoid ON `posts` (mongoid);
+CREATE INDEX posts_thread_level ON `posts` (thread_id, level);
+CREATE INDEX posts_thread_parent ON `posts` (thread_id, parent_post_id, post_id);
+
+-- Position 0 is the top-level post; assignments.done is the position of assignments.next_post_id --
+CREATE TABLE `post_positions` (
+    thread_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    post_id INTEGER NOT NULL,
+    parent_post_id INTEGER,
+    depth INTEGER NOT NULL,
+    PRIMARY KEY (thread_id, position)
+) WITHOUT ROWID;
+CREATE UNIQUE INDEX post_positions_post ON `post_positions` (post_id);
+
+-- Annotation tables --
+
+-- allow_navigation is written by the task form --
+CREATE TABLE `tasks` (
+    task_id INTEGER PRIMARY KEY,
+    title TEXT NOT NULL,
+    label TEXT NOT NULL,
+    display TEXT NOT NULL,
+    prompt TEXT NOT NULL,
+    type TEXT NOT NULL,
+    options TEXT NOT NULL,
+    restrictions TEXT NOT NULL,
+    allow_comments BOOLEAN NOT NULL,
+    allow_navigation BOOLEAN NOT NULL DEFAULT 0
+);
+
+CREATE TABLE `assignments` (
+    assn_id INTEGER PRIMARY KEY,
+    task_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    thread_id INTEGER NOT NULL,
+    next_post_id INTEGER DEFAULT NULL,
+    done INTEGER DEFAULT 1,
+    finished BOOLEAN NOT NULL
+);
+CREATE UNIQUE INDEX assignments_thread_user_task ON `assignments` (thread_id, user_id, task_id);
+CREATE INDEX assignments_user ON `assignments` (user_id);
+
+CREATE TABLE `codes` (
+    code_id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    post_id INTEGER NOT NULL,
+    assn_id INTEGER NOT NULL,
+    code_value TEXT,
+    targets TEXT DEFAULT NULL,
+    comment TEXT DEFAULT NULL,
+    active INTEGER DEFAULT 1,
+    coded_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE UNIQUE INDEX codes_assn_post ON `codes` (assn_id, post_id);
+CREATE INDEX codes_post_user_assn ON `codes` (post_id, user_id, assn_id);
+CREATE INDEX codes_coded_at ON `codes` (coded_at);
+
+-- Same columns as codes, which tiebreakers are copied from with SELECT * --
+CREATE TABLE `tiebreakers` (
+    code_id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    post_id INTEGER NOT NULL,
+    assn_id INTEGER NOT NULL,
+    code_value TEXT,
+    targets TEXT DEFAULT NULL,
+    comment TEXT DEFAULT NULL,
+    active INTEGER DEFAULT 1,
+    coded_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX tiebreakers_post_user ON `tiebreakers` (post_id, user_id);
+CREATE INDEX tiebreakers_coded_at ON `tiebreakers` (coded_at);
+
+-- MySQL restamps coded_at on every update (ON UPDATE CURRENT_TIMESTAMP) --
+CREATE TRIGGER codes_coded_at AFTER UPDATE OF code_value, targets, comment ON `codes`
+BEGIN
+    UPDATE `codes` SET coded_at = CURRENT_TIMESTAMP WHERE code_id = NEW.code_id;
+END;
+
+CREATE TRIGGER tiebreakers_coded_at AFTER UPDATE OF code_value, targets, comment ON `tiebreakers`
+BEGIN
+    UPDATE `tiebreakers` SET coded_at = CURRENT_TIMESTAMP WHERE code_id = NEW.code_id;
+END;
+
+-- Agreement caches, maintained as codes are written --
+
+CREATE TABLE `pair_agreement` (
+    task_id INTEGER NOT NULL,
+    thread_id INTEGER NOT NULL,
+    user1_id INTEGER NOT NULL,
+    user2_id INTEGER NOT NULL,
+    overlap INTEGER NOT NULL,
+    agree INTEGER NOT NULL,
+    PRIMARY KEY (task_id, thread_id, user1_id, user2_id)
+) WITHOUT ROWID;
+
+CREATE TABLE `disagreements` (
+    task_id INTEGER NOT NULL,
+    thread_id INTEGER NOT NULL,
+    post_id INTEGER NOT NULL,
+    user1_id INTEGER NOT NULL,
+    user2_id INTEGER NOT NULL,
+    PRIMARY KEY (task_id, post_id, user1_id, user2_id)
+) WITHOUT ROWID;
+CREATE INDEX disagreements_thread ON `disagreements` (task_id, thread_id, post_id);
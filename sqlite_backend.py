@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# sqlite_backend.py
+# Embedded SQLite storage for forum data annotator application.
+#
+# Author: Alex Kindel
+# Date: 19 July 2016
+
+import os
+import re
+import sqlite3
+
+
+SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sql', 'sqlite', 'schema.sql')
+BUSY_TIMEOUT = 30  # Seconds a writer waits for another connection's transaction to finish
+PRAGMAS = ["PRAGMA journal_mode = WAL",    # Readers don't block the writer, or the writer them
+           "PRAGMA synchronous = NORMAL",  # Durable at checkpoints; safe against corruption in WAL mode
+           "PRAGMA temp_store = MEMORY"]
+TRANSLATION_CACHE_SIZE = 1024
+MIN_VERSION = (3, 24, 0)  # First SQLite with upserts (INSERT ... ON CONFLICT (...) DO UPDATE)
+
+# MySQL idioms in the app's queries and their SQLite equivalents, applied in order
+DIALECT = [(re.compile(r'\bSTART TRANSACTION\b'), 'BEGIN IMMEDIATE'),  # Take the write lock up front, so transactions never deadlock upgrading it
+           (re.compile(r'\bINSERT IGNORE\b'), 'INSERT OR IGNORE'),
+           (re.compile(r'\bVALUES\(([A-Za-z_]\w*)\)'), r'excluded.\1'),
+           (re.compile(r'\bUNIX_TIMESTAMP\(\)'), "CAST(strftime('%s', 'now') AS INTEGER)"),
+           (re.compile(r'\bLAST_INSERT_ID\(\)'), 'last_insert_rowid()'),
+           (re.compile(r'\bLEAST\('), 'MIN('),
+           (re.compile(r'\bGREATEST\('), 'MAX('),
+           (re.compile(r'<=>'), 'IS'),
+           (re.compile(r'\bBINARY\s+'), ''),  # SQLite compares text case-sensitively already
+           (re.compile(r'\bTRUNCATE TABLE\b'), 'DELETE FROM'),
+           (re.compile(r'\s+FOR UPDATE\b'), ''),  # BEGIN IMMEDIATE already holds the write lock
+           (re.compile(r'^\s*EXPLAIN\s+(?!QUERY PLAN)'), 'EXPLAIN QUERY PLAN '),
+           (re.compile(r'\)\s*ENGINE\s*=\s*\w+(\s+DEFAULT CHARSET\s*=\s*\w+)?'), ')')]
+
+# INSERT ... ON DUPLICATE KEY UPDATE becomes an upsert on the table's unique key, which
+# SQLite before 3.35 needs named; each table the app upserts into is listed here
+UPSERT = re.compile(r'^(\s*INSERT\s+INTO\s+`?(\w+)`?.*?)\bON DUPLICATE KEY UPDATE\b', re.S)
+CONFLICT_TARGETS = {'codes': '(assn_id, post_id)'}
+
+# MySQL session settings (SET sql_mode, SET NAMES) have no SQLite counterpart
+SESSION_SETTING = re.compile(r'^\s*SET\s', re.I)
+
+# Stored functions and procedures from sql/procs_funcs.sql, with {0}, {1}... for their arguments
+FUNCTIONS = {'total_posts': "(SELECT comment_count FROM threads WHERE thread_id = {0})",
+             'done_posts': "(SELECT done FROM assignments WHERE assn_id = {0})",
+             'thread_title': "(SELECT title FROM threads WHERE thread_id = {0})"}
+PROCEDURES = {'set_finished': "UPDATE assignments SET finished = 1 WHERE assn_id = {0}",
+              'set_levels': """UPDATE posts SET level = 4
+                               WHERE thread_id = {0} AND level = 3 AND post_id NOT IN (
+                                   SELECT MIN(post_id) FROM posts WHERE thread_id = {0} AND level = 3 GROUP BY parent_post_id)"""}
+FUNCTION_CALL = re.compile(r'\b(%s)\(([^()]*)\)' % '|'.join(FUNCTIONS))
+PROCEDURE_CALL = re.compile(r'^\s*CALL\s+(\w+)\(([^()]*)\)\s*$', re.I)
+
+
+# Query translation
+
+_translations = dict()
+
+def translate(query, placeholders=True):
+    '''SQLite version of a MySQL query, or None for a statement with nothing to do.
+
+    With placeholders, %s marks an argument (and %% a literal %), as with MySQLdb.'''
+    key = (query, placeholders)
+    if key in _translations:
+        return _translations[key]
+    if isinstance(query, str):
+        query = query.decode('UTF-8')
+    if SESSION_SETTING.match(query):
+        sql = None
+    else:
+        sql = query.replace('%s', '?').replace('%%', '%') if placeholders else query
+        call = PROCEDURE_CALL.match(sql)
+        if call:
+            sql = PROCEDURES[call.group(1)].format(*split_args(call.group(2)))
+        sql = FUNCTION_CALL.sub(lambda m: FUNCTIONS[m.group(1)].format(*split_args(m.group(2))), sql)
+        sql = UPSERT.sub(lambda m: "%sON CONFLICT%s DO UPDATE SET" % (m.group(1), CONFLICT_TARGETS[m.group(2)]), sql)
+        for pattern, replacement in DIALECT:
+            sql = pattern.sub(replacement, sql)
+    if len(_translations) >= TRANSLATION_CACHE_SIZE:
+        _translations.clear()  # Queries with values built in rarely repeat
+    _translations[key] = sql
+    return sql
+
+def split_args(args):
+    return [arg.strip() for arg in args.split(',')]
+
+def bind(args):
+    '''Query arguments as SQLite takes them: byte strings are decoded from UTF-8.'''
+    return tuple(decode(a) if isinstance(a, str) else a for a in args)
+
+def decode(value):
+    '''A UTF-8 byte string as unicode. Invalid bytes raise DataError, as MySQL's strict mode
+    rejects them, rather than being stored altered.'''
+    try:
+        return value.decode('UTF-8')
+    except UnicodeDecodeError as e:
+        raise sqlite3.DataError("Argument is not valid UTF-8 (%s at byte %d): %r" % (e.reason, e.start, value[max(e.start - 20, 0):e.end + 20]))
+
+
+# Connections
+
+def dict_row(cursor, row):
+    return dict((col[0], value) for col, value in zip(cursor.description, row))
+
+class SQLiteCursor(object):
+    '''Cursor taking the app's MySQL queries, with %s placeholders, and returning rows as dicts.'''
+
+    def __init__(self, connection):
+        self.connection = connection
+        self._cursor = connection.raw.cursor()
+        self._skipped = False
+
+    def execute(self, query, args=None):
+        sql = translate(query, args is not None)
+        self._skipped = sql is None
+        if self._skipped:
+            return 0
+        self._cursor.execute(sql, bind(args or ()))
+        return max(self._cursor.rowcount, 0)
+
+    def executemany(self, query, rows):
+        sql = translate(query)
+        self._cursor.executemany(sql, (bind(row) for row in rows))
+        return max(self._cursor.rowcount, 0)
+
+    def fetchall(self):
+        return [] if self._skipped else self._cursor.fetchall()
+
+    def fetchmany(self, size):
+        return [] if self._skipped else self._cursor.fetchmany(size)
+
+    @property
+    def lastrowid(self):
+        return self._cursor.lastrowid
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    def close(self):
+        self._cursor.close()
+
+class SQLiteConnection(object):
+    '''A SQLite database file in WAL mode, used like a MySQLdb connection.
+
+    Statements autocommit unless a transaction is opened with START TRANSACTION.
+    The connection may move between threads, but only one may use it at a time,
+    which the connection pool ensures.'''
+
+    def __init__(self, path, timeout=BUSY_TIMEOUT):
+        self.path = path
+        self.raw = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self.raw.row_factory = dict_row
+        for pragma in PRAGMAS:
+            self.raw.execute(pragma)
+
+    def cursor(self, cursorclass=None):
+        return SQLiteCursor(self)  # Every SQLite cursor streams, so any class will do
+
+    def autocommit(self, on):
+        pass
+
+    def commit(self):
+        self.raw.commit()
+
+    def rollback(self):
+        self.raw.rollback()
+
+    def ping(self):
+        self.raw.execute("SELECT 1")
+
+    def close(self):
+        self.raw.close()
+
+def connect(path):
+    if sqlite3.sqlite_version_info < MIN_VERSION:
+        raise RuntimeError("The SQLite backend needs SQLite %s or later; Python is linked against %s"
+                           % ('.'.join(str(v) for v in MIN_VERSION), sqlite3.sqlite_version))
+    return SQLiteConnection(path)
+
+
+# Schema
+
+def create_schema(connection):
+    '''Drop and recreate every table, at the schema version of the latest migration.'''
+    with open(SCHEMA) as f:
+        connection.raw.executescript(f.read())
@@ -0,0 +1,262 @@
+// annotate.js
+// Client-side prefetch and batched code submission for the annotation view.
+//
+// Posts ahead of the pointer are fetched from the annotation API in batches, so recording
+// a code shows the next post at once. Codes are queued and sent in the background, one
+// batch per request; navigation still goes through the server once the queue is saved.
+
+(function ($) {
+    var form, display, recordName, postsUrl, codesUrl, pageUrl, prefetch;
+    var top = null;
+    var posts = {};       // post_id -> post
+    var items = [];       // Posts to code in order, each {post_id, position, context}
+    var current = 0;      // Index in items of the post on screen
+    var exhausted = false;
+    var fetching = false;
+    var pending = [];     // Codes not yet sent
+    var sending = false;
+    var onSaved = [];     // Callbacks to run once every code is saved
+    var submitter = null;
+
+    // Prefetching
+
+    function lastPosition() {
+        return items.length ? items[items.length - 1].position : form.data('position') - 1;
+    }
+
+    function fetchMore(then) {
+        if (exhausted || fetching) {
+            return;
+        }
+        fetching = true;
+        $.getJSON(postsUrl, {after: lastPosition(), count: prefetch})
+            .done(function (data) {
+                fetching = false;
+                top = data.top;
+                $.extend(posts, data.posts);
+                items = items.concat(data.items);
+                exhausted = data.items.length < prefetch;
+                if (then) {
+                    then();
+                }
+            })
+            .fail(function () {
+                fetching = false;
+            });
+    }
+
+    // Rendering, matching posts/cumulative_thread.html and posts/sequential_thread.html
+
+    function postLabel(post) {
+        if (post.level === 1) {
+            return $('<em>').text('Top-level post');
+        }
+        if (post.level === 2) {
+            return $('<em>').text('Main reply');
+        }
+        return null;
+    }
+
+    function contextItem(post, next) {
+        var li = $('<li class="post">').attr('indent', post.level);
+        var user = $('<div class="user">').text(post.author_username);
+        if (next.level >= 3 && display === 'replymap') {
+            user.append(' ', $('<input type="checkbox" form="codeform">').attr('name', 'target_' + post.post_id).val(post.post_id));
+        }
+        li.append(user);
+        if (post.level === 2) {
+            li.append(postLabel(post), '<br>');
+        }
+        return li.append('<br>', document.createTextNode(post.body));
+    }
+
+    function render(item) {
+        var next = posts[item.post_id];
+        var thread = $('#thread').empty();
+        var coding = $('<div class="post">');
+        var body = coding;
+
+        if (display === 'cumthread' || display === 'replymap') {
+            var list = $('<ul>');
+            if (top) {
+                list.append($('<li class="post">').attr('indent', top.level).append(
+                    $('<div class="user">').text(top.author_username), postLabel(top), '<br><br>', document.createTextNode(top.body)));
+            }
+            $.each(item.context, function (_, post_id) {
+                list.append(contextItem(posts[post_id], next));
+            });
+            thread.append(list);
+            if (top && top.author_username === next.author_username) {
+                body = $('<span class="staffpost">').appendTo(coding);
+            }
+            body.append('<u>Now coding:</u>', '<br>', $('<div class="user">').text(next.author_username));
+            if (next.level === 2) {
+                body.append(postLabel(next), '<br>');
+            }
+        } else {
+            body.append('<u>Now coding:</u>', '<br>', $('<div class="user">').text(next.author_username));
+            if (next.level <= 2) {
+                body.append(postLabel(next), '<br>');
+            }
+        }
+        body.append('<br>', document.createTextNode(next.body));
+        thread.append($('<div id="annotatethread">').append(coding));
+
+        // Reset the code inputs and apply option restrictions for this post's level
+        form[0].reset();
+        form.find('option[data-restr]').each(function () {
+            var restr = $(this).attr('data-restr');
+            var allowed = restr === '_' || next.level >= parseInt(restr, 10);
+            $(this).prop('disabled', !allowed).toggle(allowed);
+        });
+        $('#gotoform input[name=position]').val(item.position);
+        window.scrollTo(0, document.body.scrollHeight);
+    }
+
+    function showMessage(msg) {
+        $('#apimessage').text(msg).toggle(!!msg);
+    }
+
+    // Recording codes
+
+    function readCode() {
+        var values = [];
+        form.find('[name^=choice]').each(function () {
+            if ((this.type === 'checkbox' || this.type === 'radio') && !this.checked) {
+                return;
+            }
+            values.push($(this).val());
+        });
+        return {
+            post_id: items[current].post_id,
+            values: values,
+            targets: $('input[name^=target_]:checked').map(function () { return this.value; }).get(),
+            comment: form.find('textarea[name=comment]').val() || ''
+        };
+    }
+
+    function checkCode(code) {
+        if (!code.values.length || $.inArray('no_code', code.values) >= 0) {
+            return 'Submit a code for this post.';
+        }
+        if (display === 'replymap' && $.inArray('commenters', code.values) >= 0 && !code.targets.length) {
+            return 'Which commenters was this post responding to?';
+        }
+        return null;
+    }
+
+    function flush() {
+        if (sending) {
+            return;
+        }
+        if (!pending.length) {
+            while (onSaved.length) {
+                onSaved.shift()();
+            }
+            return;
+        }
+        sending = true;
+        var batch = pending;
+        pending = [];
+        $.ajax({url: codesUrl, type: 'POST', contentType: 'application/json', dataType: 'json', data: JSON.stringify({codes: batch})})
+            .done(function (data) {
+                sending = false;
+                if (data.finished) {
+                    showMessage(data.message);
+                }
+                flush();
+            })
+            .fail(function (xhr) {
+                // Fall back to the server's view of the assignment
+                var error = xhr.responseJSON && xhr.responseJSON.error;
+                pending = [];
+                onSaved = [];
+                alert((error || 'Your codes could not be saved.') + ' Reloading from the last saved post.');
+                window.location = pageUrl;
+            });
+    }
+
+    function record(event) {
+        event.preventDefault();
+        var code = readCode();
+        var msg = checkCode(code);
+        if (msg) {
+            showMessage(msg);
+            return;
+        }
+        showMessage(null);
+        pending.push(code);
+        flush();
+
+        if (current + 1 < items.length) {
+            current += 1;
+            render(items[current]);
+        } else if (exhausted) {
+            showMessage('Last post. This thread is finished!');
+        } else {
+            // Prefetch fell behind: show the next post as soon as it arrives
+            showMessage('Loading...');
+            fetchMore(function () {
+                showMessage(null);
+                if (current + 1 < items.length) {
+                    current += 1;
+                    render(items[current]);
+                } else {
+                    showMessage('Last post. This thread is finished!');
+                }
+            });
+        }
+        if (items.length - current <= prefetch / 2) {
+            fetchMore();
+        }
+    }
+
+    function afterSaving(event, target) {
+        // Let queued codes reach the server before it moves the pointer
+        if (!pending.length && !sending) {
+            return;
+        }
+        event.preventDefault();
+        showMessage('Saving codes...');
+        onSaved.push(function () {
+            if (submitter && submitter.name) {
+                $('<input type="hidden">').attr('name', submitter.name).val(submitter.value).appendTo(target);
+            }
+            target.submit();
+        });
+    }
+
+    $(function () {
+        form = $('#codeform');
+        if (!form.data('posts-url')) {
+            return;
+        }
+        display = form.data('display');
+        recordName = form.data('record');
+        postsUrl = form.data('posts-url');
+        codesUrl = form.data('codes-url');
+        pageUrl = form.attr('action');
+        prefetch = form.data('prefetch');
+
+        $('input[type=submit]').on('click', function () {
+            submitter = this;
+        });
+        form.on('submit', function (event) {
+            if (submitter && submitter.name === recordName && items.length) {
+                record(event);
+            } else {
+                afterSaving(event, form[0]);
+            }
+        });
+        $('#gotoform').on('submit', function (event) {
+            afterSaving(event, this);
+        });
+        $(window).on('beforeunload', function () {
+            if (pending.length || sending) {
+                return 'Some codes are still being saved.';
+            }
+        });
+
+        fetchMore();
+    });
+})(jQuery);